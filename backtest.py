@@ -0,0 +1,193 @@
+import copy
+import csv
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from classes import *
+
+
+def load_price_csvs(csv_dir: str, tickers: list = None, price_column: str = 'Adj Close'):
+    """
+    Loads Yahoo Finance style daily price CSVs (i.e., demo_data/) and aligns them on a shared date index
+    :param csv_dir: a directory containing TICKER.csv files
+    :param tickers: (optional) a list of tickers to load. If None, every .csv file in csv_dir is loaded.
+    :param price_column: default is 'Adj Close'. The CSV column to use as the daily price.
+    :return: (dates, tickers, prices) where dates is a datetime64[D] array, and prices is a (dates x tickers) array
+    with NaN on days a ticker has no data
+    """
+    if not tickers:
+        tickers = sorted([os.path.splitext(f)[0] for f in os.listdir(csv_dir) if f.endswith('.csv')])
+
+    series = []
+    for tick in tickers:
+        with open(os.path.join(csv_dir, f'{tick}.csv'), newline='') as f:
+            reader = csv.DictReader(f)
+            rows = [(row['Date'], row[price_column]) for row in reader if row[price_column] not in ('', 'null')]
+        dates = np.array([date for date, _ in rows], dtype='datetime64[D]')
+        prices = np.array([price for _, price in rows], dtype=np.float64)
+        series.append((dates, prices))
+
+    all_dates = np.unique(np.concatenate([dates for dates, _ in series]))
+    price_array = np.full((len(all_dates), len(tickers)), np.nan)
+    for i, (dates, prices) in enumerate(series):
+        price_array[np.searchsorted(all_dates, dates), i] = prices
+
+    return all_dates, list(tickers), price_array
+
+
+class Backtest:
+    """
+    Replays a daily price history through a Portfolio, allocating a fixed contribution with
+    Portfolio.get_optimal_allocations() every contribution_frequency trading days.
+    The following user facing class functions are defined:
+    - Backtest.run() -> np.ndarray: runs the backtest and returns the daily equity curve
+    """
+
+    def __init__(self, portfolio: Portfolio, dates: np.ndarray, tickers: list, prices: np.ndarray,
+                 contribution: float = 1000, contribution_frequency: int = 21, gamma: float = None,
+                 greed: float = None, conservativeness: float = None, correlation_gamma: float = None,
+                 fractional_shares: bool = True, solver_kwargs: dict = None, fundamentals: FundamentalsStore = None,
+                 pe_window: int = None):
+        """
+        :param portfolio: a Portfolio with DCF valuations completed for the tickers to be bought
+        :param dates: an array of dates with the same length as prices
+        :param tickers: a list of tickers matching the columns of prices
+        :param prices: a (dates x tickers) array of prices, i.e., from load_price_csvs()
+        :param contribution: default is 1000. The $ amount contributed at each contribution date.
+        :param contribution_frequency: default is 21 (~monthly). The number of trading days between contributions.
+        :param gamma: (optional) passed to Portfolio.get_optimal_allocations()
+        :param greed: (optional) passed to Portfolio.get_optimal_allocations()
+        :param conservativeness: (optional) passed to Portfolio.get_optimal_allocations()
+        :param correlation_gamma: (optional) passed to Portfolio.get_optimal_allocations(), only used if the
+        portfolio tracks correlations (see Portfolio.track_correlations())
+        :param fractional_shares: default is True. If False, only whole shares are bought and leftovers stay in cash.
+        :param solver_kwargs: (optional) if provided, allocations come from Portfolio.solve_optimal_allocations() called
+        with these keyword arguments (i.e., {'max_position_size': 0.3, 'lot_sizes': 1}), warm started between
+        contribution dates
+        :param fundamentals: (optional) a FundamentalsStore, if provided positions are re-valued with the EPS, EPS growth
+        and pe history known at each contribution date (see Portfolio.run_fundamentals_dcf())
+        :param pe_window: (optional) the number of most recent pe ratios used for the pe scenarios, default is all
+        """
+        self.portfolio = portfolio
+        self.dates = np.asarray(dates)
+        self.tickers = list(tickers)
+        self.prices = np.asarray(prices, dtype=np.float64)
+        self.contribution = contribution
+        self.contribution_frequency = contribution_frequency
+        self.gamma = gamma
+        self.greed = greed
+        self.conservativeness = conservativeness
+        self.correlation_gamma = correlation_gamma
+        self.fractional_shares = fractional_shares
+        self.solver_kwargs = solver_kwargs
+        self.fundamentals = fundamentals
+        self.pe_window = pe_window
+
+        # open empty positions for any ticker the portfolio does not hold yet
+        new_positions = {tick: [0, 0] for tick in self.tickers if tick not in portfolio.positions}
+        if new_positions:
+            portfolio.open_new_positions(new_positions)
+
+        # map price columns to store rows once so each day is a single array update
+        self.rows = portfolio.store.get_rows(self.tickers)
+
+        self.cash = 0.0
+        self.equity_curve = np.zeros(len(self.dates))
+        self.contributed = np.zeros(len(self.dates))
+        self.contribution_dates = []
+        self.allocations = []  # a list of optimal allocation dictionaries, one per contribution date
+
+    def run(self) -> np.ndarray:
+        portfolio = self.portfolio
+        store = portfolio.store
+        total_contributed = 0.0
+
+        for i in range(len(self.dates)):
+            portfolio.update_current_prices_array(self.prices[i], self.rows)
+            portfolio.update_correlations()
+
+            if i % self.contribution_frequency == 0:
+                total_contributed += self.contribution
+                self.cash += self.contribution
+                self._allocate(i)
+
+            self.equity_curve[i] = np.nansum(store['equity']) + self.cash
+            self.contributed[i] = total_contributed
+
+        return self.equity_curve
+
+    # #### INTERNAL METHODS #####
+    def _allocate(self, i: int):
+        if self.fundamentals is not None:
+            self.portfolio.run_fundamentals_dcf(self.fundamentals, self.dates[i], self.pe_window)
+        if self.solver_kwargs is not None:
+            return self._allocate_with_solver(i)
+
+        allocations = self.portfolio.get_optimal_allocations(gamma=self.gamma, greed=self.greed,
+                                                             conservativeness=self.conservativeness,
+                                                             correlation_gamma=self.correlation_gamma)
+        self.contribution_dates.append(self.dates[i])
+        self.allocations.append(allocations)
+
+        cash = self.cash
+        for tick, allocation in allocations.items():
+            position = self.portfolio.positions[tick]
+            price = position.current_price
+            if allocation <= 0 or not price:
+                continue
+
+            shares = (cash * allocation) / price
+            if not self.fractional_shares:
+                shares = np.floor(shares)
+            if shares > 0:
+                position.make_a_buy(shares, price)
+                self.cash -= shares * price
+
+    def _allocate_with_solver(self, i: int):
+        portfolio = self.portfolio
+        allocations = portfolio.solve_optimal_allocations(self.cash, gamma=self.gamma, greed=self.greed,
+                                                          conservativeness=self.conservativeness,
+                                                          correlation_gamma=self.correlation_gamma,
+                                                          **self.solver_kwargs)
+        self.contribution_dates.append(self.dates[i])
+        self.allocations.append(allocations)
+
+        for tick, shares in portfolio.optimal_shares.items():
+            if shares > 0:
+                position = portfolio.positions[tick]
+                price = position.current_price
+                position.make_a_buy(shares, price)
+                self.cash -= shares * price
+
+
+def _init_sweep_worker(portfolio, dates, tickers, prices, backtest_kwargs):
+    global _sweep_state
+    _sweep_state = (portfolio, dates, tickers, prices, backtest_kwargs)
+
+
+def _run_sweep_task(params: dict) -> dict:
+    portfolio, dates, tickers, prices, backtest_kwargs = _sweep_state
+    kwargs = dict(backtest_kwargs)
+    kwargs.update(params)
+    backtest = Backtest(copy.deepcopy(portfolio), dates, tickers, prices, **kwargs)
+    equity_curve = backtest.run()
+    return {'params': params, 'final_equity': float(equity_curve[-1]), 'equity_curve': equity_curve}
+
+
+def run_parameter_sweep(portfolio: Portfolio, dates: np.ndarray, tickers: list, prices: np.ndarray,
+                        param_sets: list, processes: int = None, **backtest_kwargs) -> list:
+    """
+    Runs one backtest per parameter set across a process pool. The portfolio and price history are sent to each worker
+    once, and every backtest starts from its own copy of the portfolio.
+    :param portfolio: the starting Portfolio, with DCF valuations completed
+    :param dates: an array of dates with the same length as prices
+    :param tickers: a list of tickers matching the columns of prices
+    :param prices: a (dates x tickers) array of prices
+    :param param_sets: a list of dictionaries of Backtest keyword arguments, i.e., [{'gamma': 0.1, 'greed': 0.5}, ...]
+    :param processes: (optional) the number of worker processes, default is the number of cores
+    :param backtest_kwargs: keyword arguments shared by all backtests (i.e., contribution=500)
+    :return: a list of dictionaries with 'params', 'final_equity' and 'equity_curve' keys, in param_sets order
+    """
+    with ProcessPoolExecutor(max_workers=processes, initializer=_init_sweep_worker,
+                             initargs=(portfolio, dates, tickers, prices, backtest_kwargs)) as executor:
+        return list(executor.map(_run_sweep_task, param_sets))
@@ -0,0 +1,182 @@
+import argparse
+import copy
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+
+from backtest import *
+from diagnostics import quiet, OFF
+
+
+def make_synthetic_prices(n_tickers: int, n_days: int = 1260, seed: int = 0):
+    """
+    Builds daily prices shaped like the demo_data/ CSVs (~5 years of trading days) from geometric Brownian motions
+    :return: (dates, tickers, prices) in the same format as backtest.load_price_csvs()
+    """
+    rng = np.random.default_rng(seed)
+    tickers = [f'T{i:06d}' for i in range(n_tickers)]
+    dates = np.busday_offset('2017-05-22', np.arange(n_days), roll='forward')
+
+    start_prices = rng.uniform(10, 500, n_tickers)
+    drifts = rng.normal(0.0003, 0.0003, n_tickers)
+    volatilities = rng.uniform(0.01, 0.03, n_tickers)
+    log_returns = drifts + (volatilities * rng.standard_normal((n_days, n_tickers)))
+    prices = start_prices * np.exp(np.cumsum(log_returns, axis=0))
+    return dates, tickers, prices
+
+
+def make_synthetic_portfolio(tickers: list, prices: np.ndarray, seed: int = 0) -> Portfolio:
+    """
+    Builds a portfolio holding every ticker with random share counts, priced at prices[-1]
+    """
+    rng = np.random.default_rng(seed)
+    n_tickers = len(tickers)
+    shares = rng.integers(0, 100, n_tickers).astype(float)
+    with quiet(OFF):
+        portfolio = Portfolio(dict(zip(tickers, zip(shares, prices[0]))))
+    portfolio.update_current_prices_array(prices[-1])
+    return portfolio
+
+
+def make_synthetic_dcf_dict(tickers: list, prices: np.ndarray, seed: int = 0) -> dict:
+    rng = np.random.default_rng(seed)
+    n_tickers = len(tickers)
+    pes = rng.uniform(10, 30, n_tickers)
+    eps = prices[-1] / (pes * rng.uniform(0.6, 1.4, n_tickers))
+    growths = rng.uniform(0, 25, n_tickers)
+    return {tick: [eps[i], growths[i], [pes[i] * 0.7, pes[i], pes[i] * 1.3]] for i, tick in enumerate(tickers)}
+
+
+def measure_stage(func, repeats: int = 1, trace_memory: bool = True) -> dict:
+    """
+    Times a stage (best of repeats), then re-runs it once under tracemalloc to record its peak allocated memory
+    """
+    best = np.inf
+    for _ in range(repeats):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+
+    result = {'seconds': best}
+    if trace_memory:
+        tracemalloc.start()
+        func()
+        result['peak_memory_bytes'] = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return result
+
+
+def run_benchmarks(sizes: list, n_days: int = 1260, repeats: int = 3, trace_memory: bool = True,
+                   max_correlation_size: int = 2000, max_backtest_size: int = 1000) -> list:
+    """
+    Times the valuation and allocation hot paths on synthetic portfolios of each size
+    :param sizes: a list of portfolio sizes (number of positions)
+    :param n_days: default is 1260. The number of synthetic trading days.
+    :param repeats: default is 3. Each stage's time is the best of this many runs.
+    :param trace_memory: default is True. Records each stage's peak memory with tracemalloc.
+    :param max_correlation_size: the largest size the O(N^2) correlation stage runs for
+    :param max_backtest_size: the largest size the daily backtest stage runs for
+    :return: a list of result dictionaries with 'n_positions', 'stage', 'seconds' and 'peak_memory_bytes' keys
+    """
+    results = []
+    for n_positions in sizes:
+        dates, tickers, prices = make_synthetic_prices(n_positions, n_days)
+        dcf_dict = make_synthetic_dcf_dict(tickers, prices)
+        portfolio = make_synthetic_portfolio(tickers, prices)
+        portfolio.run_batch_dcf(dcf_dict, use_cache=False)
+        single_dcf_inputs = dcf_dict[tickers[0]]
+
+        def full_allocation():
+            portfolio._derived_params = None
+            portfolio.get_optimal_allocations()
+
+        def single_tick_allocation():
+            portfolio.positions[tickers[0]]._update_current_price(float(prices[-1, 0]))
+            portfolio.get_optimal_allocations()
+
+        stages = {
+            'make_synthetic_portfolio': lambda: make_synthetic_portfolio(tickers, prices),
+            'run_DCF_valuation': lambda: run_DCF_valuation(*single_dcf_inputs[:2], 0.05, single_dcf_inputs[2]),
+            'run_batch_dcf': lambda: portfolio.run_batch_dcf(dcf_dict, use_cache=False),
+            'calculate_expected_roic': lambda: portfolio.calculate_expected_roic(),
+            'add_portolio_balancer': lambda: portfolio.add_portolio_balancer(),
+            'get_optimal_allocations': full_allocation,
+            'get_optimal_allocations_single_tick': single_tick_allocation,
+            'update_current_prices_array': lambda: portfolio.update_current_prices_array(prices[-1]),
+        }
+        if n_positions <= max_correlation_size:
+            stages['update_correlations'] = lambda: StreamingCorrelation(n_positions).fit(prices[-21:])
+        if n_positions <= max_backtest_size:
+            # the backtest only buys positions with valuations, so each run starts from a valued copy
+            backtest_portfolio = make_synthetic_portfolio(tickers, prices)
+            backtest_portfolio.run_batch_dcf(dcf_dict, use_cache=False)
+            stages['backtest'] = lambda: Backtest(copy.deepcopy(backtest_portfolio), dates, tickers, prices).run()
+
+        with quiet(OFF):
+            for stage, func in stages.items():
+                result = measure_stage(func, repeats=repeats, trace_memory=trace_memory)
+                result.update({'n_positions': n_positions, 'stage': stage})
+                results.append(result)
+                print(f'{n_positions} positions | {stage}: {result["seconds"]:.6f}s', file=sys.stderr)
+
+    return results
+
+
+def get_commit() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        return None
+
+
+def compare_results(results: list, baseline: list) -> list:
+    """
+    :return: a list of (n_positions, stage, seconds, baseline seconds, ratio) for stages present in both runs
+    """
+    baseline_seconds = {(result['n_positions'], result['stage']): result['seconds'] for result in baseline}
+    comparison = []
+    for result in results:
+        key = (result['n_positions'], result['stage'])
+        if key in baseline_seconds:
+            ratio = result['seconds'] / baseline_seconds[key] if baseline_seconds[key] else np.nan
+            comparison.append(key + (result['seconds'], baseline_seconds[key], ratio))
+    return comparison
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the valuation and allocation hot paths')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10, 100, 1000, 10000, 100000])
+    parser.add_argument('--days', type=int, default=1260)
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--no-memory', action='store_true', help='skip the tracemalloc peak memory runs')
+    parser.add_argument('--output', help='write results as JSON to this path (default is stdout)')
+    parser.add_argument('--compare', help='a previous JSON results file to compare stage times against')
+    args = parser.parse_args()
+
+    report = {
+        'commit': get_commit(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'results': run_benchmarks(args.sizes, n_days=args.days, repeats=args.repeats,
+                                  trace_memory=not args.no_memory),
+    }
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline_report = json.load(f)
+        for n_positions, stage, seconds, baseline, ratio in compare_results(report['results'],
+                                                                             baseline_report['results']):
+            print(f'{n_positions} positions | {stage}: {seconds:.6f}s vs {baseline:.6f}s ({ratio:.2f}x)',
+                  file=sys.stderr)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
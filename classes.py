@@ -1,105 +1,484 @@
 from functions import *
+from correlation import StreamingCorrelation, get_weighted_correlations
+from valuation_cache import ValuationCache, get_valuation_key
+from monte_carlo import run_monte_carlo_DCF, QUANTILE_LEVELS
+from lot_ledger import LotLedger, read_trade_history
+from position_heap import IndexedMaxHeap
+from fundamentals import FundamentalsStore
+from risk import RISK_METRICS
+from diagnostics import emit, format_items, is_enabled, DEBUG, INFO, WARNING, ERROR
+
+
+class PositionStore:
+    """
+    Struct-of-arrays storage for the state of many positions. Each attribute is held in one contiguous numpy array
+    (a column) and each ticker maps to a row, so portfolio wide updates are single array operations.
+    Rows whose derived values (expected and greedy returns) need recomputing are tracked in dirty_rows, rows whose DCF
+    valuation is out of date in stale_valuation_rows, and running sums of equity are kept for allocation statistics.
+    - PositionStore.add_row(ticker) -> int: appends a row with default values and returns its index
+    - PositionStore[column]: returns the active rows of a column as a writable numpy view
+    - PositionStore.update_prices(rows, prices): sets current prices and recomputes equity for the given rows
+    - PositionStore.set_equity(rows, values): sets equity while keeping the running sums up to date
+    - PositionStore.get_top_rows(n) -> np.ndarray: the rows of the n largest positions by equity, largest first
+    """
+    # column name -> default value, every column is float64
+    column_defaults = {
+        'shares': 0.0,
+        'invested': 0.0,
+        'current_price': np.nan,
+        'equity': np.nan,
+        'raw_valuation': np.nan,  # valuations weighted by the scenario weightings
+        'expected_return': np.nan,
+        'greedy_return': np.nan,
+        'decay_rate': 0.05,
+        'discount_rate': 0.125,  # default discount rate
+        'eps': np.nan,  # DCF inputs from the last valuation, used to re-value after decay/discount rate changes
+        'eps_growth': np.nan,
+        'prob_loss': np.nan,  # probability the value is below the price when the Monte Carlo DCF was run
+        'implied_growth': np.nan,  # three year EPS growth priced in by the current price, see Portfolio.run_reverse_dcf()
+        'implied_pe': np.nan,
+        'volatility': np.nan,  # risk metrics from price histories, see Portfolio.set_risk_metrics()
+        'rolling_volatility': np.nan,
+        'beta': np.nan,
+        'max_drawdown': np.nan,
+        'downside_deviation': np.nan,
+        'mean_return': np.nan,
+    }
+    # column name -> width of per row arrays, these default to NaN
+    wide_columns = {
+        'valuations': 3,  # valuations are stored as [low, middle, high]
+        'pe_scenarios': 3,
+        'value_quantiles': len(QUANTILE_LEVELS),  # Monte Carlo value distribution, see Portfolio.run_monte_carlo_dcf()
+    }
+
+    def __init__(self, capacity: int = 16):
+        self.rows = {}  # ticker -> row index
+        self.tickers = []  # row index -> ticker
+        self.size = 0
+        self.capacity = max(int(capacity), 1)
+
+        self.columns = {}
+        for name, default in self.column_defaults.items():
+            self.columns[name] = np.full(self.capacity, default, dtype=np.float64)
+        for name, width in self.wide_columns.items():
+            self.columns[name] = np.full((self.capacity, width), np.nan, dtype=np.float64)
+
+        self.dirty_rows = set()
+        self.stale_valuation_rows = set()
+        self.journal = None  # (optional) an append-only log of row changes, see snapshot.PortfolioJournal
+
+        # running sums over equity (NaN counted as 0), resynced after enough incremental updates to bound float drift
+        self.equity_sum = 0.0
+        self.equity_sq_sum = 0.0
+        self._n_sum_updates = 0
+        self.equity_heap = IndexedMaxHeap()  # rows ordered by equity, for the largest positions
+
+    def __getitem__(self, column: str) -> np.ndarray:
+        return self.columns[column][:self.size]
+
+    def __len__(self):
+        return self.size
+
+    def add_row(self, ticker) -> int:
+        if self.size == self.capacity:
+            self._grow(self.capacity * 2)
+
+        row = self.size
+        self.rows[ticker] = row
+        self.tickers.append(ticker)
+        self.size += 1
+        self.dirty_rows.add(row)
+        self.equity_heap.update(row, self['equity'])
+        if self.journal is not None:
+            self.journal.record_open(ticker)
+        return row
+
+    def copy_row(self, other_store, other_row: int, row: int):
+        """
+        Copies every column value of a row in another PositionStore into a row of this store
+        """
+        for name, column in self.columns.items():
+            if name != 'equity':
+                column[row] = other_store.columns[name][other_row]
+        self.set_equity(row, other_store.columns['equity'][other_row])
+        if other_row in other_store.stale_valuation_rows:
+            self.stale_valuation_rows.add(row)
+
+    def get_rows(self, tickers: list) -> np.ndarray:
+        return np.array([self.rows[tick] for tick in tickers], dtype=np.intp)
+
+    def mark_dirty(self, rows):
+        if np.ndim(rows) == 0:
+            self.dirty_rows.add(int(rows))
+        else:
+            self.dirty_rows.update(np.asarray(rows).tolist())
+
+    def mark_stale_valuations(self, rows):
+        self.mark_dirty(rows)
+        if np.ndim(rows) == 0:
+            self.stale_valuation_rows.add(int(rows))
+        else:
+            self.stale_valuation_rows.update(np.asarray(rows).tolist())
+
+    def mark_rate_changes(self, rows):
+        # decay or discount rates changed, valuations are refreshed on the next Portfolio.refresh_expected_returns()
+        self.mark_stale_valuations(rows)
+        if self.journal is not None:
+            self.journal.record_rates(rows, self)
+
+    def pop_dirty_rows(self) -> np.ndarray:
+        rows = np.fromiter(self.dirty_rows, dtype=np.intp, count=len(self.dirty_rows))
+        self.dirty_rows = set()
+        return rows
+
+    def pop_stale_valuation_rows(self) -> np.ndarray:
+        rows = np.fromiter(self.stale_valuation_rows, dtype=np.intp, count=len(self.stale_valuation_rows))
+        self.stale_valuation_rows = set()
+        return rows
+
+    def update_prices(self, rows: np.ndarray, prices: np.ndarray):
+        shares = self.columns['shares']
+        self.columns['current_price'][rows] = prices
+        self.set_equity(rows, prices * shares[rows])
+        self.mark_dirty(rows)
+        if self.journal is not None:
+            self.journal.record_prices(rows, prices)
+
+    def set_valuations(self, rows, values):
+        self.columns['valuations'][rows] = values
+        self.mark_dirty(rows)
+
+    def set_equity(self, rows, values):
+        equity = self.columns['equity']
+        old_values = np.nan_to_num(equity[rows])
+        new_values = np.nan_to_num(values)
+        self.equity_sum += np.sum(new_values) - np.sum(old_values)
+        self.equity_sq_sum += np.sum(new_values ** 2) - np.sum(old_values ** 2)
+        equity[rows] = values
+        self.equity_heap.update(rows, self['equity'])
+
+        self._n_sum_updates += np.size(rows)
+        if self._n_sum_updates > 4 * max(self.size, 256):
+            self.resync_equity_sums()
+
+    def refresh_equity(self):
+        np.multiply(self['current_price'], self['shares'], out=self['equity'])
+        self.resync_equity_sums()
+        self.equity_heap.invalidate()
+
+    def resync_equity_sums(self):
+        equity = np.nan_to_num(self['equity'])
+        self.equity_sum = float(np.sum(equity))
+        self.equity_sq_sum = float(np.sum(equity ** 2))
+        self._n_sum_updates = 0
+
+    def get_top_rows(self, n: int) -> np.ndarray:
+        return self.equity_heap.top(n, self['equity'])
+
+    def get_allocation_stats(self):
+        """
+        The mean and standard deviation of allocations (equity / total equity) over every row, from the running sums
+        :return: (mean, std), both 0 if the total equity is not positive
+        """
+        total = self.equity_sum
+        if self.size == 0 or total <= 0:
+            return 0.0, 0.0
+        mean = 1 / self.size
+        variance = (self.equity_sq_sum / (total ** 2 * self.size)) - mean ** 2
+        if variance <= 1e-12 * mean ** 2:
+            return mean, 0.0
+        return mean, float(np.sqrt(variance))
+
+    # #### INTERNAL METHODS #####
+    def _grow(self, new_capacity: int):
+        for name, column in self.columns.items():
+            if name in self.wide_columns:
+                grown = np.full((new_capacity, self.wide_columns[name]), np.nan, dtype=np.float64)
+            else:
+                grown = np.full(new_capacity, self.column_defaults[name], dtype=np.float64)
+            grown[:self.capacity] = column
+            self.columns[name] = grown
+        self.capacity = new_capacity
+
+
+def _store_column(name: str, doc: str = None):
+    """
+    Builds a property that reads/writes a Position's row of a PositionStore column. NaN values are returned as None.
+    """
+    def getter(self):
+        value = self._store.columns[name][self._row]
+        if np.isnan(value):
+            return None
+        return float(value)
+
+    def setter(self, value):
+        self._store.columns[name][self._row] = np.nan if value is None else value
+
+    return property(getter, setter, doc=doc)
 
 
 class Position:
     """
     A class that contains, and tracks changes to, a given stock position.
+    The position's numeric state lives in one row of a PositionStore (shared with the rest of a Portfolio), and
+    this class is a thin view over that row.
     The following user facing class functions are defined:
     - Position.add_base_position(shares: float or int, average_price: float or int): initiates an a stock position
     - Position.make_a_buy(shares: float or int, average_price: float or int) adds a buy to the current position
+    - Position.make_a_sell(shares: float or int, price: float or int, method: str = 'fifo') sells shares from the
+    position's lots and returns the realized gain
+    - Position.ingest_trades(shares: np.ndarray, prices: np.ndarray, dates: np.ndarray = None) applies a trade history
     - Position.run_dcf_valuation(eps: float, three_year_eps_growth: float, pe_ratios_outcomes: list = None,
                           historic_pe_ratios: list = None): runs a DCF valuation and updates self.valuations
     """
-
-    def __init__(self, ticker: str = None, current_price: float = None):
+    shares = _store_column('shares', 'number of shares held')
+    invested = _store_column('invested', 'total $ invested')
+    current_price = _store_column('current_price')
+    expected_return = _store_column('expected_return')
+    decay_rate = _store_column('decay_rate')
+    discount_rate = _store_column('discount_rate')
+    volatility = _store_column('volatility', 'annualized volatility of daily log returns')
+    beta = _store_column('beta', 'beta to the benchmark the risk metrics were computed against')
+    max_drawdown = _store_column('max_drawdown', 'the largest fall from a peak price, as a fraction')
+    downside_deviation = _store_column('downside_deviation', 'annualized deviation of returns below the minimum')
+
+    def __init__(self, ticker: str = None, current_price: float = None, store: PositionStore = None):
+        """
+        :param ticker: the position's ticker string
+        :param current_price: (optional) the current share price
+        :param store: (optional) the PositionStore to keep state in. If None, the position gets its own one row store.
+        """
         if not ticker:
             self.ticker = None
-            print('WARNING: Empty position class initiated, please provide a ticker in the')
+            emit(WARNING, 'empty_position', 'WARNING: Empty position class initiated, please provide a ticker')
         else:
             # store ticker name
             self.ticker = str(ticker).capitalize()
 
-            # store number of shares and purchases
-            self.shares = 0
-            self.invested = 0
+        if store is None:
+            store = PositionStore(capacity=1)
+        self._store = store
+        self._row = store.add_row(ticker)
 
-            self.purchases = []  # a list of purchase amounts in shares (int or float)
-            self.purchase_prices = []  # a list of the same length as self.purchase that stores the price at each buy
-            self.average_price = None
+        self._lots = LotLedger()  # every buy as a tax lot, see Position.lots
+        self._lots_loader = None
 
-            # store price data
-            if not current_price:
-                self.current_price = current_price
-                self.equity = self.current_price * self.shares
-                self.profit_loss = self.invested - self.equity
-            else:
-                self.equity = None
-                self.profit_loss = None
+        # store price data
+        if current_price:
+            self._update_current_price(float(current_price))
+
+    @property
+    def average_price(self):
+        if self.shares == 0:
+            return None
+        return self.invested / self.shares
+
+    @property
+    def lots(self) -> LotLedger:
+        """
+        The position's buys and sells as a lot_ledger.LotLedger
+        """
+        if self._lots is None:
+            # positions restored from a snapshot build their ledger on first use
+            self._lots = self._lots_loader(self._row)
+            self._lots_loader = None
+        return self._lots
+
+    @property
+    def purchases(self) -> list:
+        """
+        A list of purchase amounts in shares, one per lot
+        """
+        return self.lots.lots['shares'].tolist()
 
-            # store attributes for DCF
-            self.discount_rate = 0.125  # default discount rate
-            self.valuations = None  # when calculated this stores [low, middle, high]
-            self.decay_rate = 0.05
+    @property
+    def purchase_prices(self) -> list:
+        """
+        A list of the same length as self.purchases that stores the price at each buy
+        """
+        return self.lots.lots['price'].tolist()
+
+    @property
+    def realized_gain(self) -> float:
+        return self.lots.realized_gain
+
+    @property
+    def unrealized_gain(self):
+        if self.current_price is None:
+            return None
+        return self.lots.get_unrealized_gain(self.current_price)
+
+    @property
+    def equity(self):
+        value = self._store.columns['equity'][self._row]
+        if np.isnan(value):
+            return None
+        return float(value)
+
+    @equity.setter
+    def equity(self, value):
+        self._store.set_equity(self._row, np.nan if value is None else value)
+
+    @property
+    def profit_loss(self):
+        if self.equity is None:
+            return None
+        return self.equity - self.invested
+
+    @property
+    def valuations(self):
+        """
+        When calculated this stores [low, middle, high], otherwise None
+        """
+        values = self._store.columns['valuations'][self._row]
+        if np.isnan(values).any():
+            return None
+        return values.tolist()
+
+    @valuations.setter
+    def valuations(self, values):
+        self._store.set_valuations(self._row, np.nan if values is None else values)
 
     # #### KEY USER METHODS #####
     # define a function to initiate a positions with a starting share balance
     def add_base_position(self, shares: float or int, average_price: float or int):
-        if shares == 0:
+        if self.shares == 0:
             self.shares = shares
             self.invested = shares * average_price
-            self.purchases = [shares]
-            self.purchase_prices = [average_price]
-            self._update_average_price()
+            if shares:
+                self.lots.add_lot(shares, average_price)
+                self._journal_lots(len(self.lots) - 1, len(self.lots.sales))
 
             if isinstance(self.current_price, float):
                 self._update_equity()
 
         else:
-            return print('ERROR: You are trying to initialize a position in {} that already exists!')
+            return emit(ERROR, 'position_exists', 'ERROR: You are trying to initialize a position in {ticker} that '
+                        'already exists!', ticker=self.ticker)
 
     # define a function to make buy trades
-    def make_a_buy(self, shares, average_price):
+    def make_a_buy(self, shares, average_price, date=None):
         self.shares += shares
         self.invested += (shares * average_price)
-        self.purchases.append(shares)
-        self.purchase_prices.append(average_price)
-        self._update_average_price()
+        self.lots.add_lot(shares, average_price, date)
+        self._store.mark_dirty(self._row)
+        self._journal_lots(len(self.lots) - 1, len(self.lots.sales))
 
         if isinstance(self.current_price, float):
             self._update_equity()
 
+    # define a function to make sell trades, lots are matched 'fifo', 'lifo' or 'specific' (from lot_ids)
+    def make_a_sell(self, shares, price, method: str = 'fifo', lot_ids: list = None, date=None):
+        if shares > self.shares:
+            return emit(ERROR, 'oversell', 'ERROR: You are trying to sell {shares} shares of {ticker}, but only '
+                        '{held} are held!', ticker=self.ticker, shares=shares, held=self.shares)
+
+        n_sales = len(self.lots.sales)
+        realized_gain = self.lots.sell(shares, price, method=method, lot_ids=lot_ids, date=date)
+        self._sync_lots()
+        self._journal_lots(len(self.lots), n_sales)
+        return realized_gain
+
+    # define a function to apply a history of trades (sells as negative shares) in one call
+    def ingest_trades(self, shares: np.ndarray, prices: np.ndarray, dates: np.ndarray = None, method: str = 'fifo'):
+        n_lots, n_sales = len(self.lots), len(self.lots.sales)
+        self.lots.ingest_trades(shares, prices, dates, method=method)
+        self._sync_lots()
+        self._journal_lots(n_lots, n_sales)
+
     # main internal DCF function, how the DCF results are used/interpreted is controlled by the portfolio object
     def run_dcf_valuation(self, eps: float, three_year_eps_growth: float, pe_ratios_outcomes: list = None,
-                          historic_pe_ratios: list = None):
-        if not historic_pe_ratios:
-            self.valuations = run_DCF_valuation(eps, three_year_eps_growth, self.decay_rate,
-                                                pe_ratios_outcomes=pe_ratios_outcomes)
-        else:
-            self.valuations = run_DCF_valuation(eps, three_year_eps_growth, self.decay_rate,
-                                                historic_pe_ratios=historic_pe_ratios)
+                          historic_pe_ratios: list = None, cache: ValuationCache = None):
+        pe_scenarios = get_pe_scenarios(pe_ratios_outcomes, historic_pe_ratios)
+        self._record_dcf_inputs(eps, three_year_eps_growth, pe_scenarios)
+
+        # reuse a cached valuation if these exact inputs were valued before
+        if cache is not None:
+            key = get_valuation_key(eps, three_year_eps_growth, self.decay_rate, self.discount_rate, pe_scenarios)
+            values = cache.get(key)
+            if values is not None:
+                self.valuations = values
+                return self.valuations
+
+        values = run_batch_DCF_valuation(eps, three_year_eps_growth, self.decay_rate, self.discount_rate, pe_scenarios)
+        self.valuations = values.tolist()
+        if cache is not None:
+            cache.put(key, self.valuations)
 
         return self.valuations
 
     # #### INTERNAL METHODS - using individually may cause issues #####
     def _update_decay_rate(self, new_decay_rate):
         self.decay_rate = new_decay_rate
+        self._store.mark_rate_changes(self._row)
 
     def _update_discount_rate(self, updated_discount_rate: float):
         self.discount_rate = updated_discount_rate
+        self._store.mark_rate_changes(self._row)
 
     def _update_current_price(self, new_price):
         self.current_price = new_price
+        self._store.mark_dirty(self._row)
+        if self._store.journal is not None:
+            self._store.journal.record_prices(self._row, new_price)
 
-        # if we own shares, update our equity and profit attributes
-        if self.shares > 0:
-            self._update_equity()
-
-    def _update_average_price(self):
-        self.average_price = self.invested / self.shares
+        # equity is price * shares (0 with no shares), matching PositionStore.update_prices()
+        self._update_equity()
 
     def _update_equity(self):
         self.equity = self.current_price * self.shares
-        self.profit_loss = self.invested - self.equity
+
+    def _journal_lots(self, first_lot: int, first_sale: int):
+        # lots from first_lot and sales from first_sale on are new, sales are logged against their matched lots
+        if self._store.journal is not None:
+            self._store.journal.record_lots(self._row, self.lots, first_lot, first_sale)
+
+    def _sync_lots(self):
+        # the lot ledger's running totals are the source of truth for shares held and their cost basis
+        self.shares = self.lots.open_shares
+        self.invested = self.lots.open_cost
+        self._store.mark_dirty(self._row)
+
+        if isinstance(self.current_price, float):
+            self._update_equity()
+
+    def _record_dcf_inputs(self, eps: float, three_year_eps_growth: float, pe_scenarios: list):
+        store = self._store
+        store.columns['eps'][self._row] = eps
+        store.columns['eps_growth'][self._row] = three_year_eps_growth
+        store.columns['pe_scenarios'][self._row] = pe_scenarios
+        store.stale_valuation_rows.discard(self._row)
+        if store.journal is not None:
+            store.journal.record_dcf_inputs(self._row, store)
+
+    @classmethod
+    def _from_store_row(cls, ticker, store: PositionStore, row: int, lots_loader=None):
+        """
+        Builds a view over an existing PositionStore row (i.e., one restored from a snapshot) without adding a row
+        :param lots_loader: (optional) a callable returning the row's LotLedger, called on first use of Position.lots
+        """
+        position = cls.__new__(cls)
+        position.ticker = str(ticker).capitalize() if ticker else None
+        position._store = store
+        position._row = row
+        position._lots = LotLedger() if lots_loader is None else None
+        position._lots_loader = lots_loader
+        return position
+
+    def _move_to_store(self, store: PositionStore):
+        """
+        Copies this position's row into another PositionStore (i.e., a Portfolio's) and re-points the view at it
+        """
+        row = store.add_row(self.ticker)
+        store.copy_row(self._store, self._row, row)
+        self._store = store
+        self._row = row
+
+        # log the position's history so far, a journaled store can then rebuild it
+        if store.journal is not None:
+            self._journal_lots(0, 0)
+            if self.current_price is not None:
+                store.journal.record_prices(row, self.current_price)
 
 
 class Portfolio:
@@ -109,49 +488,106 @@ class Portfolio:
         An instance of this Portfolio class is largely to store active positions, and update them all simultaneously.
         :param positions_dict: a dictionary with ticker names as keys storing [# of shares, average price]
         """
+        self.store = PositionStore()  # columnar state for every position, each Position is a view over one row
         self.positions = {}
         self.tickers = []
         self.conservativeness = 0.5  # default is 0.5, but can range from 0 (no conservativeness) to 1 (max)
         self.greed = 0.5  # default is 0.5, but can range from 0 to 1. A higher value more strongly weights stock returns.
         self.gamma = 0.2
+        # 'scenarios' weights [low, mid, high], 'monte_carlo' uses value quantiles, 'implied_growth' compares EPS growth
+        # estimates to the growth implied by the price (see Portfolio.run_reverse_dcf())
+        self.valuation_mode = 'scenarios'
+        self.correlation_gamma = 0.2  # weight of the correlation minimizer, only used once track_correlations() is called
+        self.evener_top_n = None  # number of largest positions evened, only used once add_position_evener() is called
 
         if isinstance(positions_dict, dict):
             for tick in list(positions_dict.keys()):
                 shares, price = positions_dict[tick]
-                self.positions[tick] = Position(ticker=tick)
+                self.positions[tick] = Position(ticker=tick, store=self.store)
                 self.positions[tick].add_base_position(shares, price)
                 self.tickers.append(tick)
-                print(f'Initialized a position in ticker {tick}, with {shares} shares at an average price of {price}')
+                if is_enabled(DEBUG):
+                    emit(DEBUG, 'position_opened', 'Initialized a position in ticker {ticker}, with {shares} shares at an '
+                         'average price of {price}', ticker=tick, shares=shares, price=price)
+            emit(INFO, 'positions_initialized', 'Initialized {count} positions: {tickers}', count=len(positions_dict),
+                 tickers=format_items(list(positions_dict.keys())))
 
-        # initialize dictionary to hold portfolio balance values
-        self.raw_valuations = {}  # stores raw DCF expected return values for each position
-        self.expected_returns = {}  # stores the expected return if the price returns to intrinsic value
-        self.greedy_returns = {}
+        # initialize dictionary to hold portfolio balance values, expected returns are held in self.store columns
         self.balance_scores = {}
         self.overbalance_scores = {}  # will be zero unless a balance eq is used
+        self.correlation_scores = {}
+        self.correlation = None  # a StreamingCorrelation over store rows, see Portfolio.track_correlations()
+        self.valuation_cache = ValuationCache()  # memoized DCF valuations, replace to bound size or persist to disk
+        self.optimal_shares = {}  # shares to buy from the last Portfolio.solve_optimal_allocations() call
+        self.solver_iterations = 0
+        self._previous_solution = None  # warm start for Portfolio.solve_optimal_allocations(), in store row order
+        self._derived_params = None  # (scenario weights, greed exponent) the store's derived columns were computed with
+
+    @property
+    def raw_valuations(self) -> dict:
+        """
+        Stores raw DCF values weighted by conservativeness for each position
+        """
+        return self._get_column_dict('raw_valuation')
+
+    @property
+    def expected_returns(self) -> dict:
+        """
+        Stores the expected return if the price returns to intrinsic value
+        """
+        return self._get_column_dict('expected_return')
+
+    @property
+    def greedy_returns(self) -> dict:
+        return self._get_column_dict('greedy_return')
+
+    @property
+    def implied_growths(self) -> dict:
+        return self._get_column_dict('implied_growth')
+
+    @property
+    def implied_pes(self) -> dict:
+        return self._get_column_dict('implied_pe')
 
     # #### METHODS TO GET INFORMATION FROM THE PORTOFLIO #####
     def get_tickers(self):
         return list(self.positions.keys())
 
     def get_current_equity(self):
-        balance = 0
-        tickers = self.get_tickers()
-        sub_tickers = []
-        for tick in tickers:
-            position = self.positions[tick]
-            if isinstance(position.equity, float or int):
-                balance += position.equity
-            else:
-                print(f'No current price provided for ticker {tick}, please call '
-                      f'Portfolio.update_current_prices({tick}: [# of shares, average price]) to provide values')
-        return balance
+        equity = self.store['equity']
+        priced = ~np.isnan(equity)
+        unpriced = np.flatnonzero(~priced)
+        if len(unpriced) > 0 and is_enabled(WARNING):
+            emit(WARNING, 'missing_price', 'No current price provided for {count} tickers ({tickers}), please call '
+                 'Portfolio.update_current_prices({{TICKER: price}}) to provide values', count=len(unpriced),
+                 tickers=format_items([self.store.tickers[row] for row in unpriced]))
+        return float(np.sum(equity[priced]))
+
+    def get_position_sizes(self, top_n: int = None, print_info: bool = False) -> dict:
+        """
+        :param top_n: (optional) only return the top_n largest positions by equity, largest first
+        :param print_info: default is False. If True, the position sizes are printed.
+        :return: a dictionary with tickers as keys storing dictionaries of 'Shares', 'Equity', 'Allocation' and
+        'Return_in_dollars' values
+        """
+        store = self.store
+        rows = store.get_top_rows(top_n) if top_n else np.arange(len(store))
+        equity = np.nan_to_num(store['equity'][rows])
+        allocations = equity / store.equity_sum if store.equity_sum > 0 else np.zeros(len(rows))
+        returns = equity - store['invested'][rows]
 
-    def get_position_sizes(self):
-        tickers = self.get_tickers()
         positions_info_dict = {}
-        for tick in tickers:
-            positions_info_dict[tick] = {}
+        for i, row in enumerate(rows.tolist()):
+            positions_info_dict[store.tickers[row]] = {
+                'Shares': float(store['shares'][row]),
+                'Equity': float(equity[i]),
+                'Allocation': float(allocations[i]),
+                'Return_in_dollars': float(returns[i]),
+            }
+
+        if print_info:
+            self._positions_info_printer(positions_info_dict)
+        return positions_info_dict
 
     def verify_valuations(self) -> dict:
         """
@@ -173,53 +609,126 @@ class Portfolio:
         Uses current prices to calculate what % of the portfolio value is associated with each position
         :return: a dictionary with tickers and their relative proportion
         """
-        return
+        # the store keeps a running total of equity
+        equity = np.nan_to_num(self.store['equity'])
+        if self.store.equity_sum > 0:
+            equity = equity / self.store.equity_sum
+        return dict(zip(self.store.tickers, equity.tolist()))
 
+    @timed('Portfolio.get_optimal_allocations')
     def get_optimal_allocations(self, current_prices_dict: dict = None, gamma: float = 0.05, greed: float = None,
-                                conservativeness: float = None):
+                                conservativeness: float = None, correlation_gamma: float = None):
         """
 
         :param current_prices_dict:
         :param gamma: controls the weighting of the rebalanced coefficient in optimization
         :param greed: (optional) allows a greed value (float 0 - 1) that differs from the Portfolios setting to be used
+        :param correlation_gamma: (optional) controls the weighting of the correlation minimizer, only used if
+        correlations are tracked (see Portfolio.track_correlations())
         :return:
         """
         # if current_prices_dict is provided, update prices
-        tickers = self.get_tickers()
         if isinstance(current_prices_dict, dict):
             self.update_current_prices(current_prices_dict)
 
         # use custom parameters is input
         if not gamma:
             gamma = self.gamma
-        if not greed:
-            greed = self.greed
-
-        if not conservativeness:
-            conservativeness = self.conservativeness
 
-        # update expected returns
-        self.calculate_expected_roic(new_conservativeness=conservativeness)
-
-        # add greed re-weighting
-        greed_exponent = get_greed_exponent(greed)
-        self.add_greed_weights(greed_exponent)
+        # update expected returns and greed re-weighting, only for positions that changed since the last call
+        greedy_returns = self.refresh_expected_returns(conservativeness, greed)
 
         # create portfolio_balancer weights
-        self.add_portolio_balancer(gamma)
+        balance_scores = self._get_balance_scores(gamma)
+        self.balance_scores = dict(zip(self.store.tickers, balance_scores.tolist()))
+        self.overbalance_scores = {}
+        if self.evener_top_n:
+            overbalance_scores = self._get_overbalance_scores(gamma)
+            self.overbalance_scores = self._get_nonzero_dict(overbalance_scores)
+            balance_scores = balance_scores + overbalance_scores
+        self.correlation_scores = {}
+        if self.correlation is not None:
+            correlation_scores = self._get_correlation_scores(correlation_gamma)
+            self.correlation_scores = dict(zip(self.store.tickers, correlation_scores.tolist()))
+            balance_scores = balance_scores + correlation_scores
 
         # calculate optimal allocation
-        balanced_values = []
-        for tick in tickers:
-            balanced_values.append(self.greedy_returns[tick] * (1 + self.balance_scores[tick]))
-
-        balance_sum = sum(balanced_values)
+        balanced_values = np.nan_to_num(greedy_returns) * np.maximum(1 + balance_scores, 0)
+        balance_sum = np.sum(balanced_values)
+        if balance_sum > 0:
+            balanced_values = balanced_values / balance_sum
+
+        return dict(zip(self.store.tickers, balanced_values.tolist()))
+
+    @timed('Portfolio.solve_optimal_allocations')
+    def solve_optimal_allocations(self, contribution: float, current_prices_dict: dict = None, gamma: float = None,
+                                  greed: float = None, conservativeness: float = None, correlation_gamma: float = None,
+                                  max_position_size: float = None, min_cash: float = 0, lot_sizes=None,
+                                  warm_start: bool = True, tol: float = 1e-9, max_iter: int = 1000) -> dict:
+        """
+        Constrained version of Portfolio.get_optimal_allocations(). Maximizes the greed weighted expected return of the
+        contribution minus gamma times the spread of post contribution position sizes (see functions.solve_allocation_qp),
+        with position caps, a cash minimum and whole share lots enforced.
+        :param contribution: the $ amount being allocated, every allocation is 0 if it is not positive
+        :param current_prices_dict: (optional) a dictionary of new current prices
+        :param gamma: (optional) the weight on the balance term, default is self.gamma
+        :param greed: (optional) allows a greed value (float 0 - 1) that differs from the Portfolios setting to be used
+        :param conservativeness: (optional) a conservativeness that differs from the Portfolios setting
+        :param correlation_gamma: (optional) the weight of the correlation minimizer, only used if correlations are tracked
+        :param max_position_size: (optional) the maximum fraction of the post contribution portfolio in one position
+        :param min_cash: default is 0. The minimum fraction of the contribution to keep as cash.
+        :param lot_sizes: (optional) an int or {ticker: int} dictionary of share lot sizes (i.e., 1 for whole shares)
+        :param warm_start: default is True. Starts the solver from the previous call's solution.
+        :param tol: default is 1e-9. The solver's convergence tolerance.
+        :param max_iter: default is 1000. The maximum number of solver iterations.
+        :return: a dictionary with tickers and the fraction of the contribution allocated to them. The number of shares
+        to buy is stored in self.optimal_shares.
+        """
+        if isinstance(current_prices_dict, dict):
+            self.update_current_prices(current_prices_dict)
+        if not gamma:
+            gamma = self.gamma
 
-        optimal_allocations = {}
-        for i, tick in enumerate(tickers):
-            optimal_allocations[tick] = balanced_values[i] / balance_sum
+        store = self.store
+        tickers = store.tickers
+        if contribution <= 0:
+            # there is nothing to allocate
+            self.optimal_shares = dict.fromkeys(tickers, 0.0)
+            return dict.fromkeys(tickers, 0.0)
+
+        # update expected returns and greed re-weighting, only for positions that changed since the last call
+        returns = np.nan_to_num(self.refresh_expected_returns(conservativeness, greed))
+        if self.correlation is not None:
+            returns *= np.maximum(1 + self._get_correlation_scores(correlation_gamma), 0)
+
+        prices = store['current_price']
+        equity = np.nan_to_num(store['equity'])
+
+        upper = np.ones(len(tickers))
+        if max_position_size:
+            upper = ((max_position_size * (np.sum(equity) + contribution)) - equity) / contribution
+            upper = np.clip(upper, 0, 1)
+
+        x0 = None
+        if warm_start and self._previous_solution is not None:
+            x0 = np.zeros(len(tickers))
+            x0[:len(self._previous_solution)] = self._previous_solution[:len(tickers)]
+
+        x, self.solver_iterations = solve_allocation_qp(returns, equity, contribution, gamma, upper=upper,
+                                                        budget=1 - min_cash, x0=x0, tol=tol, max_iter=max_iter)
+        self._previous_solution = x
+
+        if lot_sizes is None:
+            with np.errstate(invalid='ignore', divide='ignore'):
+                shares = np.nan_to_num((x * contribution) / prices)
+        else:
+            if isinstance(lot_sizes, dict):
+                lot_sizes = np.array([lot_sizes.get(tick, 1) for tick in tickers], dtype=np.float64)
+            shares = round_to_lots(x, contribution, prices, np.broadcast_to(lot_sizes, x.shape), upper=upper)
+            x = np.nan_to_num(shares * prices) / contribution
 
-        return optimal_allocations
+        self.optimal_shares = dict(zip(tickers, shares.tolist()))
+        return dict(zip(tickers, x.tolist()))
 
     # #### METHODS TO UPDATE PORTFOLIO VALUES OR POSITIONS #####
     def update_conservativeness(self, new_conservativeness: float):
@@ -228,33 +737,33 @@ class Portfolio:
             if 0 < new_conservativeness < 1:
                 old_conservativeness = float(self.conservativeness)
                 self.conservativeness = new_conservativeness
-                return print(
-                    f'SUCCESS: conservativeness updated from {old_conservativeness} to {self.conservativeness}')
+                return emit(INFO, 'conservativeness_updated', 'SUCCESS: conservativeness updated from {old} to {new}',
+                            old=old_conservativeness, new=self.conservativeness)
             else:
                 warning = True
         else:
             warning = True
 
         if warning:
-            return print('WARNING: new_conservativeness parameter must be a floating point number between 0 - 1. '
-                         'Could not update value')
+            return emit(WARNING, 'invalid_parameter', 'WARNING: new_conservativeness parameter must be a floating '
+                        'point number between 0 - 1. Could not update value')
 
     def update_greed(self, new_greed: float):
         warning = False
         if isinstance(new_greed, float):
             if 0 < new_greed < 1:
-                old_conservativeness = float(self.conservativeness)
-                self.conservativeness = new_greed
-                return print(
-                    f'SUCCESS: conservativeness updated from {old_conservativeness} to {self.conservativeness}')
+                old_greed = float(self.greed)
+                self.greed = new_greed
+                return emit(INFO, 'greed_updated', 'SUCCESS: greed updated from {old} to {new}', old=old_greed,
+                            new=self.greed)
             else:
                 warning = True
         else:
             warning = True
 
         if warning:
-            return print('WARNING: new_greed parameter must be a floating point number between 0 - 1. '
-                         'Could not update value')
+            return emit(WARNING, 'invalid_parameter', 'WARNING: new_greed parameter must be a floating point number '
+                        'between 0 - 1. Could not update value')
 
     def open_new_positions(self, new_positions_dict: dict):
         """
@@ -262,26 +771,55 @@ class Portfolio:
         :param new_positions_dict: a dictionary where {'TICKER': [# of shares, average price]} OR a Positions class
         """
         if isinstance(new_positions_dict, dict):
+            opened, existing = [], []
             for tick in list(new_positions_dict.keys()):
-                if tick not in self.tickers:
+                if tick not in self.positions:
                     shares, price = new_positions_dict[tick]
-                    self.positions[tick] = Position(ticker=tick)
+                    self.positions[tick] = Position(ticker=tick, store=self.store)
                     self.positions[tick].add_base_position(shares, price)
                     self.tickers.append(tick)
-                    print(
-                        f'Initialized a position in ticker {tick}, with {shares} shares at an average price of {price}')
+                    opened.append(tick)
+                    if is_enabled(DEBUG):
+                        emit(DEBUG, 'position_opened', 'Initialized a position in ticker {ticker}, with {shares} shares '
+                             'at an average price of {price}', ticker=tick, shares=shares, price=price)
                 else:
-                    print(f'Cant make new position in {tick} because on already exists '
-                          f'with {self.positions[tick].shares} shares')
+                    existing.append(tick)
+
+            if opened:
+                emit(INFO, 'positions_initialized', 'Initialized {count} positions: {tickers}', count=len(opened),
+                     tickers=format_items(opened))
+            if existing:
+                emit(WARNING, 'position_exists', 'Cant make new positions in {count} tickers because they already '
+                     'exist: {tickers}', count=len(existing), tickers=format_items(existing))
 
     def add_position_class_instance(self, new_position):
         if isinstance(new_position, Position):
             tick = new_position.ticker
+            new_position._move_to_store(self.store)
             self.positions[tick] = new_position
             self.tickers.append(tick)
         else:
-            return print('WARNING: Must provide initated Position object. To add positions with a dictionary use the '
-                         'Portfolio.open_new_positions(new_position_dicts)')
+            return emit(WARNING, 'invalid_position', 'WARNING: Must provide initated Position object. To add positions '
+                        'with a dictionary use the Portfolio.open_new_positions(new_position_dicts)')
+
+    def ingest_trade_history(self, csv_path: str, method: str = 'fifo'):
+        """
+        Applies a trade history CSV (Date, Ticker, Shares, Price and an optional Side column) to each position's lots,
+        opening positions for new tickers
+        :param csv_path: path to the CSV file, see lot_ledger.read_trade_history()
+        :param method: default is 'fifo'. The lot matching method for sells, 'fifo' or 'lifo'.
+        """
+        trades = read_trade_history(csv_path)
+        for tick, (dates, shares, prices) in trades.items():
+            if tick not in self.positions:
+                self.positions[tick] = Position(ticker=tick, store=self.store)
+                self.tickers.append(tick)
+            self.positions[tick].ingest_trades(shares, prices, dates, method=method)
+            if is_enabled(DEBUG):
+                emit(DEBUG, 'trades_applied', 'Applied {count} trades to ticker {ticker}, now holding {shares} shares',
+                     count=len(shares), ticker=tick, shares=self.positions[tick].shares)
+        emit(INFO, 'trade_history_ingested', 'Applied {count} trades to {n_tickers} tickers',
+             count=sum(len(shares) for _, shares, _ in trades.values()), n_tickers=len(trades))
 
     def update_current_prices(self, current_prices_dict: dict = None):
         """
@@ -289,39 +827,156 @@ class Portfolio:
         :param current_prices_dict: a dictionary with ticker strings as keys, and new
         :return:
         """
-        tickers = self.get_tickers()
         if isinstance(current_prices_dict, dict):
-            for tick in tickers:
-                position = self.positions[tick]
+            rows = self.store.rows
+            update_ticks = [tick for tick in current_prices_dict.keys() if tick in rows]
+            update_rows = self.store.get_rows(update_ticks)
+            prices = np.array([current_prices_dict[tick] for tick in update_ticks], dtype=np.float64)
+            self.store.update_prices(update_rows, prices)
+
+            if len(update_ticks) < len(rows) and is_enabled(WARNING):
+                missing = [tick for tick in self.get_tickers() if tick not in current_prices_dict]
+                emit(WARNING, 'missing_price', 'Could not update current price for {count} stocks: {tickers}',
+                     count=len(missing), tickers=format_items(missing))
+
+    def update_current_prices_array(self, prices: np.ndarray, rows: np.ndarray = None):
+        """
+        Updates current prices straight from an array, avoiding building a dictionary (i.e., inside a backtest loop)
+        :param prices: an array of new prices, NaN values are skipped and the previous price is kept
+        :param rows: (optional) the PositionStore rows the prices map to. If None, prices must cover every position in
+        the order of Portfolio.store.tickers
+        :return:
+        """
+        prices = np.asarray(prices, dtype=np.float64)
+        if rows is None:
+            rows = np.arange(len(self.store))
+        has_price = ~np.isnan(prices)
+        self.store.update_prices(rows[has_price], prices[has_price])
 
-                if tick in list(current_prices_dict.keys()):
-                    current_price = current_prices_dict[tick]
-                    position._update_current_price(current_price)
-                else:
-                    print(f'Could not update current price for stock {tick}')
+    def track_correlations(self, historic_prices: np.ndarray = None, tickers: list = None, halflife: float = 63):
+        """
+        Starts a streaming correlation estimator over the portfolio's positions, used by the correlation balancer
+        :param historic_prices: (optional) a (dates x tickers) price array to warm up the estimator with
+        :param tickers: the tickers matching the columns of historic_prices, default is Portfolio.store.tickers
+        :param halflife: default is 63. The halflife in bars of the exponential weights, None for equal weights.
+        :return:
+        """
+        self.correlation = StreamingCorrelation(len(self.store), halflife=halflife)
+        if historic_prices is not None:
+            rows = self.store.get_rows(tickers) if tickers else np.arange(len(self.store))
+            bar = np.full(len(self.store), np.nan)
+            for prices in np.asarray(historic_prices, dtype=np.float64):
+                bar[rows] = prices
+                self.correlation.update_prices(bar)
+
+    def update_correlations(self):
+        """
+        Adds the current prices of every position as a new bar to the correlation estimator (i.e., once per day)
+        """
+        if self.correlation is not None:
+            self.correlation.resize(len(self.store))
+            self.correlation.update_prices(self.store['current_price'])
 
-    def run_batch_dcf(self, dcf_dict, historic_data: bool = False):
+    @timed('Portfolio.run_monte_carlo_dcf')
+    def run_monte_carlo_dcf(self, n_paths: int = 50000, seed: int = None, processes: int = None, **sample_kwargs):
+        """
+        Runs a stochastic DCF for every position with recorded DCF inputs (see Portfolio.run_batch_dcf()), sampling
+        EPS growth, decay rate and terminal pe paths. The value quantiles are stored and Portfolio.valuation_mode is set
+        to 'monte_carlo', so expected returns use the value quantile matching 1 - conservativeness.
+        :param n_paths: default is 50,000. The number of paths sampled for each position.
+        :param seed: (optional) seed for reproducible results
+        :param processes: (optional) if > 1, positions are valued across a process pool of this size
+        :param sample_kwargs: keyword arguments for monte_carlo.sample_DCF_values() (i.e., growth_std, decay_std)
+        :return: a dictionary with tickers and their probability of loss at current prices
+        """
+        store = self.store
+        rows = np.flatnonzero(~np.isnan(store['eps']))
+        results = run_monte_carlo_DCF(store['eps'][rows], store['eps_growth'][rows], store['decay_rate'][rows],
+                                      store['discount_rate'][rows], store['pe_scenarios'][rows],
+                                      current_prices=store['current_price'][rows], n_paths=n_paths, seed=seed,
+                                      processes=processes, **sample_kwargs)
+        store['value_quantiles'][rows] = results['quantiles']
+        store['prob_loss'][rows] = results['prob_loss']
+        store.mark_dirty(rows)
+        self.valuation_mode = 'monte_carlo'
+
+        return {store.tickers[row]: float(prob_loss) for row, prob_loss in zip(rows, results['prob_loss'])}
+
+    def get_probability_of_loss(self) -> dict:
+        """
+        Uses the Monte Carlo value quantiles to estimate the probability each position's value is below its current price
+        :return: a dictionary with tickers and their probability of loss
+        """
+        store = self.store
+        value_quantiles = store['value_quantiles']
+        prices = store['current_price']
+        rows = np.flatnonzero(~np.isnan(value_quantiles).any(axis=1) & ~np.isnan(prices))
+        return {store.tickers[row]: float(np.interp(prices[row], value_quantiles[row], QUANTILE_LEVELS))
+                for row in rows}
+
+    @timed('Portfolio.run_batch_dcf')
+    def run_batch_dcf(self, dcf_dict, historic_data: bool = False, use_cache: bool = True):
         """
         Allows a DCF analyses to be ran for multiple positions by referencing their tickers
         :param dcf_dict: a dictionary where {'TICK': current EPS, three year EPS growth rate: float, pe_ratios: list]
         :param historic_data: default is false, if true or is >3 pe ratios are provided, the pe ratios are viewed as
         historic and low,mid,high scenarios are defined via standard deviations instead of explictly.
+        :param use_cache: default is True. Reuses valuations from self.valuation_cache for unchanged inputs.
         :return: updates each positions valuation attributes
         """
+        dcf_ticks = []
+        eps_list = []
+        growth_list = []
+        pe_scenarios_list = []
         for dcf_tick in list(dcf_dict.keys()):
-            if dcf_tick in self.get_tickers():
+            if dcf_tick in self.positions:
                 eps, eps_growth, pe_ratios = dcf_dict[dcf_tick]
-                position = self.positions[dcf_tick]
 
                 if isinstance(pe_ratios, list):
                     if not historic_data and len(pe_ratios) == 3:
-                        position.run_dcf_valuation(eps, eps_growth, pe_ratios)
-                    elif not historic_data and len(pe_ratios) != 3:
-                        print('Please provide exactly three pe ratios if historic_data=False: [low, middle, high] \n'
-                              'Intepreting as historic'
-                              )
-
-        return
+                        pe_scenarios = get_pe_scenarios(pe_ratios_outcomes=pe_ratios)
+                    else:
+                        if not historic_data:
+                            emit(WARNING, 'pe_scenarios', 'Please provide exactly three pe ratios if '
+                                 'historic_data=False: [low, middle, high] \nIntepreting as historic')
+                        pe_scenarios = get_pe_scenarios(historic_pe_ratios=pe_ratios)
+
+                    dcf_ticks.append(dcf_tick)
+                    eps_list.append(eps)
+                    growth_list.append(eps_growth)
+                    pe_scenarios_list.append(pe_scenarios)
+
+        if not dcf_ticks:
+            return
+        self._set_dcf_inputs(self.store.get_rows(dcf_ticks), eps_list, growth_list, pe_scenarios_list, use_cache)
+
+    @timed('Portfolio.run_fundamentals_dcf')
+    def run_fundamentals_dcf(self, fundamentals: FundamentalsStore, date=None, window: int = None,
+                             use_cache: bool = True) -> list:
+        """
+        Runs a DCF for every position with EPS, EPS growth and pe history in a FundamentalsStore, using the values known
+        as of a date (i.e., each contribution date of a backtest). Pe scenarios are the mean +/- one standard deviation
+        of the historic pe ratios, as in run_batch_dcf(historic_data=True).
+        :param fundamentals: a FundamentalsStore
+        :param date: (optional) the as of date, default is the latest stored values
+        :param window: (optional) the number of most recent pe ratios to use, default is all pe ratios before date
+        :param use_cache: default is True. Reuses valuations from self.valuation_cache for unchanged inputs.
+        :return: a list of the tickers that were valued
+        """
+        store = self.store
+        tickers = [tick for tick in store.tickers if tick in fundamentals]
+        eps, eps_growth, pe_scenarios = fundamentals.get_dcf_inputs(tickers, date, window)
+        valid = ~np.isnan(eps) & ~np.isnan(eps_growth) & ~np.isnan(pe_scenarios).any(axis=1)
+        if not valid.all() and is_enabled(WARNING):
+            missing = [tick for tick, has_inputs in zip(tickers, valid) if not has_inputs]
+            emit(WARNING, 'missing_fundamentals', 'No EPS, EPS growth or pe history as of {date} for {count} '
+                 'tickers: {tickers}', count=len(missing), date='the latest date' if date is None else date,
+                 tickers=format_items(missing))
+
+        valued = [tick for tick, has_inputs in zip(tickers, valid) if has_inputs]
+        if valued:
+            self._set_dcf_inputs(store.get_rows(valued), eps[valid], eps_growth[valid], pe_scenarios[valid], use_cache)
+        return valued
 
     def change_decay_rates(self, new_rate, sub_tickers: list = None):
         """
@@ -336,12 +991,51 @@ class Portfolio:
         else:
             tickers = sub_tickers
 
-        # update rates for tickers
-        for tick in tickers:
-            position = self.positions[tick]
-            position._update_decay_rate(new_rate)
+        # update rates for tickers, their valuations are refreshed on the next Portfolio.refresh_expected_returns()
+        rows = self.store.get_rows(tickers)
+        self.store['decay_rate'][rows] = new_rate
+        self.store.mark_rate_changes(rows)
+
+    def set_risk_metrics(self, metrics: dict, tickers: list = None):
+        """
+        Stores risk metrics for the portfolio's positions, readable as Position.volatility, Position.beta, etc.
+        :param metrics: a dictionary of RISK_METRICS arrays, i.e., from risk.run_risk_pipeline() or
+        risk.compute_risk_metrics()
+        :param tickers: the tickers matching the metric arrays, default is metrics['tickers']
+        """
+        if tickers is None:
+            tickers = metrics['tickers']
+        index = np.array([i for i, tick in enumerate(tickers) if tick in self.positions], dtype=np.intp)
+        rows = self.store.get_rows([tickers[i] for i in index])
+        for name in RISK_METRICS:
+            if name in metrics:
+                self.store[name][rows] = np.asarray(metrics[name], dtype=np.float64)[index]
+
+    def get_risk_metrics(self) -> dict:
+        """
+        :return: a dictionary of {ticker: {metric: value}} for positions with risk metrics
+        """
+        store = self.store
+        rows = np.flatnonzero(~np.isnan(store['volatility']))
+        return {store.tickers[row]: {name: float(store[name][row]) for name in RISK_METRICS} for row in rows}
+
+    def apply_risk_discount_rates(self, base_rate: float = 0.125, risk_premium: float = 0.05, min_rate: float = 0.06):
+        """
+        Sets each position's DCF discount rate from its beta, base_rate + risk_premium * (beta - 1), so valuations
+        of riskier positions are discounted more. Positions without a beta keep their discount rate.
+        :param base_rate: default is 0.125. The discount rate of a position with a beta of 1.
+        :param risk_premium: default is 0.05. The added rate per unit of beta above 1.
+        :param min_rate: default is 0.06. The lowest discount rate applied.
+        """
+        store = self.store
+        rows = np.flatnonzero(~np.isnan(store['beta']))
+        store['discount_rate'][rows] = np.maximum(base_rate + (risk_premium * (store['beta'][rows] - 1)), min_rate)
+
+        # valuations are refreshed on the next Portfolio.refresh_expected_returns()
+        store.mark_rate_changes(rows)
 
     # #### METHODS TO RETURN STATE BASED (i.e., current price based) values #####
+    @timed('Portfolio.calculate_expected_roic')
     def calculate_expected_roic(self, current_prices_dict: dict = None, new_conservativeness: float = None):
         """
 
@@ -349,8 +1043,6 @@ class Portfolio:
         :param new_conservativeness:
         :return:
         """
-        tickers = self.get_tickers()
-
         # update conservativeness if input (optional)
         if isinstance(new_conservativeness, float):
             self.update_conservativeness(new_conservativeness)
@@ -362,30 +1054,88 @@ class Portfolio:
         # get scenario weighting based on conservativeness
         scenario_weights = self._get_scenario_weightings()
 
-        # calculate expected returns
-        valuations = {}
-        relative_values = {}
-        for tick in tickers:
-            position = self.positions[tick]
-            if isinstance(position.current_price, float):
-                valuations = position.valuations
-                if not valuations:
-                    print(f'WARNING: No DCF valuation completed for ticker {tick}, run a DCF for the position within '
-                          f'the portfolio (ex: Portfolio[TICKER].run_dcf_valuation() or for the whole portfolio'
-                          f'(ex: Portfolio.run_batch_dcf_valuations()')
-                else:
-                    # get valuations and weight based off conservativeness
-                    final_value = sum([value * weight for value, weight in zip(valuations, scenario_weights)])
-                    relative_value = (final_value - position.current_price) / position.current_price
+        # calculate expected returns for every position at once
+        store = self.store
+        prices = store['current_price']
+        valuations = store['valuations']
+        priced = ~np.isnan(prices)
+        valued = ~np.isnan(valuations).any(axis=1)
+
+        if is_enabled(WARNING):
+            unvalued = np.flatnonzero(priced & ~valued)
+            if len(unvalued) > 0:
+                emit(WARNING, 'missing_valuation', 'WARNING: No DCF valuation completed for {count} tickers ({tickers}), '
+                     'run a DCF for the position within the portfolio (ex: Portfolio[TICKER].run_dcf_valuation() or '
+                     'for the whole portfolio (ex: Portfolio.run_batch_dcf())', count=len(unvalued),
+                     tickers=format_items([store.tickers[row] for row in unvalued]))
+            unpriced = np.flatnonzero(~priced)
+            if len(unpriced) > 0:
+                emit(WARNING, 'missing_price', 'No current price data for {count} tickers: {tickers}',
+                     count=len(unpriced), tickers=format_items([store.tickers[row] for row in unpriced]))
+
+        # get valuations and weight based off conservativeness
+        self._update_expected_returns(np.arange(len(store)), scenario_weights)
+
+    @timed('Portfolio.run_reverse_dcf')
+    def run_reverse_dcf(self, current_prices_dict: dict = None, solve_pe: bool = False) -> dict:
+        """
+        Solves the three year EPS growth rate each position's current price implies (the growth at which the DCF,
+        weighted by conservativeness, equals the price), for every position at once. Set Portfolio.valuation_mode to
+        'implied_growth' to base expected returns on the gap between recorded EPS growth estimates and these rates.
+        :param current_prices_dict: (optional) a dictionary of {ticker: current price} to update first
+        :param solve_pe: default is False. If True, also solves the terminal pe ratio the price implies at each position's
+        recorded EPS growth estimate (see Portfolio.implied_pes).
+        :return: a dictionary of {ticker: implied three year EPS growth (YoY%)}
+        """
+        if isinstance(current_prices_dict, dict):
+            self.update_current_prices(current_prices_dict)
 
-                    # add to dictionaries to store for each ticker
-                    valuations[tick] = final_value
-                    relative_values[tick] = relative_value
+        store = self.store
+        self._update_implied_values(np.arange(len(store)), self._get_scenario_weightings(), solve_pe)
+        if is_enabled(WARNING):
+            has_inputs = ~np.isnan(store['current_price']) & ~np.isnan(store['eps'])
+            unsolved = np.flatnonzero(has_inputs & np.isnan(store['implied_growth']))
+            if len(unsolved) > 0:
+                emit(WARNING, 'implied_growth_unsolved', 'No implied EPS growth within (-99%, 500%) for {count} '
+                     'tickers: {tickers}', count=len(unsolved),
+                     tickers=format_items([store.tickers[row] for row in unsolved]))
+        return self.implied_growths
+
+    @timed('Portfolio.refresh_expected_returns')
+    def refresh_expected_returns(self, conservativeness: float = None, greed: float = None) -> np.ndarray:
+        """
+        Incrementally updates expected and greedy returns. Only positions flagged as changed since the last call (new
+        prices, buys, valuations or decay/discount rates) are recomputed, unless conservativeness or greed changed.
+        Positions with stale valuations and recorded DCF inputs are re-valued first.
+        :param conservativeness: (optional) a conservativeness that differs from the Portfolios setting
+        :param greed: (optional) allows a greed value (float 0 - 1) that differs from the Portfolios setting to be used
+        :return: the greedy returns column of self.store, in store row order (NaN where unavailable)
+        """
+        if conservativeness and conservativeness != self.conservativeness:
+            self.update_conservativeness(conservativeness)
+        if not greed:
+            greed = self.greed
 
-            elif not position:
-                print(f'No current price data for ticker {tick}')
-        self.raw_valuations = valuations
-        self.expected_returns = relative_values
+        store = self.store
+        stale_rows = store.pop_stale_valuation_rows()
+        stale_rows = stale_rows[~np.isnan(store['eps'][stale_rows])]
+        if len(stale_rows) > 0:
+            self._value_rows(stale_rows)
+
+        scenario_weights = self._get_scenario_weightings()
+        greed_exponent = get_greed_exponent(greed)
+        derived_params = (tuple(scenario_weights), greed_exponent, self.valuation_mode)
+        if derived_params != self._derived_params:
+            store.dirty_rows = set()
+            rows = np.arange(len(store))
+            self._derived_params = derived_params
+        else:
+            rows = store.pop_dirty_rows()
+
+        if len(rows) > 0:
+            self._update_expected_returns(rows, scenario_weights)
+            self._update_greedy_returns(rows, greed_exponent)
+        return store['greedy_return']
 
     def add_greed_weights(self, greed_exponent: float):
         """
@@ -393,41 +1143,200 @@ class Portfolio:
         :param greed_exponent: the greed exponent fom get_greed_exponent(self.greed)
         :return:
         """
-        expected_returns = self.expected_returns
-        for tick in expected_returns.keys():
-            greed_return = (float(expected_returns[tick]) ** greed_exponent)
-            self.greedy_returns[tick] = greed_return
+        self._update_greedy_returns(np.arange(len(self.store)), greed_exponent)
         return self.greedy_returns
 
+    @timed('Portfolio.add_portolio_balancer')
     def add_portolio_balancer(self, gamma: float = None, eta: float = 0.95):
         if not gamma:
             gamma = self.gamma
 
-        self.balance_scores = {}
-        allocations = self.calculate_current_allocations()
-        allocations_array = np.array(list(allocations.values()))
-        allocations_mean = np.mean(allocations_array)
-        allocations_std = np.std(allocations_array)
-
-        for tick in allocations.keys():
-            allocation = allocations[tick]
-            z_score = (allocation - allocations_mean) / allocations_std
-            balance_score = -z_score*gamma
-            if abs(balance_score) > eta:
-                if balance_score < 0:
-                    balance_score = -eta
-                else:
-                    balance_score = eta
-            self.balance_scores[tick] = balance_score
+        balance_scores = self._get_balance_scores(gamma, eta)
+        self.balance_scores = dict(zip(self.store.tickers, balance_scores.tolist()))
         return self.balance_scores
 
+    def add_position_evener(self, top_n: int = 3, gamma: float = None, eta: float = 0.95):
+        """
+        Penalizes the largest positions when they grow apart. The top_n largest positions by equity are kept in an
+        indexed heap, and each one with an above average allocation among them is scored by -gamma * its z-score within
+        the top_n (see README balance_eq). Portfolio.get_optimal_allocations() applies it from then on.
+        :param top_n: default is 3. The number of largest positions to even.
+        :param gamma: (optional) the weight of the position-evener, default is self.gamma
+        :param eta: default is 0.95. The maximum absolute score.
+        :return: a dictionary of the non-zero position-evener scores
+        """
+        self.evener_top_n = top_n
+        self.overbalance_scores = self._get_nonzero_dict(self._get_overbalance_scores(gamma, eta))
+        return self.overbalance_scores
+
+    def add_correlation_balancer(self, correlation_gamma: float = None, eta: float = 0.95):
+        """
+        Penalizes positions that are correlated with the rest of the portfolio. For each ticker the correlation with
+        every other position is averaged using current allocations as weights, and scaled by -correlation_gamma.
+        :param correlation_gamma: (optional) the weight of the correlation minimizer, default is self.correlation_gamma
+        :param eta: default is 0.95. The maximum absolute correlation score.
+        :return: a dictionary with tickers and their correlation scores
+        """
+        self.correlation_scores = {}
+        if self.correlation is None:
+            return self.correlation_scores
+
+        correlation_scores = self._get_correlation_scores(correlation_gamma, eta)
+        self.correlation_scores = dict(zip(self.store.tickers, correlation_scores.tolist()))
+        return self.correlation_scores
+
     # #### INTERNAL METHODS - using may cause issues#####
     def _get_scenario_weightings(self):
-        low = 0
-        mid = 0
-        high = 0
+        # conservativeness shifts weight from the high scenario to the low one, 0.5 -> [0.25, 0.5, 0.25]
+        low = self.conservativeness / 2
+        mid = 0.5
+        high = (1 - self.conservativeness) / 2
         return [low, mid, high]
 
+    def _get_column_dict(self, column: str) -> dict:
+        values = self.store[column]
+        return {self.store.tickers[row]: float(values[row]) for row in np.flatnonzero(~np.isnan(values))}
+
+    def _update_expected_returns(self, rows: np.ndarray, scenario_weights: list):
+        store = self.store
+        prices = store['current_price'][rows]
+        raw_valuations = store['valuations'][rows] @ np.array(scenario_weights, dtype=np.float64)
+
+        if self.valuation_mode == 'monte_carlo':
+            # use the value quantile at 1 - conservativeness, i.e., the median at the default of 0.5
+            value_quantiles = store['value_quantiles'][rows]
+            position = (1 - self.conservativeness) * (len(QUANTILE_LEVELS) - 1)
+            lower = int(np.floor(position))
+            upper = min(lower + 1, len(QUANTILE_LEVELS) - 1)
+            fraction = position - lower
+            quantile_values = (value_quantiles[:, lower] * (1 - fraction)) + (value_quantiles[:, upper] * fraction)
+            sampled = ~np.isnan(quantile_values)
+            raw_valuations[sampled] = quantile_values[sampled]
+        store['raw_valuation'][rows] = raw_valuations
+
+        if self.valuation_mode == 'implied_growth':
+            # the yearly EPS growth expected beyond the growth the current price already implies
+            self._update_implied_values(rows, scenario_weights)
+            store['expected_return'][rows] = ((1 + (store['eps_growth'][rows] / 100)) /
+                                              (1 + (store['implied_growth'][rows] / 100))) - 1
+        else:
+            store['expected_return'][rows] = (raw_valuations - prices) / prices
+
+    def _update_implied_values(self, rows: np.ndarray, scenario_weights: list, solve_pe: bool = False):
+        # value is linear in the terminal pe, so solving against the weighted pe matches the weighted valuation
+        store = self.store
+        prices = store['current_price'][rows]
+        eps = store['eps'][rows]
+        decay_rates = store['decay_rate'][rows]
+        discount_rates = store['discount_rate'][rows]
+        terminal_pes = store['pe_scenarios'][rows] @ np.array(scenario_weights, dtype=np.float64)
+        store['implied_growth'][rows], _ = solve_implied_growth(prices, eps, decay_rates, discount_rates, terminal_pes)
+        if solve_pe:
+            store['implied_pe'][rows] = get_implied_terminal_pe(prices, eps, store['eps_growth'][rows], decay_rates,
+                                                                discount_rates)
+
+    def _update_greedy_returns(self, rows: np.ndarray, greed_exponent: float):
+        # only positive expected returns attract new capital
+        expected_returns = self.store['expected_return'][rows]
+        self.store['greedy_return'][rows] = np.maximum(expected_returns, 0) ** greed_exponent
+
+    def _get_balance_scores(self, gamma: float = None, eta: float = 0.95) -> np.ndarray:
+        """
+        -gamma * z-score of each position's allocation clipped to +/- eta, the allocation mean and standard deviation
+        come from the store's running equity sums
+        """
+        if not gamma:
+            gamma = self.gamma
+
+        store = self.store
+        allocations_mean, allocations_std = store.get_allocation_stats()
+        if allocations_std == 0:
+            return np.zeros(len(store))
+
+        allocations = np.nan_to_num(store['equity']) / store.equity_sum
+        z_scores = (allocations - allocations_mean) / allocations_std
+        return np.clip(-z_scores * gamma, -eta, eta)
+
+    def _get_overbalance_scores(self, gamma: float = None, eta: float = 0.95) -> np.ndarray:
+        """
+        -gamma * z-score of each of the evener_top_n largest allocations among themselves, only above average ones are
+        penalized and every other position scores 0
+        """
+        if not gamma:
+            gamma = self.gamma
+
+        store = self.store
+        scores = np.zeros(len(store))
+        if not self.evener_top_n or store.equity_sum <= 0:
+            return scores
+
+        top_rows = store.get_top_rows(self.evener_top_n)
+        top_allocations = np.nan_to_num(store['equity'][top_rows]) / store.equity_sum
+        spread = np.std(top_allocations)
+        if spread == 0:
+            return scores
+
+        z_scores = (top_allocations - np.mean(top_allocations)) / spread
+        scores[top_rows] = np.clip(-z_scores * gamma, -eta, 0)
+        return scores
+
+    def _get_nonzero_dict(self, values: np.ndarray) -> dict:
+        return {self.store.tickers[row]: float(values[row]) for row in np.flatnonzero(values)}
+
+    def _get_correlation_scores(self, correlation_gamma: float = None, eta: float = 0.95) -> np.ndarray:
+        if not correlation_gamma:
+            correlation_gamma = self.correlation_gamma
+
+        self.correlation.resize(len(self.store))
+        weights = np.nan_to_num(self.store['equity'])
+        weighted_correlations = get_weighted_correlations(self.correlation.get_correlation(), weights)
+        return np.clip(-weighted_correlations * correlation_gamma, -eta, eta)
+
+    def _set_dcf_inputs(self, rows: np.ndarray, eps, eps_growth, pe_scenarios, use_cache: bool = True):
+        # record the DCF inputs so positions can be re-valued when their decay or discount rates change
+        store = self.store
+        store['eps'][rows] = eps
+        store['eps_growth'][rows] = eps_growth
+        store['pe_scenarios'][rows] = pe_scenarios
+        store.stale_valuation_rows.difference_update(rows.tolist())
+        if store.journal is not None:
+            store.journal.record_dcf_inputs(rows, store)
+
+        self._value_rows(rows, use_cache=use_cache)
+
+    def _value_rows(self, rows: np.ndarray, use_cache: bool = True):
+        """
+        Runs the DCF for store rows from their recorded inputs (eps, eps_growth, pe_scenarios), reusing cached
+        valuations where possible and valuing the rest in one vectorized pass
+        """
+        store = self.store
+        eps = store['eps'][rows]
+        eps_growth = store['eps_growth'][rows]
+        pe_scenarios = store['pe_scenarios'][rows]
+        decay_rates = store['decay_rate'][rows]
+        discount_rates = store['discount_rate'][rows]
+
+        # look up cached valuations, only positions with new inputs are valued
+        to_value = np.arange(len(rows))
+        if use_cache:
+            keys = [get_valuation_key(*inputs) for inputs in
+                    zip(eps, eps_growth, decay_rates, discount_rates, pe_scenarios)]
+            cached = [self.valuation_cache.get(key) for key in keys]
+            to_value = np.array([i for i, values in enumerate(cached) if values is None], dtype=np.intp)
+            hits = [i for i, values in enumerate(cached) if values is not None]
+            if hits:
+                store.set_valuations(rows[hits], [cached[i] for i in hits])
+
+        if len(to_value) == 0:
+            return
+
+        values = run_batch_DCF_valuation(eps[to_value], eps_growth[to_value], decay_rates[to_value],
+                                         discount_rates[to_value], pe_scenarios[to_value])
+        store.set_valuations(rows[to_value], values)
+        if use_cache:
+            for i, position_values in zip(to_value, values.tolist()):
+                self.valuation_cache.put(keys[i], position_values)
+
     def _positions_info_printer(self, positions_info_dict: dict):
         for key in positions_info_dict.keys():
             position_dict = positions_info_dict[key]
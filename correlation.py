@@ -0,0 +1,148 @@
+import numpy as np
+
+
+class StreamingCorrelation:
+    """
+    Incrementally updated covariance/correlation matrix of daily log returns. Each new bar updates the N x N running
+    statistics in O(N^2) without revisiting the history.
+    Updates are exponentially weighted when a halflife is given, otherwise Welford-style equal weighted (expanding).
+    The following user facing class functions are defined:
+    - StreamingCorrelation.update_prices(prices: np.ndarray): adds a bar of prices (NaN = no data that day)
+    - StreamingCorrelation.update(returns: np.ndarray): adds a bar of returns directly
+    - StreamingCorrelation.fit(prices: np.ndarray): adds every row of a (dates x tickers) price array
+    - StreamingCorrelation.get_correlation() -> np.ndarray: the current N x N correlation matrix
+    """
+
+    def __init__(self, n_tickers: int = 0, halflife: float = 63):
+        """
+        :param n_tickers: the number of tickers (matrix rows) to track, can be increased later with resize()
+        :param halflife: default is 63 (~3 months of trading days). The halflife in bars of the exponential weights.
+        If None, every bar is weighted equally.
+        """
+        self.halflife = halflife
+        if halflife:
+            self.alpha = 1 - 0.5 ** (1 / halflife)
+        else:
+            self.alpha = None
+
+        self.n_updates = 0
+        self.mean = np.zeros(0)
+        self.cov = np.zeros((0, 0))  # for equal weights this holds the running sum of co-deviations
+        self.last_prices = np.zeros(0)
+        # for equal weights, each ticker's number of returns and each pair's number of bars with returns for both
+        self.counts = np.zeros(0, dtype=np.int64)
+        self.pair_counts = np.zeros((0, 0), dtype=np.int64)
+        self.resize(n_tickers)
+
+    def __len__(self):
+        return len(self.mean)
+
+    def resize(self, n_tickers: int):
+        """
+        Adds rows for newly tracked tickers, they start with no history (zero covariance)
+        """
+        n_old = len(self.mean)
+        if n_tickers <= n_old:
+            return
+
+        mean = np.zeros(n_tickers)
+        mean[:n_old] = self.mean
+        cov = np.zeros((n_tickers, n_tickers))
+        cov[:n_old, :n_old] = self.cov
+        last_prices = np.full(n_tickers, np.nan)
+        last_prices[:n_old] = self.last_prices
+        counts = np.zeros(n_tickers, dtype=np.int64)
+        counts[:n_old] = self.counts
+        pair_counts = np.zeros((n_tickers, n_tickers), dtype=np.int64)
+        pair_counts[:n_old, :n_old] = self.pair_counts
+
+        self.mean = mean
+        self.cov = cov
+        self.last_prices = last_prices
+        self.counts = counts
+        self.pair_counts = pair_counts
+
+    def update_prices(self, prices: np.ndarray):
+        """
+        Converts a bar of prices to log returns against the previous bar and updates the running statistics
+        :param prices: an array of prices in tracked ticker order, NaN if a ticker has no price this bar
+        """
+        prices = np.asarray(prices, dtype=np.float64)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            returns = np.log(prices / self.last_prices)
+
+        has_price = ~np.isnan(prices)
+        self.last_prices[has_price] = prices[has_price]
+        if np.isnan(returns).all():
+            return
+        self.update(returns)
+
+    def update(self, returns: np.ndarray):
+        """
+        Updates the running mean and covariance with one bar of returns. NaN returns are treated as equal to the
+        running mean, so they do not move the statistics of that ticker. With equal weights, each ticker's mean is
+        over its own returns and each covariance is normalized by the number of bars both tickers have returns for.
+        """
+        returns = np.asarray(returns, dtype=np.float64)
+        self.n_updates += 1
+
+        deviation = returns - self.mean
+        observed = ~np.isnan(deviation)
+        deviation[~observed] = 0
+
+        if self.alpha:
+            self.mean += self.alpha * deviation
+            self.cov += self.alpha * np.outer(deviation, deviation)
+            self.cov *= (1 - self.alpha)
+        else:
+            self.counts += observed
+            self.mean[observed] += deviation[observed] / self.counts[observed]
+            # Welford's (n - 1) / n co-deviation update with n the pair's shared bars, which keeps cov symmetric
+            shared = np.outer(observed, observed)
+            self.pair_counts += shared
+            scale = np.zeros_like(self.cov)
+            np.divide(self.pair_counts - 1, self.pair_counts, out=scale, where=shared)
+            self.cov += np.outer(deviation, deviation) * scale
+
+    def fit(self, prices: np.ndarray):
+        for bar in np.asarray(prices, dtype=np.float64):
+            self.update_prices(bar)
+
+    def get_covariance(self) -> np.ndarray:
+        if self.alpha:
+            return self.cov.copy()
+        # pairs with fewer than 2 shared bars have no covariance
+        cov = np.zeros_like(self.cov)
+        np.divide(self.cov, self.pair_counts - 1, out=cov, where=self.pair_counts > 1)
+        return cov
+
+    def get_correlation(self) -> np.ndarray:
+        """
+        :return: the N x N correlation matrix, tickers without enough history have zero correlation to others
+        """
+        cov = self.get_covariance()
+        std = np.sqrt(np.diag(cov))
+        with np.errstate(invalid='ignore', divide='ignore'):
+            corr = cov / np.outer(std, std)
+        corr[np.isnan(corr)] = 0
+        np.fill_diagonal(corr, 1)
+        return np.clip(corr, -1, 1)
+
+
+def get_weighted_correlations(correlation: np.ndarray, weights: np.ndarray) -> np.ndarray:
+    """
+    For each ticker, the average correlation with every other position weighted by the other positions' sizes
+    :param correlation: an N x N correlation matrix
+    :param weights: an array of N position weights (i.e., current allocations)
+    :return: an array of N weighted average correlations ranging -1 to 1
+    """
+    weights = np.nan_to_num(np.asarray(weights, dtype=np.float64))
+    if np.sum(weights) <= 0:
+        weights = np.ones(len(weights))
+
+    other_weights = np.sum(weights) - weights
+    weighted_sums = correlation @ weights - (np.diag(correlation) * weights)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        weighted_correlations = weighted_sums / other_weights
+    weighted_correlations[other_weights <= 0] = 0
+    return weighted_correlations
@@ -0,0 +1,153 @@
+import contextlib
+import time
+
+from instrumentation import get_stage_stats
+
+DEBUG, INFO, WARNING, ERROR, OFF = 10, 20, 30, 40, 100
+LEVEL_NAMES = {DEBUG: 'debug', INFO: 'info', WARNING: 'warning', ERROR: 'error'}
+
+
+def print_handler(record: dict):
+    print(record['message'])
+
+
+# messages below _level are dropped before they are formatted or counted, OFF disables the channel
+_level = INFO
+_handler = print_handler  # called with each record dictionary, None counts events without formatting them
+_max_messages = 100  # per event per rate limit interval, None for no limit
+_interval = 1.0
+_counters = {}  # (event, level) -> number of items reported
+_windows = {}  # event -> [window start, messages written, messages suppressed]
+
+
+def set_level(level: int):
+    global _level
+    _level = level
+
+
+def get_level() -> int:
+    return _level
+
+
+def is_enabled(level: int) -> bool:
+    return level >= _level
+
+
+def set_handler(handler):
+    """
+    :param handler: a callable that receives each record as a dictionary with 'time', 'level', 'event', 'message',
+    'count' and the event's fields, i.e., to forward records to logging or write them as JSON. None keeps only counters.
+    """
+    global _handler
+    _handler = handler
+
+
+def set_rate_limit(max_messages: int = 100, interval: float = 1.0):
+    """
+    Limits each event to max_messages handled messages per interval seconds, the rest are counted as suppressed and
+    reported with the next handled message of that event
+    """
+    global _max_messages, _interval
+    _max_messages = max_messages
+    _interval = interval
+
+
+@contextlib.contextmanager
+def quiet(level: int = None):
+    """
+    Stops messages from being formatted or written within the block, events are still counted. If a level is given,
+    events below it are also not counted.
+    """
+    global _handler, _level
+    handler, old_level = _handler, _level
+    _handler = None
+    if level is not None:
+        _level = level
+    try:
+        yield
+    finally:
+        _handler, _level = handler, old_level
+
+
+def emit(level: int, event: str, message: str, count: int = 1, **fields):
+    """
+    Reports an event. The message is a str.format() template filled from fields, only formatted if it is handled.
+    :param level: DEBUG, INFO, WARNING or ERROR
+    :param event: a short event name used as the counter key, i.e., 'missing_price'
+    :param message: the message template
+    :param count: default is 1. The number of items the event covers, i.e., the number of tickers missing a price.
+    :param fields: values for the message template (along with count), also passed to the handler
+    """
+    if level < _level:
+        return
+    key = (event, level)
+    _counters[key] = _counters.get(key, 0) + count
+    if _handler is None:
+        return
+
+    suppressed = 0
+    if _max_messages is not None:
+        now = time.monotonic()
+        window = _windows.get(event)
+        if window is None or now - window[0] >= _interval:
+            window = _windows[event] = [now, 0, window[2] if window else 0]
+        if window[1] >= _max_messages:
+            window[2] += 1
+            return
+        window[1] += 1
+        suppressed, window[2] = window[2], 0
+
+    message = message.format(count=count, **fields)
+    if suppressed:
+        message = f'{message} ({suppressed} similar messages suppressed)'
+    record = {'time': time.time(), 'level': LEVEL_NAMES.get(level, level), 'event': event, 'message': message,
+              'count': count}
+    record.update(fields)
+    _handler(record)
+
+
+def format_items(items: list, limit: int = 10) -> str:
+    """
+    Formats the first limit items of a list for an aggregated message, i.e., 'AAPL, FB, MSFT and 12 more'
+    """
+    items = [str(item) for item in items]
+    if len(items) <= limit:
+        return ', '.join(items)
+    return f'{", ".join(items[:limit])} and {len(items) - limit} more'
+
+
+def get_counters() -> dict:
+    """
+    :return: a dictionary of {event: {level name: number of items reported}}, including suppressed message counts
+    """
+    counters = {}
+    for (event, level), count in _counters.items():
+        counters.setdefault(event, {})[LEVEL_NAMES.get(level, str(level))] = count
+    for event, window in _windows.items():
+        if window[2]:
+            counters.setdefault(event, {})['suppressed'] = window[2]
+    return counters
+
+
+def reset_counters():
+    _counters.clear()
+    _windows.clear()
+
+
+def format_metrics(prefix: str = 'portfolio') -> str:
+    """
+    The event counters and instrumentation.get_stage_stats() in the Prometheus text exposition format, for a metrics
+    exporter to serve
+    """
+    lines = [f'# TYPE {prefix}_events_total counter']
+    for (event, level), count in sorted(_counters.items()):
+        lines.append(f'{prefix}_events_total{{event="{event}",level="{LEVEL_NAMES.get(level, level)}"}} {count}')
+
+    stage_stats = get_stage_stats()
+    if stage_stats:
+        lines.append(f'# TYPE {prefix}_stage_calls_total counter')
+        lines.append(f'# TYPE {prefix}_stage_seconds_total counter')
+        for stage, stats in sorted(stage_stats.items()):
+            lines.append(f'{prefix}_stage_calls_total{{stage="{stage}"}} {stats["calls"]}')
+            lines.append(f'{prefix}_stage_seconds_total{{stage="{stage}"}} {stats["total_seconds"]}')
+    return '\n'.join(lines) + '\n'
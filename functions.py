@@ -1,8 +1,69 @@
 import numpy as np
 
+from instrumentation import timed
 
-def run_DCF_valuation(self, eps: float, three_year_eps_growth: float, decay_rate: float, pe_ratios_outcomes: list = None,
-                      historic_pe_ratios: list = None, time_horizon: int = 10) -> list:
+
+def get_pe_scenarios(pe_ratios_outcomes: list = None, historic_pe_ratios: list = None) -> list:
+    """
+    Returns the [low, middle, high] terminal pe ratio scenarios used in a DCF
+    :param pe_ratios_outcomes: a list of three terminal pe ratios [low, middle, high]
+    :param historic_pe_ratios: (optional) a list of historic pe ratios, if provided, outcome pe ratios will be
+    estimated as the mean +/- one standard deviation of the historic values.
+    :return: a sorted list with [low, middle, high] pe ratios
+    """
+    if not historic_pe_ratios:
+        return sorted(pe_ratios_outcomes)
+
+    pes = np.array(historic_pe_ratios)
+    mean_pe = np.mean(pes)
+    std_pe = np.std(pes)
+    return [mean_pe - std_pe, mean_pe, mean_pe + std_pe]
+
+
+@timed('run_batch_DCF_valuation')
+def run_batch_DCF_valuation(eps, three_year_eps_growth, decay_rate, discount_rate, terminal_pes,
+                            time_horizon: int = 10) -> np.ndarray:
+    """
+    Vectorized discounted cash flow valuation for any number of tickers and scenarios in one pass.
+
+    All inputs are broadcast against each other (i.e., shape tickers x scenarios), with terminal_pes carrying an extra
+    trailing axis of [low, middle, high] terminal pe ratios. EPS growth is held for the first years and then decays
+    geometrically, i.e. rate_t = growth * (1 - decay_rate) ** max(0, t - 3). Each year is one array operation over every
+    input combination, and the terminal pe scenarios are applied at the end.
+    :param eps: float or array of current earnings per share
+    :param three_year_eps_growth: float or array of YoY% EPS growth estimates for the next three years
+    :param decay_rate: float or array of EPS growth decay rates applied after the first three years
+    :param discount_rate: float or array of discount rates (i.e., 0.125)
+    :param terminal_pes: array with a trailing axis of terminal pe ratios, typically [low, middle, high]
+    :param time_horizon: default is 10. The time horizon to conduct the DCF for.
+    :return: an array of values with shape broadcast(inputs) + (number of pe scenarios,)
+    """
+    terminal_pes = np.asarray(terminal_pes, dtype=float)
+    inputs = [np.asarray(values, dtype=float) for values in (eps, three_year_eps_growth, decay_rate, discount_rate)]
+    shape = np.broadcast_shapes(terminal_pes.shape[:-1], *[values.shape for values in inputs])
+    eps, three_year_eps_growth, decay_rate, discount_rate = inputs
+
+    future_flow = np.broadcast_to(eps, shape)
+    discount_factor = np.ones(shape)
+    yearly_discount = 1 / (1 + discount_rate)
+    rate = three_year_eps_growth / 100
+    flows_pv = np.zeros(shape)
+
+    # compound earnings and discount factors one year at a time, vectorized over every input combination
+    for t in range(time_horizon):
+        if t > 3:
+            rate = rate * (1 - decay_rate)
+        future_flow = future_flow * (1 + rate)
+        discount_factor = discount_factor * yearly_discount
+        flows_pv += future_flow * discount_factor
+
+    terminal_pv = future_flow * discount_factor
+    return flows_pv[..., np.newaxis] + terminal_pv[..., np.newaxis] * terminal_pes
+
+
+@timed('run_DCF_valuation')
+def run_DCF_valuation(eps: float, three_year_eps_growth: float, decay_rate: float, pe_ratios_outcomes: list = None,
+                      historic_pe_ratios: list = None, time_horizon: int = 10, discount_rate: float = 0.125) -> list:
     """
     Runs a discounted cash flow analysis using earnings per share, resulting in a low, middle, and high share prices
     :param eps: current earning per share
@@ -12,53 +73,225 @@ def run_DCF_valuation(self, eps: float, three_year_eps_growth: float, decay_rate
     estimated using the range of historic values.
     :param time_horizon: default is 10. The time horizon to conduct the DCF for.
     :param decay_rate: after the first three years, this becomes the second derivative of EPS YoY growth.
+    :param discount_rate: default is 0.125. The rate future cash flows are discounted at.
     :return: a list with [low, middle, high] value estimates for each
     """
-    discount_rate = self.discount_rate
+    pe_scenarios = get_pe_scenarios(pe_ratios_outcomes, historic_pe_ratios)
+    values = run_batch_DCF_valuation(eps, three_year_eps_growth, decay_rate, discount_rate, pe_scenarios,
+                                     time_horizon=time_horizon)
+    return values.tolist()
 
-    if not historic_pe_ratios:
-        pe_scenarios = pe_ratios_outcomes.sort()
-    else:
-        pes = np.array(historic_pe_ratios)
-        mean_pe = np.mean(pes)
-        std_pe = np.std(pes)
-        pe_scenarios = [mean_pe - std_pe, mean_pe, mean_pe + std_pe]
 
-    # Calculate intrinsic value for each scenario
-    values = []  # Stores the value for each scenario
+def get_DCF_value_and_slope(eps, three_year_eps_growth, decay_rate, discount_rate, terminal_pe,
+                            time_horizon: int = 10):
+    """
+    The same DCF as run_batch_DCF_valuation() for a single terminal pe ratio per input, along with the derivative of the
+    value with respect to three_year_eps_growth (per YoY% point), accumulated in the same yearly loop
+    :return: (values, slopes) arrays with the broadcast shape of the inputs
+    """
+    inputs = [np.asarray(values, dtype=float) for values in
+              (eps, three_year_eps_growth, decay_rate, discount_rate, terminal_pe)]
+    eps, three_year_eps_growth, decay_rate, discount_rate, terminal_pe = np.broadcast_arrays(*inputs)
 
-    for i, scene in enumerate(pe_scenarios):
-        future_flow = []  # Stores the estimate future cash flows for each scenario
-        future_pv = []  # Stores estimate PV values for each scenario
+    future_flow = eps.copy()
+    flow_slope = np.zeros(eps.shape)  # d future_flow / d growth
+    discount_factor = np.ones(eps.shape)
+    yearly_discount = 1 / (1 + discount_rate)
+    growth_weight = np.full(eps.shape, 0.01)  # d rate / d growth, rate = growth / 100 * (1 - decay_rate) ** (t - 3)
+    values = np.zeros(eps.shape)
+    slopes = np.zeros(eps.shape)
 
-        term_pe = pe_scenarios[i]
+    for t in range(time_horizon):
+        if t > 3:
+            growth_weight = growth_weight * (1 - decay_rate)
+        growth_factor = 1 + (three_year_eps_growth * growth_weight)
+        flow_slope = (flow_slope * growth_factor) + (future_flow * growth_weight)
+        future_flow = future_flow * growth_factor
+        discount_factor = discount_factor * yearly_discount
+        values += future_flow * discount_factor
+        slopes += flow_slope * discount_factor
 
-        for j, t in enumerate(range(0, time_horizon)):
-            if j <= 3:
-                rate = three_year_eps_growth
-            else:
-                rate = rate - (rate * decay_rate)
+    values += future_flow * discount_factor * terminal_pe
+    slopes += flow_slope * discount_factor * terminal_pe
+    return values, slopes
 
-            if j == 0:
-                future_val = eps * (1 + (rate / 100))
 
-            else:
-                future_val = future_flow[j - 1] * (1 + (rate / 100))
+@timed('solve_implied_growth')
+def solve_implied_growth(prices, eps, decay_rate, discount_rate, terminal_pe, time_horizon: int = 10,
+                         bounds: tuple = (-99, 500), tol: float = 1e-10, max_iter: int = 100):
+    """
+    Reverse DCF: finds the three year EPS growth rate (YoY%) at which the DCF value equals the price, for every input
+    at once. Each iteration takes a Newton step on log(value) using get_DCF_value_and_slope(), falling back to bisection
+    when the step leaves the bracket. Positive EPS and terminal pe ratios make the value increasing in growth, so the
+    bracket always holds the root.
+    :param prices: float or array of current prices
+    :param eps: float or array of current earnings per share
+    :param decay_rate: float or array of EPS growth decay rates applied after the first three years
+    :param discount_rate: float or array of discount rates
+    :param terminal_pe: float or array of terminal pe ratios
+    :param time_horizon: default is 10. The time horizon of the DCF.
+    :param bounds: default is (-99, 500). The bracket of growth rates searched.
+    :param tol: default is 1e-10. Stops once every value is within tol * price of the price.
+    :param max_iter: default is 100. The maximum number of iterations.
+    :return: (implied growth rates, n_iterations), NaN where the price is outside the values at the bounds or the eps
+    or terminal pe is not positive
+    """
+    prices, eps, decay_rate, discount_rate, terminal_pe = np.broadcast_arrays(
+        *[np.asarray(values, dtype=float) for values in (prices, eps, decay_rate, discount_rate, terminal_pe)])
+    low = np.full(prices.shape, float(bounds[0]))
+    high = np.full(prices.shape, float(bounds[1]))
 
-            future_flow.append(future_val)
+    with np.errstate(invalid='ignore', over='ignore', divide='ignore'):
+        low_values, _ = get_DCF_value_and_slope(eps, low, decay_rate, discount_rate, terminal_pe, time_horizon)
+        high_values, _ = get_DCF_value_and_slope(eps, high, decay_rate, discount_rate, terminal_pe, time_horizon)
+        solvable = (eps > 0) & (terminal_pe > 0) & (low_values <= prices) & (prices <= high_values)
 
-            exp = -t - 1
-            pv = future_val * ((1 + discount_rate) ** exp)
-            future_pv.append(pv)
+        # start from the growth that gives the price if it were constant and the terminal value dominated
+        growth = 100 * ((((prices / (eps * (terminal_pe + 1))) ** (1 / time_horizon)) * (1 + discount_rate)) - 1)
+        growth = np.where(np.isfinite(growth), np.clip(growth, low, high), high)
+        n_iter = 0
+        for n_iter in range(1, max_iter + 1):
+            values, slopes = get_DCF_value_and_slope(eps, growth, decay_rate, discount_rate, terminal_pe, time_horizon)
+            errors = values - prices
+            active = solvable & (np.abs(errors) > tol * prices)
+            if not active.any():
+                break
+            high = np.where(active & (errors > 0), growth, high)
+            low = np.where(active & (errors < 0), growth, low)
+            # value compounds with growth, so Newton steps on log(value) close in far fewer iterations
+            newton = growth - (np.log(values / prices) * values / slopes)
+            stepped = np.where((newton > low) & (newton < high), newton, (low + high) / 2)
+            growth = np.where(active, stepped, growth)
 
-        terminal_value = future_flow[-1] * term_pe
-        term_pv = terminal_value * ((1 + discount_rate) ** exp)
-        future_pv.append(term_pv)
+    return np.where(solvable, growth, np.nan), n_iter
 
-        values.append(sum(future_pv))
 
-    return values
+def get_implied_terminal_pe(prices, eps, three_year_eps_growth, decay_rate, discount_rate,
+                            time_horizon: int = 10) -> np.ndarray:
+    """
+    Reverse DCF for the terminal pe ratio at which the DCF value equals the price, given an EPS growth estimate. The
+    value is linear in the terminal pe, so this is solved directly from the values at pe ratios of 0 and 1.
+    :return: an array of implied terminal pe ratios with the broadcast shape of the inputs, NaN where eps is not positive
+    """
+    values = run_batch_DCF_valuation(eps, three_year_eps_growth, decay_rate, discount_rate, [0, 1],
+                                     time_horizon=time_horizon)
+    flows_pv = values[..., 0]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        implied_pes = (np.asarray(prices, dtype=float) - flows_pv) / (values[..., 1] - flows_pv)
+    return np.where(np.asarray(eps, dtype=float) > 0, implied_pes, np.nan)
 
 
 def get_greed_exponent(greed_value):
-    return
\ No newline at end of file
+    """
+    Maps a greed value (0 - 1) to the exponent applied to expected returns, ranging 1 to 3 (0.5 -> 2 is default)
+    """
+    return 1 + (2 * greed_value)
+
+
+def project_capped_simplex(values: np.ndarray, upper: np.ndarray, total: float, n_bisections: int = 60) -> np.ndarray:
+    """
+    Euclidean projection onto {x : 0 <= x <= upper, sum(x) = total}, found by bisection on the shift tau in
+    x = clip(values - tau, 0, upper)
+    :param values: the array to project
+    :param upper: an array of per element upper bounds
+    :param total: the required sum, reduced to sum(upper) if that is smaller
+    :param n_bisections: default is 60. The number of bisection steps.
+    :return: the projected array
+    """
+    total = min(total, np.sum(upper))
+    low = np.min(values) - np.max(upper)
+    high = np.max(values)
+    for _ in range(n_bisections):
+        tau = (low + high) / 2
+        if np.sum(np.clip(values - tau, 0, upper)) > total:
+            low = tau
+        else:
+            high = tau
+    return np.clip(values - high, 0, upper)
+
+
+def solve_allocation_qp(returns: np.ndarray, equity: np.ndarray, contribution: float, gamma: float,
+                        upper: np.ndarray = None, budget: float = 1, x0: np.ndarray = None, tol: float = 1e-9,
+                        max_iter: int = 1000):
+    """
+    Finds the fractions x of a contribution to allocate to each position by projected gradient ascent on
+        returns . x - gamma * N * sum((w - mean(w)) ** 2)
+    where w = (equity + contribution * x) / (sum(equity) + contribution) are the post contribution position weights.
+    :param returns: an array of (greed weighted) expected returns, normalized internally to sum to 1
+    :param equity: an array of current position equity values
+    :param contribution: the $ amount being allocated
+    :param gamma: the weight on the balance (post contribution weight variance) term
+    :param upper: (optional) an array of maximum fractions of the contribution for each position
+    :param budget: default is 1. The fraction of the contribution to invest (i.e., 1 - minimum cash).
+    :param x0: (optional) a starting solution, i.e., the previous time step's solution
+    :param tol: default is 1e-9. Stops once no fraction changes by more than tol in an iteration.
+    :param max_iter: default is 1000. The maximum number of iterations.
+    :return: (x, n_iterations)
+    """
+    returns = np.asarray(returns, dtype=np.float64)
+    equity = np.nan_to_num(np.asarray(equity, dtype=np.float64))
+    n = len(returns)
+    if upper is None:
+        upper = np.ones(n)
+
+    # only positions with positive expected returns receive capital
+    upper = np.where(returns > 0, upper, 0)
+    if n == 0 or np.sum(upper) <= 0 or contribution <= 0:
+        return np.zeros(n), 0
+    returns = returns / np.sum(returns[returns > 0])
+
+    total_value = np.sum(equity) + contribution
+    base_weights = equity / total_value
+    scale = contribution / total_value
+    penalty = gamma * n
+
+    # gradient is Lipschitz with constant 2 * penalty * scale ** 2
+    lipschitz = 2 * penalty * scale ** 2
+    step = 1 / lipschitz if lipschitz > 0 else 1.0
+
+    if x0 is None or len(x0) != n:
+        x0 = np.full(n, budget / n)
+    x = project_capped_simplex(np.asarray(x0, dtype=np.float64), upper, budget)
+
+    n_iter = 0
+    for n_iter in range(1, max_iter + 1):
+        weights = base_weights + (scale * x)
+        gradient = returns - (2 * penalty * scale * (weights - np.mean(weights)))
+        x_new = project_capped_simplex(x + (step * gradient), upper, budget)
+        converged = np.max(np.abs(x_new - x)) < tol
+        x = x_new
+        if converged:
+            break
+
+    return x, n_iter
+
+
+def round_to_lots(x: np.ndarray, contribution: float, prices: np.ndarray, lot_sizes: np.ndarray,
+                  upper: np.ndarray = None) -> np.ndarray:
+    """
+    Converts allocation fractions to whole lots of shares. Each position is rounded down, then leftover cash buys single
+    lots for the positions furthest below their target, while they fit in the cash and under upper.
+    :param x: an array of allocation fractions of the contribution
+    :param contribution: the $ amount being allocated
+    :param prices: an array of share prices
+    :param lot_sizes: an array of the number of shares per lot (i.e., 1 for whole shares)
+    :param upper: (optional) an array of maximum fractions of the contribution for each position
+    :return: an array with the number of shares to buy for each position
+    """
+    prices = np.asarray(prices, dtype=np.float64)
+    lot_costs = prices * lot_sizes
+    target = x * contribution
+    with np.errstate(invalid='ignore', divide='ignore'):
+        lots = np.floor(np.nan_to_num(target / lot_costs))
+    if upper is None:
+        upper = np.ones(len(x))
+    limits = upper * contribution
+
+    leftover = np.sum(target) - np.sum(lots * lot_costs)
+    for i in np.argsort(-(target - (lots * lot_costs))):
+        spent = (lots[i] + 1) * lot_costs[i]
+        if x[i] > 0 and lot_costs[i] <= leftover and spent <= limits[i]:
+            lots[i] += 1
+            leftover -= lot_costs[i]
+
+    return lots * lot_sizes
@@ -0,0 +1,223 @@
+import csv
+import os
+
+import numpy as np
+
+# column name -> CSV header
+FUNDAMENTAL_COLUMNS = {
+    'eps': 'EPS',
+    'eps_growth': 'EPS Growth',
+    'pe': 'PE',
+}
+
+# rows are located with one searchsorted over (ticker index, date) keys packed into int64
+_DAY_OFFSET = 2 ** 31
+_KEY_STRIDE = 2 ** 32
+
+
+def _to_float(value: str) -> float:
+    return np.nan if value in ('', 'null', None) else float(value)
+
+
+def read_fundamentals_csv(csv_path: str, ticker: str = None) -> dict:
+    """
+    Parses a fundamentals CSV with a Date column and any of the FUNDAMENTAL_COLUMNS headers (EPS, EPS Growth, PE).
+    Missing columns and empty cells are read as NaN.
+    :param csv_path: path to the CSV file
+    :param ticker: (optional) the ticker of a single ticker file, default is the Ticker column if there is one, otherwise
+    the CSV file name (i.e., FB.csv -> FB)
+    :return: a dictionary of {ticker: {'date': datetime64[D] array, 'eps': array, 'eps_growth': array, 'pe': array}}
+    """
+    with open(csv_path, newline='') as f:
+        reader = csv.DictReader(f)
+        rows = [row for row in reader if row.get('Date')]
+
+    if ticker is None and (not rows or 'Ticker' not in rows[0]):
+        ticker = os.path.splitext(os.path.basename(csv_path))[0]
+    row_tickers = [ticker if ticker else row['Ticker'] for row in rows]
+
+    histories = {}
+    for tick in dict.fromkeys(row_tickers):
+        tick_rows = [row for row, row_tick in zip(rows, row_tickers) if row_tick == tick]
+        history = {'date': np.array([row['Date'] for row in tick_rows], dtype='datetime64[D]')}
+        for column, header in FUNDAMENTAL_COLUMNS.items():
+            history[column] = np.array([_to_float(row.get(header)) for row in tick_rows], dtype=np.float64)
+        histories[tick] = history
+    return histories
+
+
+def read_fundamentals_csv_dir(csv_dir: str) -> dict:
+    """
+    Reads every .csv file in a directory (i.e., demo_data/fundamentals/), either one file per ticker or files with a
+    Ticker column, see read_fundamentals_csv()
+    """
+    histories = {}
+    for file_name in sorted(os.listdir(csv_dir)):
+        if file_name.endswith('.csv'):
+            histories.update(read_fundamentals_csv(os.path.join(csv_dir, file_name)))
+    return histories
+
+
+class FundamentalsStore:
+    """
+    Time indexed EPS, EPS growth and pe ratio histories for many tickers, held as concatenated arrays with one segment
+    per ticker. Prefix sums of each column are built once, so the mean and standard deviation of any expanding or
+    rolling window ending at a date cost O(1) per ticker, and every lookup is vectorized across tickers.
+    The following user facing class functions are defined:
+    - FundamentalsStore.update(histories): adds or replaces ticker histories
+    - FundamentalsStore.get_history(ticker, column) -> (dates, values): zero-copy slices of a ticker's history
+    - FundamentalsStore.get_latest(column, date, tickers) -> np.ndarray: the last value known at a date
+    - FundamentalsStore.get_window_stats(column, date, window, tickers) -> (mean, std, count)
+    - FundamentalsStore.get_pe_scenarios(date, window, tickers) -> np.ndarray: [mean - std, mean, mean + std] pe ratios
+    - FundamentalsStore.get_dcf_inputs(tickers, date, window) -> (eps, eps_growth, pe_scenarios)
+    """
+
+    def __init__(self, histories: dict = None):
+        """
+        :param histories: (optional) a dictionary of {ticker: {'date': dates, 'eps': values, ...}}, i.e., from
+        read_fundamentals_csv_dir()
+        """
+        self._histories = {}
+        self.tickers = []
+        self.rows = {}
+        self.update(histories or {})
+
+    @classmethod
+    def from_csv_dir(cls, csv_dir: str):
+        return cls(read_fundamentals_csv_dir(csv_dir))
+
+    def __len__(self):
+        return len(self.tickers)
+
+    def __contains__(self, ticker):
+        return ticker in self.rows
+
+    def update(self, histories: dict):
+        """
+        Adds or replaces ticker histories and rebuilds the prefix sums once
+        :param histories: a dictionary of {ticker: {'date': dates, 'eps': values, 'eps_growth': values, 'pe': values}},
+        columns that are left out are NaN
+        """
+        for tick, history in histories.items():
+            dates = np.asarray(history['date'], dtype='datetime64[D]')
+            if len(dates) == 0:
+                continue
+            order = np.argsort(dates, kind='stable')
+            self._histories[tick] = {'date': dates[order]}
+            for column in FUNDAMENTAL_COLUMNS:
+                values = history.get(column)
+                values = np.full(len(dates), np.nan) if values is None else np.asarray(values, dtype=np.float64)
+                self._histories[tick][column] = values[order]
+        self._build()
+
+    def get_history(self, ticker: str, column: str = 'pe'):
+        row = self.rows[ticker]
+        start, end = self.offsets[row], self.offsets[row + 1]
+        return self.dates[start:end], self.columns[column][start:end]
+
+    def get_latest(self, column: str, date=None, tickers: list = None) -> np.ndarray:
+        """
+        :param column: one of FUNDAMENTAL_COLUMNS
+        :param date: (optional) the as of date, default is the last stored date
+        :param tickers: (optional) a list of tickers, default is all stored tickers
+        :return: an array with each ticker's last non NaN value dated on or before date, NaN if there is none
+        """
+        starts, ends = self._get_bounds(date, tickers)
+        last_valid = self._last_valid[column][np.maximum(ends - 1, 0)]
+        found = (ends > starts) & (last_valid >= starts)
+        return np.where(found, self.columns[column][np.maximum(last_valid, 0)], np.nan)
+
+    def get_window_stats(self, column: str = 'pe', date=None, window: int = None, tickers: list = None):
+        """
+        The mean and (population) standard deviation of each ticker's values in a window ending at date, NaN values are
+        skipped
+        :param column: default is 'pe'. One of FUNDAMENTAL_COLUMNS.
+        :param date: (optional) the as of date, default is the last stored date
+        :param window: (optional) the number of most recent observations to use, default is every observation (expanding)
+        :param tickers: (optional) a list of tickers, default is all stored tickers
+        :return: (mean, std, count) arrays, mean and std are NaN where count is 0
+        """
+        starts, ends = self._get_bounds(date, tickers)
+        if window is not None:
+            starts = np.maximum(starts, ends - window)
+
+        counts, sums, squares = self._prefix_sums[column]
+        count = counts[ends] - counts[starts]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            # sums are of values centered on each ticker's overall mean, which keeps the variance numerically stable
+            centered_mean = (sums[ends] - sums[starts]) / count
+            variance = ((squares[ends] - squares[starts]) / count) - (centered_mean ** 2)
+        mean = centered_mean + self._shifts[column][self._get_ticker_rows(tickers)]
+        return mean, np.sqrt(np.maximum(variance, 0)), count
+
+    def get_pe_scenarios(self, date=None, window: int = None, tickers: list = None) -> np.ndarray:
+        """
+        The windowed equivalent of functions.get_pe_scenarios(historic_pe_ratios=...)
+        :return: a (tickers x 3) array of [mean - std, mean, mean + std] pe ratios
+        """
+        mean, std, _ = self.get_window_stats('pe', date, window, tickers)
+        return np.stack([mean - std, mean, mean + std], axis=1)
+
+    def get_dcf_inputs(self, tickers: list = None, date=None, window: int = None):
+        """
+        :return: (eps, eps_growth, pe_scenarios) arrays as of date, ready for functions.run_batch_DCF_valuation()
+        """
+        return (self.get_latest('eps', date, tickers), self.get_latest('eps_growth', date, tickers),
+                self.get_pe_scenarios(date, window, tickers))
+
+    # #### INTERNAL METHODS #####
+    def _build(self):
+        self.tickers = list(self._histories.keys())
+        self.rows = {tick: row for row, tick in enumerate(self.tickers)}
+        lengths = np.array([len(self._histories[tick]['date']) for tick in self.tickers], dtype=np.intp)
+        self.offsets = np.concatenate([[0], np.cumsum(lengths)]).astype(np.intp)
+        ticker_rows = np.repeat(np.arange(len(self.tickers)), lengths)
+
+        def concatenate(column, dtype):
+            if not self.tickers:
+                return np.empty(0, dtype=dtype)
+            return np.concatenate([self._histories[tick][column] for tick in self.tickers])
+
+        self.dates = concatenate('date', 'datetime64[D]')
+        self._keys = self._get_keys(ticker_rows, self.dates)
+        self.columns = {column: concatenate(column, np.float64) for column in FUNDAMENTAL_COLUMNS}
+
+        self._shifts = {}
+        self._prefix_sums = {}
+        self._last_valid = {}
+        positions = np.arange(len(self.dates))
+        for column, values in self.columns.items():
+            valid = ~np.isnan(values)
+            filled = np.where(valid, values, 0)
+            # shift each ticker's values by its own mean before summing squares
+            shifts = np.zeros(len(self.tickers))
+            if len(self.tickers):
+                n_valid = np.add.reduceat(valid, self.offsets[:-1])
+                np.divide(np.add.reduceat(filled, self.offsets[:-1]), n_valid, out=shifts, where=n_valid > 0)
+            centered = np.where(valid, values - shifts[ticker_rows], 0)
+
+            self._shifts[column] = shifts
+            self._prefix_sums[column] = tuple(np.concatenate([[0], np.cumsum(terms)])
+                                              for terms in (valid, centered, centered ** 2))
+            # the index of the last non NaN value at or before each row, -1 if there is none
+            last_valid = np.maximum.accumulate(np.where(valid, positions, -1)) if len(values) else np.empty(0)
+            self._last_valid[column] = np.append(last_valid, -1).astype(np.intp)
+
+    @staticmethod
+    def _get_keys(ticker_rows: np.ndarray, dates: np.ndarray) -> np.ndarray:
+        days = dates.astype('datetime64[D]').astype(np.int64)
+        return (ticker_rows.astype(np.int64) * _KEY_STRIDE) + (days + _DAY_OFFSET)
+
+    def _get_ticker_rows(self, tickers: list = None) -> np.ndarray:
+        if tickers is None:
+            return np.arange(len(self.tickers))
+        return np.array([self.rows[tick] for tick in tickers], dtype=np.intp)
+
+    def _get_bounds(self, date=None, tickers: list = None):
+        ticker_rows = self._get_ticker_rows(tickers)
+        starts = self.offsets[ticker_rows]
+        if date is None:
+            return starts, self.offsets[ticker_rows + 1]
+        dates = np.full(len(ticker_rows), np.datetime64(date, 'D'))
+        ends = np.searchsorted(self._keys, self._get_keys(ticker_rows, dates), side='right').astype(np.intp)
+        return starts, ends
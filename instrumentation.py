@@ -0,0 +1,67 @@
+import functools
+import time
+
+# opt-in per stage timing, when disabled a decorated call costs one flag check
+_enabled = False
+_stage_stats = {}
+
+
+def enable_instrumentation():
+    global _enabled
+    _enabled = True
+
+
+def disable_instrumentation():
+    global _enabled
+    _enabled = False
+
+
+def is_instrumentation_enabled() -> bool:
+    return _enabled
+
+
+def reset_stage_stats():
+    _stage_stats.clear()
+
+
+def record_stage(stage: str, seconds: float):
+    """
+    Adds one call's latency to a stage's counters
+    """
+    stats = _stage_stats.get(stage)
+    if stats is None:
+        stats = _stage_stats[stage] = {'calls': 0, 'total_seconds': 0.0, 'max_seconds': 0.0}
+    stats['calls'] += 1
+    stats['total_seconds'] += seconds
+    if seconds > stats['max_seconds']:
+        stats['max_seconds'] = seconds
+
+
+def get_stage_stats() -> dict:
+    """
+    :return: a dictionary keyed by stage name with calls, total_seconds, max_seconds and mean_seconds
+    """
+    stage_stats = {}
+    for stage, stats in _stage_stats.items():
+        stage_stats[stage] = dict(stats)
+        stage_stats[stage]['mean_seconds'] = stats['total_seconds'] / stats['calls']
+    return stage_stats
+
+
+def timed(stage: str):
+    """
+    Decorator that records the latency of each call under a stage name while instrumentation is enabled
+    :param stage: the stage name, i.e., 'Portfolio.get_optimal_allocations'
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return func(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                record_stage(stage, time.perf_counter() - start)
+        return wrapper
+    return decorator
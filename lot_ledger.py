@@ -0,0 +1,305 @@
+import csv
+
+import numpy as np
+
+LOT_MATCHING_METHODS = ('fifo', 'lifo', 'specific')
+
+# remaining lot shares at or below this are treated as sold
+_SHARES_TOL = 1e-9
+
+
+class _GrowableColumns:
+    """
+    A set of equal length typed numpy arrays that are appended to, doubling capacity when full
+    """
+
+    def __init__(self, dtypes: dict, capacity: int = 16):
+        self.dtypes = dtypes
+        self.size = 0
+        self.capacity = max(int(capacity), 1)
+        self.columns = {name: np.zeros(self.capacity, dtype=dtype) for name, dtype in dtypes.items()}
+
+    @classmethod
+    def from_arrays(cls, dtypes: dict, arrays: dict):
+        """
+        Wraps existing arrays (i.e., memory mapped from a snapshot) without copying them, they are copied on first growth
+        """
+        size = len(next(iter(arrays.values())))
+        if size == 0:
+            return cls(dtypes, capacity=1)
+        columns = cls.__new__(cls)
+        columns.dtypes = dtypes
+        columns.columns = {name: arrays[name] for name in dtypes}
+        columns.size = columns.capacity = size
+        return columns
+
+    def __getitem__(self, column: str) -> np.ndarray:
+        return self.columns[column][:self.size]
+
+    def __len__(self):
+        return self.size
+
+    def extend(self, **values) -> int:
+        """
+        Appends rows (scalars or equal length arrays for every column)
+        :return: the index of the first appended row
+        """
+        n = max(np.size(value) for value in values.values())
+        if self.size + n > self.capacity:
+            new_capacity = self.capacity
+            while new_capacity < self.size + n:
+                new_capacity *= 2
+            for name, column in self.columns.items():
+                grown = np.zeros(new_capacity, dtype=column.dtype)
+                grown[:self.size] = column[:self.size]
+                self.columns[name] = grown
+            self.capacity = new_capacity
+
+        start = self.size
+        for name, value in values.items():
+            self.columns[name][start:start + n] = value
+        self.size += n
+        return start
+
+
+class LotLedger:
+    """
+    Tax-lot level record of a position's buys and sells. Lots are stored in growable typed arrays, and the open shares,
+    open cost basis and realized gain are kept as running totals, so the average price and gains are O(1) to read.
+    The following user facing class functions are defined:
+    - LotLedger.add_lot(shares, price, date=None) -> int: records a buy as a new lot and returns its id
+    - LotLedger.add_lots(shares, prices, dates=None): records many buys at once
+    - LotLedger.sell(shares, price, method='fifo', lot_ids=None, date=None) -> float: sells from open lots, matched
+    first in first out, last in first out, or from specific lots, and returns the realized gain
+    - LotLedger.ingest_trades(shares, prices, dates=None, method='fifo'): applies a trade history (sells negative)
+    - LotLedger.get_open_lots() -> dict: lot ids, dates, remaining shares and prices of the open lots
+    - LotLedger.get_unrealized_gain(current_price) -> float / LotLedger.get_realized_gain(start, end) -> float
+    """
+    lot_dtypes = {
+        'date': np.dtype('datetime64[D]'),
+        'shares': np.dtype(np.float64),  # shares bought
+        'remaining': np.dtype(np.float64),  # shares not yet sold
+        'price': np.dtype(np.float64),
+    }
+    sale_dtypes = {
+        'date': np.dtype('datetime64[D]'),
+        'lot': np.dtype(np.int64),  # the lot each sale was matched against
+        'shares': np.dtype(np.float64),
+        'price': np.dtype(np.float64),
+        'gain': np.dtype(np.float64),
+    }
+
+    def __init__(self, capacity: int = 16):
+        self.lots = _GrowableColumns(self.lot_dtypes, capacity)
+        self.sales = _GrowableColumns(self.sale_dtypes, capacity)
+
+        self.open_shares = 0.0
+        self.open_cost = 0.0  # cost basis of the open shares
+        self.realized_gain = 0.0
+        self._first_open = 0  # every lot before this index is fully sold
+
+    def __len__(self):
+        return len(self.lots)
+
+    @classmethod
+    def from_arrays(cls, lots: dict, sales: dict, open_shares: float, open_cost: float, realized_gain: float,
+                    first_open: int = 0):
+        """
+        Rebuilds a ledger from its lot and sale columns and running totals, see snapshot.load_snapshot()
+        """
+        ledger = cls.__new__(cls)
+        ledger.lots = _GrowableColumns.from_arrays(cls.lot_dtypes, lots)
+        ledger.sales = _GrowableColumns.from_arrays(cls.sale_dtypes, sales)
+        ledger.open_shares = float(open_shares)
+        ledger.open_cost = float(open_cost)
+        ledger.realized_gain = float(realized_gain)
+        ledger._first_open = int(first_open)
+        return ledger
+
+    @property
+    def average_price(self):
+        if self.open_shares <= _SHARES_TOL:
+            return None
+        return self.open_cost / self.open_shares
+
+    def add_lot(self, shares: float, price: float, date=None) -> int:
+        self.open_shares += shares
+        self.open_cost += shares * price
+        return self.lots.extend(date=np.datetime64(date, 'D') if date is not None else np.datetime64('NaT'),
+                                shares=shares, remaining=shares, price=price)
+
+    def add_lots(self, shares: np.ndarray, prices: np.ndarray, dates: np.ndarray = None):
+        shares = np.asarray(shares, dtype=np.float64)
+        prices = np.broadcast_to(np.asarray(prices, dtype=np.float64), shares.shape)
+        if dates is None:
+            dates = np.full(shares.shape, np.datetime64('NaT'), dtype='datetime64[D]')
+        self.open_shares += float(np.sum(shares))
+        self.open_cost += float(shares @ prices)
+        self.lots.extend(date=np.asarray(dates, dtype='datetime64[D]'), shares=shares, remaining=shares, price=prices)
+
+    def sell(self, shares: float, price: float, method: str = 'fifo', lot_ids: list = None, date=None) -> float:
+        """
+        Sells shares from open lots
+        :param shares: the number of shares to sell
+        :param price: the sale price
+        :param method: 'fifo' (oldest lots first), 'lifo' (newest lots first) or 'specific' (the lots in lot_ids)
+        :param lot_ids: the lot ids to sell from, in order, when method='specific'. Each id may appear once.
+        :param date: (optional) the sale date
+        :return: the realized gain of the sale
+        """
+        if method not in LOT_MATCHING_METHODS:
+            raise ValueError(f'method must be one of {LOT_MATCHING_METHODS}, not {method}')
+        if shares > self.open_shares + _SHARES_TOL:
+            raise ValueError(f'Cannot sell {shares} shares, only {self.open_shares} are held')
+        if shares <= 0:
+            return 0.0
+
+        remaining = self.lots['remaining']
+        if method in ('fifo', 'lifo'):
+            order = self._find_open_lots(shares, reverse=method == 'lifo')
+        else:
+            if lot_ids is None:
+                raise ValueError("lot_ids are required when method='specific'")
+            order = np.asarray(lot_ids, dtype=np.intp).ravel()
+            if np.any((order < 0) | (order >= len(self.lots))):
+                raise ValueError(f'lot_ids must be between 0 and {len(self.lots) - 1}, not {lot_ids}')
+            if len(np.unique(order)) != len(order):
+                raise ValueError(f'lot_ids must not repeat a lot, not {lot_ids}')
+
+        # take whole lots in order until the last one is partially sold
+        available = remaining[order]
+        taken = np.minimum(available, np.maximum(shares - (np.cumsum(available) - available), 0))
+        sold = taken > 0
+        order, taken = order[sold], taken[sold]
+        if np.sum(taken) < shares - _SHARES_TOL:
+            raise ValueError(f'The matched lots hold fewer than {shares} shares')
+
+        remaining[order] -= taken
+        remaining[order[remaining[order] <= _SHARES_TOL]] = 0.0
+        gains = taken * (price - self.lots['price'][order])
+
+        self.open_shares = max(self.open_shares - float(np.sum(taken)), 0.0)
+        self.open_cost = self.open_cost - float(taken @ self.lots['price'][order]) if self.open_shares > 0 else 0.0
+        self.realized_gain += float(np.sum(gains))
+        self.sales.extend(date=np.datetime64(date, 'D') if date is not None else np.datetime64('NaT'),
+                          lot=order, shares=taken, price=price, gain=gains)
+
+        while self._first_open < len(self.lots) and remaining[self._first_open] == 0:
+            self._first_open += 1
+        return float(np.sum(gains))
+
+    def ingest_trades(self, shares: np.ndarray, prices: np.ndarray, dates: np.ndarray = None, method: str = 'fifo'):
+        """
+        Applies a trade history in order. Runs of consecutive buys are appended as one array operation, so a history of
+        buys (i.e., automated contributions) is ingested in a single vectorized call.
+        :param shares: an array of traded shares, negative for sells
+        :param prices: an array of trade prices
+        :param dates: (optional) an array of trade dates
+        :param method: default is 'fifo'. The lot matching method for sells, 'fifo' or 'lifo'.
+        """
+        shares = np.asarray(shares, dtype=np.float64)
+        prices = np.asarray(prices, dtype=np.float64)
+        if dates is None:
+            dates = np.full(shares.shape, np.datetime64('NaT'), dtype='datetime64[D]')
+        dates = np.asarray(dates, dtype='datetime64[D]')
+
+        start = 0
+        for i in np.flatnonzero(shares < 0):
+            if i > start:
+                self.add_lots(shares[start:i], prices[start:i], dates[start:i])
+            self.sell(-shares[i], prices[i], method=method, date=dates[i])
+            start = i + 1
+        if start < len(shares):
+            self.add_lots(shares[start:], prices[start:], dates[start:])
+
+    def get_open_lots(self) -> dict:
+        """
+        :return: a dictionary of 'lot', 'date', 'remaining' and 'price' arrays for lots with shares left
+        """
+        lots = self._first_open + np.flatnonzero(self.lots['remaining'][self._first_open:] > 0)
+        return {
+            'lot': lots,
+            'date': self.lots['date'][lots],
+            'remaining': self.lots['remaining'][lots],
+            'price': self.lots['price'][lots],
+        }
+
+    def get_unrealized_gain(self, current_price: float) -> float:
+        return self.open_shares * current_price - self.open_cost
+
+    def get_lot_unrealized_gains(self, current_price: float) -> dict:
+        """
+        :return: a dictionary of lot id: unrealized gain for lots with shares left
+        """
+        lots = self.get_open_lots()
+        gains = lots['remaining'] * (current_price - lots['price'])
+        return dict(zip(lots['lot'].tolist(), gains.tolist()))
+
+    def get_realized_gain(self, start=None, end=None) -> float:
+        """
+        :param start: (optional) only count sales on or after this date
+        :param end: (optional) only count sales on or before this date
+        :return: the realized gain of sales in the date range, all sales by default
+        """
+        if start is None and end is None:
+            return self.realized_gain
+        dates = self.sales['date']
+        in_range = ~np.isnat(dates)
+        if start is not None:
+            in_range &= dates >= np.datetime64(start, 'D')
+        if end is not None:
+            in_range &= dates <= np.datetime64(end, 'D')
+        return float(np.sum(self.sales['gain'][in_range]))
+
+    # #### INTERNAL METHODS #####
+    def _find_open_lots(self, shares: float, reverse: bool = False) -> np.ndarray:
+        """
+        Finds open lots oldest first (newest first if reverse) holding at least shares. The search window doubles from
+        the oldest open lot (or the newest lot) until it is enough, so a sale only touches the lots near the end it
+        sells from.
+        """
+        remaining = self.lots['remaining']
+        first, n = self._first_open, len(remaining)
+        width = 64
+        while True:
+            if reverse:
+                start = max(n - width, first)
+                lots = start + np.flatnonzero(remaining[start:] > _SHARES_TOL)[::-1]
+                exhausted = start == first
+            else:
+                end = min(first + width, n)
+                lots = first + np.flatnonzero(remaining[first:end] > _SHARES_TOL)
+                exhausted = end == n
+            if exhausted or np.sum(remaining[lots]) >= shares:
+                return lots
+            width *= 2
+
+
+def read_trade_history(csv_path: str) -> dict:
+    """
+    Reads a trade history CSV with Date, Ticker, Shares and Price columns, and an optional Side column ('buy' or
+    'sell'). Without a Side column, sells are negative Shares.
+    :param csv_path: path to the CSV file
+    :return: a dictionary of ticker: (dates, shares, prices) arrays in trade order, sells as negative shares
+    """
+    with open(csv_path, newline='') as f:
+        rows = list(csv.DictReader(f))
+
+    tickers = np.array([row['Ticker'] for row in rows])
+    dates = np.array([row['Date'] for row in rows], dtype='datetime64[D]')
+    shares = np.array([row['Shares'] for row in rows], dtype=np.float64)
+    prices = np.array([row['Price'] for row in rows], dtype=np.float64)
+    if rows and 'Side' in rows[0]:
+        sells = np.array([row['Side'].strip().lower() == 'sell' for row in rows])
+        shares = np.where(sells, -np.abs(shares), np.abs(shares))
+
+    # group by ticker, lexsort is stable so same day trades stay in file order
+    names, first_rows, groups = np.unique(tickers, return_index=True, return_inverse=True)
+    order = np.lexsort((dates, groups))
+    group_orders = np.split(order, np.cumsum(np.bincount(groups, minlength=len(names)))[:-1])
+
+    trades = {}
+    for group in np.argsort(first_rows):
+        rows = group_orders[group]
+        trades[str(names[group])] = (dates[rows], shares[rows], prices[rows])
+    return trades
@@ -0,0 +1,118 @@
+from concurrent.futures import ProcessPoolExecutor
+
+from functions import *
+
+# quantile levels stored for each ticker, every 5%
+QUANTILE_LEVELS = np.linspace(0, 1, 21)
+
+
+def sample_DCF_values(eps: float, three_year_eps_growth: float, decay_rate: float, discount_rate: float,
+                      pe_scenarios: list, n_paths: int, rng: np.random.Generator, growth_std: float = 5.0,
+                      decay_std: float = 0.02, chunk_size: int = 10000, time_horizon: int = 10) -> np.ndarray:
+    """
+    Samples DCF values for one ticker. Each path draws an EPS growth rate (normal, in YoY% points), a decay rate
+    (normal, clipped to 0 - 1) and a terminal pe ratio (lognormal with the middle scenario as its median and the
+    low/high scenarios one standard deviation away). Paths are valued chunk_size at a time to bound memory.
+    :param eps: current earnings per share
+    :param three_year_eps_growth: the expected YoY% EPS growth rate for the next three years
+    :param decay_rate: the expected EPS growth decay rate
+    :param discount_rate: the discount rate
+    :param pe_scenarios: [low, middle, high] terminal pe ratios
+    :param n_paths: the number of paths to sample
+    :param rng: a numpy random Generator
+    :param growth_std: default is 5.0. The standard deviation of EPS growth in YoY% points.
+    :param decay_std: default is 0.02. The standard deviation of the decay rate.
+    :param chunk_size: default is 10,000. The number of paths valued at once.
+    :param time_horizon: default is 10. The time horizon to conduct the DCF for.
+    :return: an array of n_paths sampled values
+    """
+    low, mid, high = pe_scenarios
+    # average the log spread of whichever sides are valid, a one sided spread is used as is
+    sides = []
+    if high > mid > 0:
+        sides.append(np.log(high / mid))
+    if mid > low > 0:
+        sides.append(np.log(mid / low))
+    pe_sigma = float(np.mean(sides)) if sides else 0.0
+
+    values = np.empty(n_paths)
+    for start in range(0, n_paths, chunk_size):
+        n = min(chunk_size, n_paths - start)
+        growths = rng.normal(three_year_eps_growth, growth_std, n)
+        decays = np.clip(rng.normal(decay_rate, decay_std, n), 0, 1)
+        terminal_pes = mid * np.exp(rng.normal(0, pe_sigma, n))
+        values[start:start + n] = run_batch_DCF_valuation(eps, growths, decays, discount_rate, terminal_pes[:, np.newaxis],
+                                                          time_horizon=time_horizon)[:, 0]
+    return values
+
+
+def _run_monte_carlo_chunk(inputs: tuple, n_paths: int, seeds: list, sample_kwargs: dict):
+    eps, growth, decay, discount, pe_scenarios, current_prices = inputs
+    n_tickers = len(eps)
+    value_quantiles = np.full((n_tickers, len(QUANTILE_LEVELS)), np.nan)
+    means = np.full(n_tickers, np.nan)
+    prob_loss = np.full(n_tickers, np.nan)
+
+    for i in range(n_tickers):
+        if np.isnan(eps[i]) or np.isnan(pe_scenarios[i]).any():
+            continue
+        values = sample_DCF_values(eps[i], growth[i], decay[i], discount[i], pe_scenarios[i], n_paths,
+                                   np.random.default_rng(seeds[i]), **sample_kwargs)
+        value_quantiles[i] = np.quantile(values, QUANTILE_LEVELS)
+        means[i] = np.mean(values)
+        if not np.isnan(current_prices[i]):
+            prob_loss[i] = np.mean(values < current_prices[i])
+
+    return value_quantiles, means, prob_loss
+
+
+def run_monte_carlo_DCF(eps, three_year_eps_growth, decay_rate, discount_rate, pe_scenarios, current_prices=None,
+                        n_paths: int = 50000, seed: int = None, processes: int = None, tickers_per_task: int = 50,
+                        **sample_kwargs) -> dict:
+    """
+    Stochastic DCF for many tickers. Each ticker gets its own random stream spawned from seed, so results do not
+    depend on how tickers are split across processes.
+    :param eps: an array of current earnings per share
+    :param three_year_eps_growth: an array of YoY% EPS growth estimates
+    :param decay_rate: an array of EPS growth decay rates
+    :param discount_rate: an array of discount rates
+    :param pe_scenarios: a (tickers x 3) array of [low, middle, high] terminal pe ratios
+    :param current_prices: (optional) an array of current prices, used for the probability of loss
+    :param n_paths: default is 50,000. The number of paths sampled for each ticker.
+    :param seed: (optional) seed for reproducible results
+    :param processes: (optional) if > 1, tickers are valued across a process pool of this size
+    :param tickers_per_task: default is 50. The number of tickers sent to a worker at once.
+    :param sample_kwargs: keyword arguments for sample_DCF_values() (i.e., growth_std, decay_std, chunk_size)
+    :return: a dictionary with 'quantiles' (tickers x QUANTILE_LEVELS), 'mean' and 'prob_loss' arrays
+    """
+    pe_scenarios = np.asarray(pe_scenarios, dtype=np.float64)
+    n_tickers = len(pe_scenarios)
+    inputs = [np.broadcast_to(np.asarray(values, dtype=np.float64), n_tickers) for values in
+              (eps, three_year_eps_growth, decay_rate, discount_rate)]
+    if current_prices is None:
+        current_prices = np.full(n_tickers, np.nan)
+    current_prices = np.asarray(current_prices, dtype=np.float64)
+    seeds = np.random.SeedSequence(seed).spawn(n_tickers)
+
+    tasks = []
+    for start in range(0, n_tickers, tickers_per_task):
+        end = start + tickers_per_task
+        chunk_inputs = tuple(values[start:end] for values in inputs) + (pe_scenarios[start:end],
+                                                                        current_prices[start:end])
+        tasks.append((chunk_inputs, n_paths, seeds[start:end], sample_kwargs))
+
+    if processes and processes > 1 and len(tasks) > 1:
+        with ProcessPoolExecutor(max_workers=processes) as executor:
+            results = list(executor.map(_run_monte_carlo_chunk, *zip(*tasks)))
+    else:
+        results = [_run_monte_carlo_chunk(*task) for task in tasks]
+
+    if not results:
+        return {'quantiles': np.empty((0, len(QUANTILE_LEVELS))), 'mean': np.empty(0), 'prob_loss': np.empty(0)}
+
+    value_quantiles, means, prob_loss = zip(*results)
+    return {
+        'quantiles': np.concatenate(value_quantiles),
+        'mean': np.concatenate(means),
+        'prob_loss': np.concatenate(prob_loss),
+    }
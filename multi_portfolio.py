@@ -0,0 +1,140 @@
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+from classes import *
+from diagnostics import quiet, OFF
+
+
+def _create_shared_array(shape: tuple) -> tuple:
+    size = max(int(np.prod(shape)) * np.dtype(np.float64).itemsize, 1)
+    block = shared_memory.SharedMemory(create=True, size=size)
+    return block, np.ndarray(shape, dtype=np.float64, buffer=block.buf)
+
+
+def _attach_shared_array(name: str, shape: tuple) -> tuple:
+    # pool workers share the creating process's resource tracker, which stays responsible for unlinking
+    block = shared_memory.SharedMemory(name=name)
+    return block, np.ndarray(shape, dtype=np.float64, buffer=block.buf)
+
+
+class SharedMarketData:
+    """
+    Current prices and [low, middle, high] valuations for a ticker universe, held in multiprocessing shared memory so
+    worker processes read them without pickling a copy per task. Use as a context manager to free the memory.
+    """
+
+    def __init__(self, tickers: list, prices: np.ndarray, valuations: np.ndarray):
+        """
+        :param tickers: the universe of tickers
+        :param prices: an array of current prices matching tickers
+        :param valuations: a (tickers x 3) array of [low, middle, high] DCF valuations
+        """
+        self.tickers = list(tickers)
+        self.shapes = {'prices': (len(self.tickers),), 'valuations': (len(self.tickers), 3)}
+        self.blocks = {}
+        self.arrays = {}
+        for name, values in (('prices', prices), ('valuations', valuations)):
+            self.blocks[name], self.arrays[name] = _create_shared_array(self.shapes[name])
+            self.arrays[name][:] = values
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def get_handles(self) -> dict:
+        """
+        :return: a small picklable dictionary of {array name: (shared memory name, shape)} for worker processes
+        """
+        return {name: (block.name, self.shapes[name]) for name, block in self.blocks.items()}
+
+    def close(self):
+        self.arrays = {}
+        for block in self.blocks.values():
+            block.close()
+            block.unlink()
+        self.blocks = {}
+
+
+# shared arrays attached once per worker process
+_worker_state = {}
+
+
+def _init_worker(tickers: list, market_handles: dict, output_handle: tuple):
+    _worker_state['rows'] = {tick: row for row, tick in enumerate(tickers)}
+    _worker_state['blocks'] = []
+    for name, (block_name, shape) in list(market_handles.items()) + [('output', output_handle)]:
+        block, array = _attach_shared_array(block_name, shape)
+        _worker_state['blocks'].append(block)
+        _worker_state[name] = array
+
+
+def _evaluate_chunk(start: int, specs: list):
+    universe_rows = _worker_state['rows']
+    prices = _worker_state['prices']
+    valuations = _worker_state['valuations']
+    output = _worker_state['output']
+
+    with quiet(OFF):
+        for i, spec in enumerate(specs):
+            output[start + i] = evaluate_portfolio_spec(spec, universe_rows, prices, valuations)
+
+
+def evaluate_portfolio_spec(spec: dict, universe_rows: dict, prices: np.ndarray, valuations: np.ndarray) -> np.ndarray:
+    """
+    Builds one portfolio from a spec and computes its optimal allocations against shared market data
+    :param spec: a dictionary with 'positions' ({'TICKER': [# of shares, average price]}) and optional 'gamma', 'greed'
+    and 'conservativeness' keys
+    :param universe_rows: a dictionary mapping universe tickers to their index in prices/valuations
+    :param prices: an array of current prices for the universe
+    :param valuations: a (universe x 3) array of valuations
+    :return: an array of allocations over the universe, 0 for tickers the portfolio does not hold
+    """
+    portfolio = Portfolio(spec['positions'])
+    for parameter in ('gamma', 'greed', 'conservativeness'):
+        if spec.get(parameter) is not None:
+            setattr(portfolio, parameter, spec[parameter])
+
+    store = portfolio.store
+    universe_index = np.array([universe_rows[tick] for tick in store.tickers], dtype=np.intp)
+    store_rows = np.arange(len(store))
+    store.set_valuations(store_rows, valuations[universe_index])
+    portfolio.update_current_prices_array(prices[universe_index], store_rows)
+
+    portfolio.calculate_expected_roic()
+    allocations = portfolio.get_optimal_allocations(gamma=portfolio.gamma)
+
+    universe_allocations = np.zeros(len(prices))
+    universe_allocations[universe_index] = [allocations[tick] for tick in store.tickers]
+    return universe_allocations
+
+
+def evaluate_portfolios(specs: list, tickers: list, prices: np.ndarray, valuations: np.ndarray,
+                        processes: int = None, specs_per_task: int = 64) -> np.ndarray:
+    """
+    Evaluates Portfolio.calculate_expected_roic() and Portfolio.get_optimal_allocations() for many portfolio specs
+    against the same market data, across a process pool. Prices, valuations and the output are shared memory blocks,
+    so only the specs are pickled per task.
+    :param specs: a list of portfolio spec dictionaries, see evaluate_portfolio_spec()
+    :param tickers: the universe of tickers, every spec's positions must be in it
+    :param prices: an array of current prices matching tickers
+    :param valuations: a (tickers x 3) array of [low, middle, high] DCF valuations
+    :param processes: (optional) the number of worker processes, default is the number of cores
+    :param specs_per_task: default is 64. The number of specs sent to a worker at once.
+    :return: a (specs x tickers) array of optimal allocations
+    """
+    output_block, output = _create_shared_array((len(specs), len(tickers)))
+    try:
+        with SharedMarketData(tickers, prices, valuations) as market:
+            output_handle = (output_block.name, output.shape)
+            with ProcessPoolExecutor(max_workers=processes, initializer=_init_worker,
+                                     initargs=(list(tickers), market.get_handles(), output_handle)) as executor:
+                starts = list(range(0, len(specs), specs_per_task))
+                chunks = [specs[start:start + specs_per_task] for start in starts]
+                list(executor.map(_evaluate_chunk, starts, chunks))
+        return output.copy()
+    finally:
+        del output
+        output_block.close()
+        output_block.unlink()
@@ -0,0 +1,136 @@
+import heapq
+
+import numpy as np
+
+
+class IndexedMaxHeap:
+    """
+    A binary max-heap of row indices ordered by an external key array (i.e., a PositionStore's equity column), with
+    each row's heap position indexed so a changed key is re-sifted in O(log N). NaN keys are ordered as 0.
+    Bulk key changes mark the heap stale instead. The first read of a stale heap selects its top rows with one
+    argpartition, and the heap is only rebuilt (one argsort) if it is read again before the next bulk change.
+    The following user facing class functions are defined:
+    - IndexedMaxHeap.update(rows, keys): re-orders rows whose keys changed (or adds new rows)
+    - IndexedMaxHeap.invalidate(): marks every key as changed
+    - IndexedMaxHeap.top(n, keys) -> np.ndarray: the rows with the n largest keys, largest first
+    """
+
+    def __init__(self):
+        self.heap = np.empty(0, dtype=np.intp)  # heap index -> row
+        self.index = np.empty(0, dtype=np.intp)  # row -> heap index
+        self.size = 0
+        self.stale = True
+        self._stale_reads = 0  # reads since the heap was marked stale
+
+    def __len__(self):
+        return self.size
+
+    def invalidate(self):
+        self.stale = True
+        self._stale_reads = 0
+
+    def update(self, rows, keys: np.ndarray, max_sifts: int = None):
+        """
+        :param rows: a row or array of rows whose keys changed, rows >= len(self) are added
+        :param keys: the full key array
+        :param max_sifts: (optional) above this many rows the heap is marked stale instead of re-sifted, default is
+        max(8, len(keys) // 128)
+        """
+        rows = np.atleast_1d(rows)
+        if max_sifts is None:
+            max_sifts = max(8, len(keys) // 128)
+        if len(rows) > max_sifts:
+            self.invalidate()
+            return
+        if self.stale:
+            return
+
+        for row in rows.tolist():
+            if row >= self.size:
+                self._push(row, keys)
+            else:
+                position = self._sift_up(self.index[row], keys)
+                self._sift_down(position, keys)
+
+    def rebuild(self, keys: np.ndarray):
+        # rows sorted by descending key already satisfy the heap property
+        self.heap = np.argsort(-np.nan_to_num(keys), kind='stable').astype(np.intp)
+        self.index = np.empty(len(keys), dtype=np.intp)
+        self.index[self.heap] = np.arange(len(keys))
+        self.size = len(keys)
+        self.stale = False
+        self._stale_reads = 0
+
+    def top(self, n: int, keys: np.ndarray) -> np.ndarray:
+        """
+        Finds the n largest rows with a best first search from the root, O(n log n) once the heap is up to date
+        """
+        if self.size != len(keys):
+            self.stale = True
+        if self.stale:
+            self._stale_reads += 1
+            if self._stale_reads == 1:
+                return self._select_top(n, keys)
+            self.rebuild(keys)
+
+        rows = []
+        frontier = [(-self._key(keys, 0), 0)] if self.size else []
+        while frontier and len(rows) < n:
+            _, position = heapq.heappop(frontier)
+            rows.append(self.heap[position])
+            for child in (2 * position + 1, 2 * position + 2):
+                if child < self.size:
+                    heapq.heappush(frontier, (-self._key(keys, child), child))
+        return np.array(rows, dtype=np.intp)
+
+    # #### INTERNAL METHODS #####
+    @staticmethod
+    def _select_top(n: int, keys: np.ndarray) -> np.ndarray:
+        # O(N) selection of the n largest keys, then only those are sorted (ties by row, as in rebuild())
+        keys = -np.nan_to_num(keys)
+        if n <= 0:
+            return np.empty(0, dtype=np.intp)
+        rows = np.argpartition(keys, n - 1)[:n] if n < len(keys) else np.arange(len(keys))
+        return rows[np.lexsort((rows, keys[rows]))].astype(np.intp)
+
+    def _key(self, keys: np.ndarray, position: int) -> float:
+        value = keys[self.heap[position]]
+        return 0.0 if value != value else value
+
+    def _swap(self, i: int, j: int):
+        heap = self.heap
+        heap[i], heap[j] = heap[j], heap[i]
+        self.index[heap[i]] = i
+        self.index[heap[j]] = j
+
+    def _push(self, row: int, keys: np.ndarray):
+        if self.size == len(self.heap):
+            capacity = max(2 * len(self.heap), row + 1, 16)
+            self.heap = np.resize(self.heap, capacity)
+            self.index = np.resize(self.index, capacity)
+        elif row >= len(self.index):
+            self.index = np.resize(self.index, max(2 * len(self.index), row + 1))
+        self.heap[self.size] = row
+        self.index[row] = self.size
+        self.size += 1
+        self._sift_up(self.size - 1, keys)
+
+    def _sift_up(self, position: int, keys: np.ndarray) -> int:
+        while position > 0:
+            parent = (position - 1) // 2
+            if self._key(keys, parent) >= self._key(keys, position):
+                break
+            self._swap(parent, position)
+            position = parent
+        return position
+
+    def _sift_down(self, position: int, keys: np.ndarray) -> int:
+        while True:
+            largest = position
+            for child in (2 * position + 1, 2 * position + 2):
+                if child < self.size and self._key(keys, child) > self._key(keys, largest):
+                    largest = child
+            if largest == position:
+                return position
+            self._swap(position, largest)
+            position = largest
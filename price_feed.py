@@ -0,0 +1,232 @@
+import asyncio
+import time
+
+from classes import *
+from diagnostics import get_counters
+
+
+async def replay_ticks(events, batch_size: int = None, delay: float = 0):
+    """
+    Async source that replays an iterable of (ticker, price, timestamp) events, i.e., as a stand-in for a live feed
+    :param events: an iterable of (ticker, price, timestamp) tuples
+    :param batch_size: (optional) if given, events are yielded as lists of this many events
+    :param delay: default is 0. Seconds to sleep between yields, 0 still yields control to the event loop.
+    """
+    if not batch_size:
+        for event in events:
+            yield event
+            await asyncio.sleep(delay)
+        return
+
+    batch = []
+    for event in events:
+        batch.append(event)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+            await asyncio.sleep(delay)
+    if batch:
+        yield batch
+
+
+def _parse_tick_lines(lines: list, first_line: int = 1) -> list:
+    # blank lines are skipped, malformed lines are skipped and reported with their line numbers
+    events = []
+    malformed = []
+    for line_number, line in enumerate(lines, first_line):
+        fields = line.strip().split(',')
+        if fields == ['']:
+            continue
+        try:
+            ticker, price, timestamp = fields
+            events.append((ticker, float(price), float(timestamp)))
+        except ValueError:
+            malformed.append(line_number)
+    if malformed:
+        emit(WARNING, 'malformed_tick', 'Skipped {count} malformed tick lines (expected ticker,price,timestamp) at '
+             'lines: {lines}', count=len(malformed), lines=format_items(malformed))
+    return events
+
+
+def write_tick_file(path: str, events):
+    """
+    Writes (ticker, price, timestamp) events as 'ticker,price,timestamp' lines, the format read by read_tick_file()
+    """
+    with open(path, 'w') as f:
+        for ticker, price, timestamp in events:
+            f.write(f'{ticker},{price},{timestamp}\n')
+
+
+async def read_tick_file(path: str, batch_lines: int = 4096):
+    """
+    Async source that replays a file of 'ticker,price,timestamp' lines in batches. Blank lines are skipped, and
+    malformed lines are skipped with a 'malformed_tick' warning giving their line numbers.
+    """
+    with open(path) as f:
+        first_line = 1
+        while True:
+            lines = f.readlines(batch_lines * 32)
+            if not lines:
+                return
+            yield _parse_tick_lines(lines, first_line)
+            first_line += len(lines)
+            await asyncio.sleep(0)
+
+
+async def read_tick_socket(host: str, port: int, batch_lines: int = 4096):
+    """
+    Async source that reads 'ticker,price,timestamp' lines from a TCP socket until it is closed, yielding each burst of
+    available lines as a batch. Malformed lines are reported with their line number in the stream.
+    """
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        buffered = b''
+        first_line = 1
+        while True:
+            data = await reader.read(batch_lines * 32)
+            if not data:
+                break
+            buffered += data
+            complete, _, buffered = buffered.rpartition(b'\n')
+            if complete:
+                lines = complete.decode().split('\n')
+                yield _parse_tick_lines(lines, first_line)
+                first_line += len(lines)
+        if buffered.strip():
+            yield _parse_tick_lines([buffered.decode()], first_line)
+    finally:
+        writer.close()
+
+
+class PriceFeedIngestor:
+    """
+    Consumes an async iterator of (ticker, price, timestamp) events (or lists of them) and applies them to a
+    Portfolio in coalesced micro-batches, without per tick dictionary rebuilding or console output. Allocations are
+    re-optimized on a fixed schedule with the portfolio's incremental Portfolio.get_optimal_allocations().
+    The following user facing class functions are defined:
+    - await PriceFeedIngestor.run(source): consumes a source until it is exhausted
+    - PriceFeedIngestor.flush(): applies buffered ticks now
+    - PriceFeedIngestor.get_stats() -> dict: tick, batch and allocation latency counters
+    """
+
+    def __init__(self, portfolio: Portfolio, batch_size: int = 4096, max_batch_delay: float = 0.005,
+                 allocation_interval: float = 1.0, on_allocation=None, allocation_kwargs: dict = None):
+        """
+        :param portfolio: the Portfolio to apply prices to
+        :param batch_size: default is 4096. Buffered ticks are applied once this many arrive.
+        :param max_batch_delay: default is 0.005. Buffered ticks are applied at least this often (seconds).
+        :param allocation_interval: default is 1.0. Seconds between Portfolio.get_optimal_allocations() calls, None to
+        never allocate.
+        :param on_allocation: (optional) a callback called with (allocations dict, last tick timestamp)
+        :param allocation_kwargs: (optional) keyword arguments for Portfolio.get_optimal_allocations()
+        """
+        self.portfolio = portfolio
+        self.batch_size = batch_size
+        self.max_batch_delay = max_batch_delay
+        self.allocation_interval = allocation_interval
+        self.on_allocation = on_allocation
+        self.allocation_kwargs = allocation_kwargs or {}
+
+        self._tickers = []
+        self._prices = []
+        self._last_timestamp = None
+        self._last_allocation_time = time.monotonic()
+
+        self.allocations = None  # the latest optimal allocations
+        self.ticks_received = 0
+        self.ticks_applied = 0
+        self.unknown_ticks = 0
+        self.batches = 0
+        self.n_allocations = 0
+        self.max_allocation_latency = 0.0
+        self.total_allocation_latency = 0.0
+
+    async def run(self, source):
+        """
+        Consumes a source until it is exhausted, then applies any remaining ticks
+        :param source: an async iterator of (ticker, price, timestamp) tuples or lists of them
+        """
+        flusher = asyncio.create_task(self._flush_periodically())
+        try:
+            async for item in source:
+                if isinstance(item, list):
+                    for ticker, price, timestamp in item:
+                        self._tickers.append(ticker)
+                        self._prices.append(price)
+                    if item:
+                        self._last_timestamp = item[-1][2]
+                else:
+                    ticker, price, self._last_timestamp = item
+                    self._tickers.append(ticker)
+                    self._prices.append(price)
+
+                if len(self._tickers) >= self.batch_size:
+                    self.flush()
+        finally:
+            flusher.cancel()
+            self.flush()
+
+    def flush(self):
+        """
+        Applies buffered ticks as one coalesced update (the last price per ticker wins) and re-optimizes allocations if
+        the allocation interval has passed
+        """
+        if self._tickers:
+            tickers, prices = self._tickers, self._prices
+            self._tickers, self._prices = [], []
+            self._apply(tickers, prices)
+
+        if self.allocation_interval is not None:
+            now = time.monotonic()
+            if now - self._last_allocation_time >= self.allocation_interval:
+                self._allocate()
+                self._last_allocation_time = time.monotonic()
+
+    def get_stats(self) -> dict:
+        return {
+            'ticks_received': self.ticks_received,
+            'ticks_applied': self.ticks_applied,
+            'unknown_ticks': self.unknown_ticks,
+            # skipped by read_tick_file()/read_tick_socket(), counted process wide by the diagnostics channel
+            'malformed_ticks': get_counters().get('malformed_tick', {}).get('warning', 0),
+            'batches': self.batches,
+            'allocations': self.n_allocations,
+            'max_allocation_latency': self.max_allocation_latency,
+            'mean_allocation_latency': (self.total_allocation_latency / self.n_allocations
+                                        if self.n_allocations else 0.0),
+        }
+
+    # #### INTERNAL METHODS #####
+    async def _flush_periodically(self):
+        while True:
+            await asyncio.sleep(self.max_batch_delay)
+            self.flush()
+
+    def _apply(self, tickers: list, prices: list):
+        store_rows = self.portfolio.store.rows
+        rows = np.fromiter((store_rows.get(tick, -1) for tick in tickers), dtype=np.intp, count=len(tickers))
+        prices = np.array(prices, dtype=np.float64)
+
+        known = rows >= 0
+        self.ticks_received += len(rows)
+        self.unknown_ticks += int(len(rows) - np.count_nonzero(known))
+        rows, prices = rows[known], prices[known]
+
+        # keep the last tick for each row
+        unique_rows, last_index = np.unique(rows[::-1], return_index=True)
+        prices = prices[::-1][last_index]
+        self.portfolio.update_current_prices_array(prices, unique_rows)
+
+        self.ticks_applied += len(rows)
+        self.batches += 1
+
+    def _allocate(self):
+        start = time.perf_counter()
+        self.allocations = self.portfolio.get_optimal_allocations(**self.allocation_kwargs)
+        latency = time.perf_counter() - start
+
+        self.n_allocations += 1
+        self.total_allocation_latency += latency
+        self.max_allocation_latency = max(self.max_allocation_latency, latency)
+        if self.on_allocation is not None:
+            self.on_allocation(self.allocations, self._last_timestamp)
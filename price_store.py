@@ -0,0 +1,163 @@
+import argparse
+import csv
+import os
+
+import numpy as np
+
+# column name -> (Yahoo Finance CSV header, on disk dtype)
+PRICE_COLUMNS = {
+    'date': ('Date', np.dtype('datetime64[D]')),
+    'open': ('Open', np.dtype(np.float32)),
+    'high': ('High', np.dtype(np.float32)),
+    'low': ('Low', np.dtype(np.float32)),
+    'close': ('Close', np.dtype(np.float32)),
+    'adj_close': ('Adj Close', np.dtype(np.float32)),
+    'volume': ('Volume', np.dtype(np.int64)),
+}
+
+
+def _column_path(store_dir: str, ticker: str, column: str) -> str:
+    return os.path.join(store_dir, ticker, f'{column}.bin')
+
+
+def read_price_csv(csv_path: str) -> dict:
+    """
+    Parses a Yahoo Finance style daily price CSV (Date, Open, High, Low, Close, Adj Close, Volume)
+    :param csv_path: path to the CSV file
+    :return: a dictionary of numpy arrays keyed by the PRICE_COLUMNS names, sorted by date
+    """
+    with open(csv_path, newline='') as f:
+        reader = csv.DictReader(f)
+        # Yahoo writes 'null' for days without data
+        rows = [row for row in reader if row['Close'] not in ('', 'null')]
+
+    arrays = {}
+    for column, (header, dtype) in PRICE_COLUMNS.items():
+        values = [row[header] for row in rows]
+        if dtype.kind == 'i':
+            values = [float(value) for value in values]
+        arrays[column] = np.array(values).astype(dtype)
+
+    order = np.argsort(arrays['date'], kind='stable')
+    return {column: values[order] for column, values in arrays.items()}
+
+
+def ingest_csv(store_dir: str, csv_path: str, ticker: str = None) -> int:
+    """
+    Appends a CSV's rows to a ticker's binary columns. Only rows dated after the last stored date are written, so
+    re-ingesting an updated CSV appends the new rows without rewriting the existing files.
+    :param store_dir: the price store directory
+    :param csv_path: path to the CSV file
+    :param ticker: (optional) the ticker to store the rows under, default is the CSV file name (i.e., FB.csv -> FB)
+    :return: the number of rows appended
+    """
+    if not ticker:
+        ticker = os.path.splitext(os.path.basename(csv_path))[0]
+    os.makedirs(os.path.join(store_dir, ticker), exist_ok=True)
+
+    arrays = read_price_csv(csv_path)
+    stored_dates = _open_column(store_dir, ticker, 'date')
+    if len(stored_dates) > 0:
+        new_rows = arrays['date'] > stored_dates[-1]
+        arrays = {column: values[new_rows] for column, values in arrays.items()}
+    del stored_dates
+
+    for column, values in arrays.items():
+        with open(_column_path(store_dir, ticker, column), 'ab') as f:
+            f.write(values.tobytes())
+
+    return len(arrays['date'])
+
+
+def ingest_csv_dir(store_dir: str, csv_dir: str) -> dict:
+    """
+    Ingests every .csv file in a directory (i.e., demo_data/) into a price store
+    :return: a dictionary with the number of rows appended for each ticker
+    """
+    appended = {}
+    for file_name in sorted(os.listdir(csv_dir)):
+        if file_name.endswith('.csv'):
+            ticker = os.path.splitext(file_name)[0]
+            appended[ticker] = ingest_csv(store_dir, os.path.join(csv_dir, file_name), ticker)
+    return appended
+
+
+def _open_column(store_dir: str, ticker: str, column: str) -> np.ndarray:
+    path = _column_path(store_dir, ticker, column)
+    dtype = PRICE_COLUMNS[column][1]
+    if not os.path.exists(path) or os.path.getsize(path) == 0:
+        return np.empty(0, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode='r')
+
+
+class PriceStore:
+    """
+    Read access to a price store directory written by ingest_csv(). Every column is opened with numpy.memmap, so
+    windows returned by PriceStore.window() are zero-copy slices of the files on disk.
+    The following user facing class functions are defined:
+    - PriceStore.column(ticker, column) -> np.ndarray: the full memory-mapped column for a ticker
+    - PriceStore.window(ticker, start, end, column) -> (dates, values): zero-copy slices between two dates
+    - PriceStore.aligned_prices(tickers, start, end, column) -> (dates, tickers, prices): a dates x tickers array
+    - PriceStore.refresh(): re-opens the memory maps after new rows are ingested
+    """
+
+    def __init__(self, store_dir: str):
+        self.store_dir = store_dir
+        self._columns = {}
+
+    @property
+    def tickers(self) -> list:
+        return sorted([name for name in os.listdir(self.store_dir)
+                       if os.path.isdir(os.path.join(self.store_dir, name))])
+
+    def column(self, ticker: str, column: str = 'adj_close') -> np.ndarray:
+        key = (ticker, column)
+        if key not in self._columns:
+            self._columns[key] = _open_column(self.store_dir, ticker, column)
+        return self._columns[key]
+
+    def dates(self, ticker: str) -> np.ndarray:
+        return self.column(ticker, 'date')
+
+    def window(self, ticker: str, start=None, end=None, column: str = 'adj_close'):
+        """
+        Returns zero-copy slices of a ticker's dates and a price column between two dates
+        :param ticker: the ticker string
+        :param start: (optional) first date to include (datetime64 or 'YYYY-MM-DD'), default is the first stored date
+        :param end: (optional) last date to include, default is the last stored date
+        :param column: default is 'adj_close'. One of PRICE_COLUMNS.
+        :return: (dates, values) memory-mapped views
+        """
+        dates = self.dates(ticker)
+        first = 0 if start is None else np.searchsorted(dates, np.datetime64(start, 'D'), side='left')
+        last = len(dates) if end is None else np.searchsorted(dates, np.datetime64(end, 'D'), side='right')
+        return dates[first:last], self.column(ticker, column)[first:last]
+
+    def aligned_prices(self, tickers: list = None, start=None, end=None, column: str = 'adj_close'):
+        """
+        Aligns several tickers on a shared date index, in the same format as backtest.load_price_csvs()
+        :return: (dates, tickers, prices) where prices is a (dates x tickers) float64 array with NaN for missing days
+        """
+        if not tickers:
+            tickers = self.tickers
+
+        windows = [self.window(tick, start, end, column) for tick in tickers]
+        all_dates = np.unique(np.concatenate([dates for dates, _ in windows]))
+        prices = np.full((len(all_dates), len(tickers)), np.nan)
+        for i, (dates, values) in enumerate(windows):
+            prices[np.searchsorted(all_dates, dates), i] = values
+
+        return all_dates, list(tickers), prices
+
+    def refresh(self):
+        self._columns = {}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Ingest Yahoo Finance style price CSVs into a memory-mapped store')
+    parser.add_argument('csv_dir', help='directory of TICKER.csv files, i.e., demo_data')
+    parser.add_argument('store_dir', help='price store directory to create or append to')
+    args = parser.parse_args()
+
+    for tick, n_rows in ingest_csv_dir(args.store_dir, args.csv_dir).items():
+        print(f'{tick}: appended {n_rows} rows')
@@ -0,0 +1,252 @@
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from price_store import PriceStore
+
+# metric name -> description, every metric is a per ticker float array
+RISK_METRICS = {
+    'volatility': 'annualized standard deviation of daily log returns over the full history',
+    'rolling_volatility': 'annualized standard deviation of the last window daily log returns',
+    'beta': 'covariance with the benchmark returns divided by the benchmark variance, on days both have returns',
+    'max_drawdown': 'the largest fall from a running peak, as a fraction of the peak',
+    'downside_deviation': 'annualized root mean square of daily log returns below the minimum acceptable return',
+    'mean_return': 'annualized mean daily log return',
+}
+
+
+class RiskAccumulator:
+    """
+    Streaming per ticker risk statistics over chunks of a (dates x tickers) price array. Each chunk is processed with
+    array operations over every date and ticker at once, and only running sums, running peaks, the last prices and the
+    last window of returns are carried between chunks, so histories of any length are read with bounded memory.
+    The following user facing class functions are defined:
+    - RiskAccumulator.update(prices, benchmark_prices) -> (log returns, rolling volatility): adds a chunk of prices
+    - RiskAccumulator.get_metrics() -> dict: the RISK_METRICS arrays for everything added so far
+    """
+
+    def __init__(self, n_tickers: int, window: int = 63, periods_per_year: int = 252, minimum_return: float = 0.0):
+        """
+        :param n_tickers: the number of tickers (columns of each price chunk)
+        :param window: default is 63 (~3 months of trading days). The number of dates in the rolling volatility window.
+        :param periods_per_year: default is 252. The number of price dates per year, used to annualize.
+        :param minimum_return: default is 0. The annual minimum acceptable return for the downside deviation.
+        """
+        self.window = window
+        self.periods_per_year = periods_per_year
+        self.minimum_return = np.log1p(minimum_return) / periods_per_year  # as a daily log return
+
+        self.last_prices = np.full(n_tickers, np.nan)
+        self.last_benchmark_price = np.full(1, np.nan)
+        self.recent_returns = np.empty((0, n_tickers))  # the last window dates of returns, for rolling volatility
+
+        self.count = np.zeros(n_tickers)
+        self.sum = np.zeros(n_tickers)
+        self.sq_sum = np.zeros(n_tickers)
+        self.downside_sq_sum = np.zeros(n_tickers)
+
+        # sums over dates where both the ticker and the benchmark have a return
+        self.pair_count = np.zeros(n_tickers)
+        self.pair_sum = np.zeros(n_tickers)
+        self.pair_benchmark_sum = np.zeros(n_tickers)
+        self.pair_benchmark_sq_sum = np.zeros(n_tickers)
+        self.cross_sum = np.zeros(n_tickers)
+
+        # drawdowns are tracked in log price space relative to each ticker's first price
+        self.level = np.zeros(n_tickers)
+        self.peak = np.zeros(n_tickers)
+        self.max_log_drawdown = np.zeros(n_tickers)
+
+    def update(self, prices: np.ndarray, benchmark_prices: np.ndarray = None):
+        """
+        :param prices: a (dates x tickers) array of prices continuing the previous chunk, NaN if a ticker has no price
+        :param benchmark_prices: (optional) an array of benchmark prices for the same dates
+        :return: (log returns, rolling volatility) arrays with the shape of prices, a ticker's return after a missing
+        day spans the gap, and its rolling volatility is NaN until the window holds two returns
+        """
+        prices = np.asarray(prices, dtype=np.float64)
+        returns, self.last_prices = self._get_log_returns(prices, self.last_prices)
+        valid = ~np.isnan(returns)
+        filled = np.where(valid, returns, 0)
+
+        self.count += valid.sum(axis=0)
+        self.sum += filled.sum(axis=0)
+        self.sq_sum += (filled ** 2).sum(axis=0)
+        self.downside_sq_sum += (np.where(valid, np.minimum(filled - self.minimum_return, 0), 0) ** 2).sum(axis=0)
+
+        if benchmark_prices is not None:
+            benchmark_prices = np.asarray(benchmark_prices, dtype=np.float64)[:, np.newaxis]
+            benchmark_returns, self.last_benchmark_price = self._get_log_returns(benchmark_prices,
+                                                                                 self.last_benchmark_price)
+            pair = valid & ~np.isnan(benchmark_returns)
+            pair_returns = np.where(pair, filled, 0)
+            pair_benchmark = np.where(pair, benchmark_returns, 0)
+            self.pair_count += pair.sum(axis=0)
+            self.pair_sum += pair_returns.sum(axis=0)
+            self.pair_benchmark_sum += pair_benchmark.sum(axis=0)
+            self.pair_benchmark_sq_sum += (pair_benchmark ** 2).sum(axis=0)
+            self.cross_sum += (pair_returns * pair_benchmark).sum(axis=0)
+
+        levels = self.level + np.cumsum(filled, axis=0)
+        if len(levels):
+            peaks = np.maximum.accumulate(np.vstack([self.peak, levels]), axis=0)[1:]
+            self.max_log_drawdown = np.minimum(self.max_log_drawdown, np.min(levels - peaks, axis=0))
+            self.level, self.peak = levels[-1], peaks[-1]
+
+        return returns, self._get_rolling_volatility(returns)
+
+    def get_metrics(self) -> dict:
+        """
+        :return: a dictionary of RISK_METRICS arrays and 'n_returns', NaN where a ticker has too few returns
+        """
+        annualize = np.sqrt(self.periods_per_year)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = self.sum / self.count
+            variance = (self.sq_sum - (self.sum * mean)) / (self.count - 1)
+            covariance = (self.cross_sum - (self.pair_sum * self.pair_benchmark_sum / self.pair_count)) / \
+                (self.pair_count - 1)
+            benchmark_variance = (self.pair_benchmark_sq_sum - (self.pair_benchmark_sum ** 2 / self.pair_count)) / \
+                (self.pair_count - 1)
+            downside = np.sqrt(self.downside_sq_sum / self.count) * annualize
+
+        rolling_volatility = self._get_rolling_volatility(np.empty((0, len(self.count))), include_last=True)
+        has_returns = self.count > 0
+        return {
+            'volatility': np.where(self.count > 1, np.sqrt(np.maximum(variance, 0)) * annualize, np.nan),
+            'rolling_volatility': rolling_volatility,
+            'beta': np.where((self.pair_count > 1) & (benchmark_variance > 0), covariance / benchmark_variance, np.nan),
+            'max_drawdown': np.where(has_returns, 1 - np.exp(self.max_log_drawdown), np.nan),
+            'downside_deviation': np.where(has_returns, downside, np.nan),
+            'mean_return': mean * self.periods_per_year,
+            'n_returns': self.count.copy(),
+        }
+
+    # #### INTERNAL METHODS #####
+    @staticmethod
+    def _get_log_returns(prices: np.ndarray, last_prices: np.ndarray):
+        # each return is against the ticker's last known price, carried forward over missing days
+        previous = np.vstack([last_prices, prices])
+        has_price = ~np.isnan(previous)
+        index = np.where(has_price, np.arange(len(previous))[:, np.newaxis], 0)
+        filled = np.take_along_axis(previous, np.maximum.accumulate(index, axis=0), axis=0)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            returns = np.where(has_price[1:], np.log(prices / filled[:-1]), np.nan)
+        return returns, filled[-1]
+
+    def _get_rolling_volatility(self, returns: np.ndarray, include_last: bool = False) -> np.ndarray:
+        # prefix sums over the carried window followed by this chunk give every window's sums in O(1)
+        combined = np.vstack([self.recent_returns, returns])
+        valid = ~np.isnan(combined)
+        filled = np.where(valid, combined, 0)
+        zeros = np.zeros((1, combined.shape[1]))
+        counts = np.vstack([zeros, np.cumsum(valid, axis=0)])
+        sums = np.vstack([zeros, np.cumsum(filled, axis=0)])
+        squares = np.vstack([zeros, np.cumsum(filled ** 2, axis=0)])
+
+        ends = np.arange(len(self.recent_returns) + 1, len(combined) + 1)
+        if include_last:
+            ends = np.array([len(combined)])
+        else:
+            self.recent_returns = combined[-self.window:]
+        starts = np.maximum(ends - self.window, 0)
+
+        count = counts[ends] - counts[starts]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            total = sums[ends] - sums[starts]
+            variance = (squares[ends] - squares[starts] - (total ** 2 / count)) / (count - 1)
+        volatility = np.where(count > 1, np.sqrt(np.maximum(variance, 0)) * np.sqrt(self.periods_per_year), np.nan)
+        return volatility[0] if include_last else volatility
+
+
+def iter_price_chunks(price_store: PriceStore, tickers: list, chunk_size: int = 4096, start=None, end=None,
+                      column: str = 'adj_close'):
+    """
+    Yields a PriceStore's prices for several tickers in date order, chunk_size dates at a time, so only one chunk of
+    the memory-mapped columns is aligned in memory at once
+    :return: a generator of (dates, prices) with prices a (dates x tickers) float64 array, NaN for missing days
+    """
+    windows = [price_store.window(tick, start, end, column)[0] for tick in tickers]
+    all_dates = np.unique(np.concatenate(windows)) if windows else np.empty(0, dtype='datetime64[D]')
+    for first in range(0, len(all_dates), chunk_size):
+        chunk_dates = all_dates[first:first + chunk_size]
+        _, _, prices = price_store.aligned_prices(tickers, chunk_dates[0], chunk_dates[-1], column)
+        yield chunk_dates, prices
+
+
+def compute_risk_metrics(prices: np.ndarray, benchmark_prices: np.ndarray = None, chunk_size: int = None,
+                         return_series: bool = False, **accumulator_kwargs) -> dict:
+    """
+    Computes RISK_METRICS for every column of a (dates x tickers) price array in one pass, i.e., from
+    backtest.load_price_csvs() or PriceStore.aligned_prices()
+    :param prices: a (dates x tickers) array of prices, NaN on days a ticker has no data
+    :param benchmark_prices: (optional) an array of benchmark prices for the same dates, needed for beta
+    :param chunk_size: (optional) the number of dates processed at once, default is all of them
+    :param return_series: default is False. If True, the (dates x tickers) 'log_returns' and 'rolling_volatilities'
+    arrays are included.
+    :param accumulator_kwargs: keyword arguments for RiskAccumulator (i.e., window, periods_per_year, minimum_return)
+    :return: a dictionary of RISK_METRICS arrays in column order
+    """
+    prices = np.asarray(prices, dtype=np.float64)
+    accumulator = RiskAccumulator(prices.shape[1], **accumulator_kwargs)
+    chunk_size = chunk_size or max(len(prices), 1)
+
+    series = []
+    for first in range(0, len(prices), chunk_size):
+        benchmark_chunk = None if benchmark_prices is None else benchmark_prices[first:first + chunk_size]
+        chunk_series = accumulator.update(prices[first:first + chunk_size], benchmark_chunk)
+        if return_series:
+            series.append(chunk_series)
+
+    metrics = accumulator.get_metrics()
+    if return_series:
+        empty = np.empty((0, prices.shape[1]))
+        metrics['log_returns'] = np.vstack([empty] + [returns for returns, _ in series])
+        metrics['rolling_volatilities'] = np.vstack([empty] + [volatility for _, volatility in series])
+    return metrics
+
+
+def _run_risk_task(store_dir: str, tickers: list, benchmark: str, chunk_size: int, start, end, column: str,
+                   accumulator_kwargs: dict) -> dict:
+    price_store = PriceStore(store_dir)
+    accumulator = RiskAccumulator(len(tickers), **accumulator_kwargs)
+    # the benchmark is read alongside each group of tickers so their dates line up
+    read_tickers = list(tickers) + ([benchmark] if benchmark else [])
+    for _, prices in iter_price_chunks(price_store, read_tickers, chunk_size, start, end, column):
+        accumulator.update(prices[:, :len(tickers)], prices[:, -1] if benchmark else None)
+    return accumulator.get_metrics()
+
+
+def run_risk_pipeline(store_dir: str, tickers: list = None, benchmark: str = None, processes: int = None,
+                      tickers_per_task: int = 64, chunk_size: int = 4096, start=None, end=None,
+                      column: str = 'adj_close', **accumulator_kwargs) -> dict:
+    """
+    Streams a price store (see price_store.py) through RiskAccumulator for many tickers. Tickers are split into groups
+    that each read their own memory-mapped columns chunk by chunk, optionally across a process pool.
+    :param store_dir: the price store directory
+    :param tickers: (optional) a list of tickers, default is every ticker in the store except the benchmark
+    :param benchmark: (optional) a ticker in the store to measure beta against (i.e., 'SPY')
+    :param processes: (optional) if > 1, groups of tickers are processed across a process pool of this size
+    :param tickers_per_task: default is 64. The number of tickers sent to a worker at once.
+    :param chunk_size: default is 4096. The number of dates read at once.
+    :param start: (optional) first date to include (datetime64 or 'YYYY-MM-DD')
+    :param end: (optional) last date to include
+    :param column: default is 'adj_close'. The price column to use.
+    :param accumulator_kwargs: keyword arguments for RiskAccumulator (i.e., window, periods_per_year, minimum_return)
+    :return: a dictionary with 'tickers' and RISK_METRICS arrays in tickers order, see Portfolio.set_risk_metrics()
+    """
+    if not tickers:
+        tickers = [tick for tick in PriceStore(store_dir).tickers if tick != benchmark]
+    tickers = list(tickers)
+
+    tasks = [(store_dir, tickers[first:first + tickers_per_task], benchmark, chunk_size, start, end, column,
+              accumulator_kwargs) for first in range(0, len(tickers), tickers_per_task)]
+    if processes and processes > 1 and len(tasks) > 1:
+        with ProcessPoolExecutor(max_workers=processes) as executor:
+            results = list(executor.map(_run_risk_task, *zip(*tasks)))
+    else:
+        results = [_run_risk_task(*task) for task in tasks]
+
+    metrics = {'tickers': tickers}
+    for name in list(RISK_METRICS) + ['n_returns']:
+        metrics[name] = np.concatenate([result[name] for result in results]) if results else np.empty(0)
+    return metrics
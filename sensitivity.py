@@ -0,0 +1,146 @@
+from concurrent.futures import ProcessPoolExecutor
+
+from classes import *
+
+# allocation tensor axes, in order, before the trailing ticker axis
+SENSITIVITY_PARAMETERS = ('gamma', 'greed', 'conservativeness', 'decay_rate')
+
+
+def _get_grid_inputs(portfolio: Portfolio, decay_rates: np.ndarray, conservativeness: np.ndarray, gammas: np.ndarray,
+                     correlation_gamma: float = None, eta: float = 0.95) -> tuple:
+    """
+    Everything the allocation tensor is built from: expected returns for each (conservativeness, decay rate) pair and
+    the (gamma x tickers) balance factors. If decay_rates is None, each position's own decay rate is used.
+    """
+    store = portfolio.store
+    prices = store['current_price']
+    if decay_rates is None:
+        decay_rates = store['decay_rate'][np.newaxis, :]
+    else:
+        decay_rates = np.broadcast_to(decay_rates[:, np.newaxis], (len(decay_rates), len(store)))
+
+    # re-value every position with recorded DCF inputs at each decay rate, (decay rates x tickers x 3)
+    valuations = np.broadcast_to(store['valuations'], (len(decay_rates),) + store['valuations'].shape).copy()
+    has_inputs = ~np.isnan(store['eps'])
+    if has_inputs.any():
+        valuations[:, has_inputs] = run_batch_DCF_valuation(store['eps'][has_inputs], store['eps_growth'][has_inputs],
+                                                            decay_rates[:, has_inputs],
+                                                            store['discount_rate'][has_inputs],
+                                                            store['pe_scenarios'][has_inputs])
+
+    # the same scenario weightings as Portfolio._get_scenario_weightings(), (conservativeness x 3)
+    scenario_weights = np.stack([conservativeness / 2, np.full(len(conservativeness), 0.5),
+                                 (1 - conservativeness) / 2], axis=1)
+    raw_valuations = np.einsum('dnk,ck->cdn', valuations, scenario_weights)
+    expected_returns = np.maximum(np.nan_to_num((raw_valuations - prices) / prices), 0)
+
+    # the balance and position-evener scores depend on gamma alone, the correlation scores on none of the parameters
+    mean, std = store.get_allocation_stats()
+    if std == 0:
+        balance_scores = np.zeros((len(gammas), len(store)))
+    else:
+        z_scores = ((np.nan_to_num(store['equity']) / store.equity_sum) - mean) / std
+        balance_scores = np.clip(-z_scores * gammas[:, np.newaxis], -eta, eta)
+    if portfolio.evener_top_n:
+        balance_scores = balance_scores + np.stack([portfolio._get_overbalance_scores(gamma) for gamma in gammas])
+    if portfolio.correlation is not None:
+        balance_scores = balance_scores + portfolio._get_correlation_scores(correlation_gamma, eta)
+    balance_factors = np.maximum(1 + balance_scores, 0)
+
+    return expected_returns, balance_factors
+
+
+def _get_allocation_chunk(expected_returns: np.ndarray, balance_factors: np.ndarray, greeds: np.ndarray) -> np.ndarray:
+    """
+    :return: a (gamma x greed x conservativeness x decay rate x tickers) array of normalized allocations
+    """
+    exponents = get_greed_exponent(greeds)[:, np.newaxis, np.newaxis, np.newaxis]
+    greedy_returns = expected_returns[np.newaxis] ** exponents
+    allocations = greedy_returns[np.newaxis] * balance_factors[:, np.newaxis, np.newaxis, np.newaxis, :]
+    totals = np.sum(allocations, axis=-1, keepdims=True)
+    np.divide(allocations, totals, out=allocations, where=totals > 0)
+    return allocations
+
+
+def get_allocation_sensitivities(allocations: np.ndarray, grid: dict) -> tuple:
+    """
+    Measures how much allocations move across each parameter's grid range. A parameter's sensitivity is the portfolio
+    turnover (half the summed absolute allocation changes) from stepping it across its whole range, averaged over every
+    other grid point. Gamma slices are processed one at a time to bound memory.
+    :param allocations: a (gamma x greed x conservativeness x decay rate x tickers) allocation tensor
+    :param grid: a dictionary of the parameter values along each axis, keyed by SENSITIVITY_PARAMETERS
+    :return: (a dictionary of parameter: sensitivity, a dictionary of parameter: per ticker sensitivity array)
+    """
+    n_gammas = allocations.shape[0]
+    ticker_sensitivities = {param: np.zeros(allocations.shape[-1]) for param in SENSITIVITY_PARAMETERS}
+    for g in range(n_gammas):
+        for axis, param in enumerate(SENSITIVITY_PARAMETERS[1:]):
+            if allocations.shape[axis + 1] > 1:
+                changes = np.abs(np.diff(allocations[g], axis=axis)).sum(axis=axis)
+                ticker_sensitivities[param] += changes.reshape(-1, allocations.shape[-1]).mean(axis=0) / n_gammas
+        if g > 0:
+            changes = np.abs(allocations[g] - allocations[g - 1])
+            ticker_sensitivities['gamma'] += changes.reshape(-1, allocations.shape[-1]).mean(axis=0)
+
+    sensitivities = {param: float(np.sum(ticker_sensitivities[param]) / 2) for param in grid}
+    return sensitivities, ticker_sensitivities
+
+
+def run_sensitivity_grid(portfolio: Portfolio, gammas: list = None, greeds: list = None,
+                         conservativeness: list = None, decay_rates: list = None, correlation_gamma: float = None,
+                         processes: int = None, greeds_per_task: int = 5) -> dict:
+    """
+    Computes Portfolio.get_optimal_allocations() for every combination of the parameter grids with broadcast numpy
+    operations, without changing the portfolio. Decay rates re-value positions with recorded DCF inputs (see
+    Portfolio.run_batch_dcf()) and the scenario valuations are used in every valuation_mode.
+    :param portfolio: a Portfolio with valuations and current prices
+    :param gammas: (optional) portfolio balancer weights, default is the portfolio's gamma
+    :param greeds: (optional) greed values, default is the portfolio's greed
+    :param conservativeness: (optional) conservativeness values, default is the portfolio's conservativeness
+    :param decay_rates: (optional) EPS growth decay rates applied to every position, default is each position's own
+    :param correlation_gamma: (optional) the correlation minimizer weight, only used if correlations are tracked
+    :param processes: (optional) if > 1, chunks of the greed axis are evaluated across a process pool of this size
+    :param greeds_per_task: default is 5. The number of greed values evaluated at once, bounding intermediate memory.
+    :return: a dictionary with 'tickers', 'grid' (the parameter values along each axis), 'allocations' (a gamma x greed x
+    conservativeness x decay rate x tickers array), 'sensitivities' (parameter: turnover across its range),
+    'ticker_sensitivities' (parameter: per ticker array) and 'ranking' (parameters, most sensitive first)
+    """
+    grid = {
+        'gamma': gammas if gammas is not None else [portfolio.gamma],
+        'greed': greeds if greeds is not None else [portfolio.greed],
+        'conservativeness': conservativeness if conservativeness is not None else [portfolio.conservativeness],
+        'decay_rate': decay_rates,
+    }
+    grid = {param: np.atleast_1d(np.asarray(values, dtype=np.float64)) for param, values in grid.items()
+            if values is not None}
+
+    store = portfolio.store
+    expected_returns, balance_factors = _get_grid_inputs(portfolio, grid.get('decay_rate'), grid['conservativeness'],
+                                                         grid['gamma'], correlation_gamma)
+
+    greeds = grid['greed']
+    shape = (len(grid['gamma']), len(greeds)) + expected_returns.shape
+    allocations = np.empty(shape)
+    starts = list(range(0, len(greeds), greeds_per_task))
+    chunks = [greeds[start:start + greeds_per_task] for start in starts]
+
+    if processes and processes > 1 and len(chunks) > 1:
+        with ProcessPoolExecutor(max_workers=processes) as executor:
+            results = executor.map(_get_allocation_chunk, [expected_returns] * len(chunks),
+                                   [balance_factors] * len(chunks), chunks)
+            for start, chunk_allocations in zip(starts, results):
+                allocations[:, start:start + greeds_per_task] = chunk_allocations
+    else:
+        for start, chunk in zip(starts, chunks):
+            allocations[:, start:start + greeds_per_task] = _get_allocation_chunk(expected_returns, balance_factors,
+                                                                                  chunk)
+
+    sensitivities, ticker_sensitivities = get_allocation_sensitivities(allocations, grid)
+    return {
+        'tickers': list(store.tickers),
+        'grid': grid,
+        'allocations': allocations,
+        'sensitivities': sensitivities,
+        'ticker_sensitivities': {param: ticker_sensitivities[param] for param in grid},
+        'ranking': sorted(sensitivities, key=sensitivities.get, reverse=True),
+    }
@@ -0,0 +1,446 @@
+import json
+import os
+
+from classes import *
+
+SNAPSHOT_MAGIC = b'PFOSNAP\x00'
+SNAPSHOT_VERSION = 1
+JOURNAL_MAGIC = b'PFOJRNL\x00'
+JOURNAL_VERSION = 2
+
+# arrays in a snapshot start at multiples of this many bytes
+_ALIGNMENT = 64
+
+# fixed size journal records, a torn record at the end of the file (i.e., after a crash) is ignored
+_JOURNAL_FIELDS = [
+    ('sequence', '<i8'),
+    ('kind', 'u1'),
+    ('row', '<i8'),
+    ('lot', '<i8'),  # the lot a sale was matched against
+    ('shares', '<f8'),
+    ('price', '<f8'),
+    ('date', '<M8[D]'),
+    ('ticker', 'S32'),  # only set for new positions
+]
+JOURNAL_RECORD = np.dtype(_JOURNAL_FIELDS + [
+    ('values', '<f8', (5,)),  # RATES: [decay rate, discount rate], DCF: [eps, eps growth, *pe scenarios]
+])
+# version 1 journals have no values field, they are upgraded when opened for appending
+_JOURNAL_RECORDS = {1: np.dtype(_JOURNAL_FIELDS), 2: JOURNAL_RECORD}
+OPEN, BUY, SELL, PRICE, RATES, DCF = 1, 2, 3, 4, 5, 6
+
+# LotLedger running totals, stored as one array per total
+_LEDGER_TOTALS = ('open_shares', 'open_cost', 'realized_gain', '_first_open')
+
+# StreamingCorrelation running statistics
+_CORRELATION_ARRAYS = ('mean', 'cov', 'last_prices', 'counts', 'pair_counts')
+
+# Portfolio attributes written to the snapshot header
+_PORTFOLIO_PARAMETERS = ('conservativeness', 'greed', 'gamma', 'valuation_mode', 'correlation_gamma',
+                         'evener_top_n', 'solver_iterations')
+
+
+class PortfolioJournal:
+    """
+    Append-only binary log of new positions, buys, sells, price updates, decay and discount rate changes and DCF inputs
+    made since the last snapshot. Attach it to a Portfolio with attach_journal(), and load_snapshot() replays it on top
+    of the snapshot it follows, re-running the journaled DCF valuations.
+    Every record has a sequence number, snapshots store the next one, so records already in a snapshot are skipped.
+    Other changes (i.e., risk metrics, Monte Carlo quantiles and Portfolio parameters) are only saved by the next
+    snapshot.
+    """
+
+    def __init__(self, path: str, start_sequence: int = 0, sync: bool = False):
+        """
+        :param path: the journal file path, appended to if it exists
+        :param start_sequence: default is 0. The first sequence number if the journal is new.
+        :param sync: default is False. If True, every write is fsync'ed to disk before returning.
+        """
+        self.path = path
+        self.sync = sync
+        if os.path.exists(path) and os.path.getsize(path) > 0:
+            base_sequence, records = read_journal(path)
+            self.sequence = int(records['sequence'][-1]) + 1 if len(records) else base_sequence
+            if _read_journal_header(path)[0] < JOURNAL_VERSION:
+                # rewrite older journals in the current record layout, keeping their sequence numbers
+                next_sequence, self.sequence = self.sequence, base_sequence
+                self._file = open(path, 'wb')
+                self._write_header()
+                self._file.write(records.tobytes())
+                self._flush()
+                self.sequence = next_sequence
+            else:
+                # drop any torn record so new records stay aligned
+                with open(path, 'r+b') as f:
+                    f.truncate(_journal_header_size() + len(records) * JOURNAL_RECORD.itemsize)
+                self._file = open(path, 'ab')
+        else:
+            self.sequence = start_sequence
+            self._file = open(path, 'wb')
+            self._write_header()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def record_open(self, ticker):
+        record = np.zeros(1, dtype=JOURNAL_RECORD)
+        record['kind'] = OPEN
+        record['ticker'] = str(ticker).encode()
+        self._write(record)
+
+    def record_prices(self, rows, prices):
+        rows = np.atleast_1d(rows)
+        records = np.zeros(len(rows), dtype=JOURNAL_RECORD)
+        records['kind'] = PRICE
+        records['row'] = rows
+        records['price'] = prices
+        self._write(records)
+
+    def record_lots(self, row: int, lots: LotLedger, first_lot: int, first_sale: int):
+        """
+        Logs lots from first_lot on as buys and sales from first_sale on as sales of their matched lots
+        """
+        new_lots = slice(first_lot, len(lots.lots))
+        new_sales = slice(first_sale, len(lots.sales))
+        n_buys = new_lots.stop - new_lots.start
+        records = np.zeros(n_buys + new_sales.stop - new_sales.start, dtype=JOURNAL_RECORD)
+        records['row'] = row
+        records['kind'][:n_buys] = BUY
+        records['kind'][n_buys:] = SELL
+        records['lot'][n_buys:] = lots.sales['lot'][new_sales]
+        for column in ('shares', 'price', 'date'):
+            records[column][:n_buys] = lots.lots[column][new_lots]
+            records[column][n_buys:] = lots.sales[column][new_sales]
+        self._write(records)
+
+    def record_rates(self, rows, store: PositionStore):
+        """
+        Logs the current decay and discount rates of store rows
+        """
+        rows = np.atleast_1d(rows)
+        records = np.zeros(len(rows), dtype=JOURNAL_RECORD)
+        records['kind'] = RATES
+        records['row'] = rows
+        records['values'][:, 0] = store['decay_rate'][rows]
+        records['values'][:, 1] = store['discount_rate'][rows]
+        self._write(records)
+
+    def record_dcf_inputs(self, rows, store: PositionStore):
+        """
+        Logs the current DCF inputs (eps, eps_growth, pe_scenarios) of store rows
+        """
+        rows = np.atleast_1d(rows)
+        records = np.zeros(len(rows), dtype=JOURNAL_RECORD)
+        records['kind'] = DCF
+        records['row'] = rows
+        records['values'][:, 0] = store['eps'][rows]
+        records['values'][:, 1] = store['eps_growth'][rows]
+        records['values'][:, 2:] = store['pe_scenarios'][rows]
+        self._write(records)
+
+    def reset(self):
+        """
+        Empties the journal (i.e., after a snapshot), sequence numbers continue from where they were
+        """
+        self._file.seek(0)
+        self._file.truncate()
+        self._write_header()
+
+    def close(self):
+        self._file.close()
+
+    # #### INTERNAL METHODS #####
+    def _write_header(self):
+        self._file.write(JOURNAL_MAGIC + np.array([JOURNAL_VERSION], dtype='<u4').tobytes() + b'\x00' * 4 +
+                         np.array([self.sequence], dtype='<i8').tobytes())
+        self._flush()
+
+    def _write(self, records: np.ndarray):
+        if len(records) == 0:
+            return
+        records['sequence'] = np.arange(self.sequence, self.sequence + len(records))
+        self.sequence += len(records)
+        self._file.write(records.tobytes())
+        self._flush()
+
+    def _flush(self):
+        self._file.flush()
+        if self.sync:
+            os.fsync(self._file.fileno())
+
+
+def _journal_header_size() -> int:
+    return len(JOURNAL_MAGIC) + 16
+
+
+def _read_journal_header(path: str) -> tuple:
+    with open(path, 'rb') as f:
+        header = f.read(_journal_header_size())
+    if header[:len(JOURNAL_MAGIC)] != JOURNAL_MAGIC:
+        raise ValueError(f'{path} is not a portfolio journal')
+    version = int(np.frombuffer(header, dtype='<u4', count=1, offset=len(JOURNAL_MAGIC))[0])
+    if version > JOURNAL_VERSION:
+        raise ValueError(f'{path} is journal version {version}, only versions <= {JOURNAL_VERSION} can be read')
+    base_sequence = int(np.frombuffer(header, dtype='<i8', count=1, offset=len(JOURNAL_MAGIC) + 8)[0])
+    return version, base_sequence
+
+
+def read_journal(path: str) -> tuple:
+    """
+    :return: (the journal's base sequence number, a structured array of its complete JOURNAL_RECORD records), records
+    of older journal versions are converted to JOURNAL_RECORD
+    """
+    version, base_sequence = _read_journal_header(path)
+    with open(path, 'rb') as f:
+        f.seek(_journal_header_size())
+        data = f.read()
+    record_dtype = _JOURNAL_RECORDS[version]
+    records = np.frombuffer(data, dtype=record_dtype, count=len(data) // record_dtype.itemsize)
+    if record_dtype != JOURNAL_RECORD:
+        converted = np.zeros(len(records), dtype=JOURNAL_RECORD)
+        for name in record_dtype.names:
+            converted[name] = records[name]
+        records = converted
+    return base_sequence, records
+
+
+def attach_journal(portfolio: Portfolio, path: str, start_sequence: int = 0, sync: bool = False) -> PortfolioJournal:
+    """
+    Starts journaling a portfolio's new positions, trades, price updates, rate changes and DCF inputs to path, see
+    PortfolioJournal
+    """
+    journal = PortfolioJournal(path, start_sequence=start_sequence, sync=sync)
+    portfolio.store.journal = journal
+    return journal
+
+
+def replay_journal(portfolio: Portfolio, path: str, from_sequence: int = 0) -> int:
+    """
+    Applies a journal's records with sequence numbers >= from_sequence to a portfolio. Consecutive price updates, rate
+    changes and DCF inputs are each applied as one array update, and journaled DCF inputs are re-valued.
+    :return: the number of records applied
+    """
+    _, records = read_journal(path)
+    records = records[records['sequence'] >= from_sequence]
+
+    store = portfolio.store
+    journal, store.journal = store.journal, None
+    try:
+        # split into runs of the same kind, so price runs are vectorized
+        run_starts = np.flatnonzero(np.diff(records['kind'], prepend=-1))
+        for run in np.split(records, run_starts[1:]):
+            if len(run) == 0:
+                continue
+            kind = run['kind'][0]
+            if kind in (PRICE, RATES, DCF):
+                # the last record for each row wins
+                rows, last = np.unique(run['row'][::-1], return_index=True)
+                latest = run[::-1][last]
+                if kind == PRICE:
+                    store.update_prices(rows, latest['price'])
+                elif kind == RATES:
+                    store['decay_rate'][rows] = latest['values'][:, 0]
+                    store['discount_rate'][rows] = latest['values'][:, 1]
+                    store.mark_stale_valuations(rows)
+                else:
+                    portfolio._set_dcf_inputs(rows, latest['values'][:, 0], latest['values'][:, 1],
+                                              latest['values'][:, 2:])
+                continue
+            for record in run:
+                date = None if np.isnat(record['date']) else record['date']
+                if kind == OPEN:
+                    tick = record['ticker'].decode()
+                    portfolio.positions[tick] = Position(ticker=tick, store=store)
+                    portfolio.tickers.append(tick)
+                elif kind == BUY:
+                    portfolio.positions[store.tickers[record['row']]].make_a_buy(float(record['shares']),
+                                                                                  float(record['price']), date)
+                elif kind == SELL:
+                    portfolio.positions[store.tickers[record['row']]].make_a_sell(
+                        float(record['shares']), float(record['price']), method='specific', lot_ids=[record['lot']],
+                        date=date)
+    finally:
+        store.journal = journal
+    return len(records)
+
+
+class _SnapshotLots:
+    """
+    Builds a restored position's LotLedger from the snapshot's concatenated lot and sale columns, see Position.lots
+    """
+
+    def __init__(self, tables: dict, totals: dict):
+        self.tables = tables  # table name -> (offsets, {column name: values})
+        self.totals = totals
+
+    def __call__(self, row: int) -> LotLedger:
+        ledger_tables = {}
+        for table, (offsets, columns) in self.tables.items():
+            ledger_tables[table] = {name: values[offsets[row]:offsets[row + 1]] for name, values in columns.items()}
+        return LotLedger.from_arrays(ledger_tables['lots'], ledger_tables['sales'],
+                                     *[self.totals[name][row] for name in _LEDGER_TOTALS])
+
+
+def save_snapshot(portfolio: Portfolio, path: str) -> str:
+    """
+    Writes a portfolio's state (positions, lots, valuations, expected returns, scores, correlations and parameters) to
+    a versioned binary file of columnar arrays. The file is written to a temporary path and then renamed, so a crash
+    never leaves a partial snapshot, and an attached journal is emptied once the snapshot is in place.
+    :param portfolio: the Portfolio to save
+    :param path: the snapshot file path
+    :return: path
+    """
+    store = portfolio.store
+    tickers = list(store.tickers)
+    arrays = {f'store.{name}': store[name] for name in store.columns}
+    arrays['store.dirty_rows'] = np.array(sorted(store.dirty_rows), dtype=np.int64)
+    arrays['store.stale_valuation_rows'] = np.array(sorted(store.stale_valuation_rows), dtype=np.int64)
+
+    # every position's lots and sales are concatenated, with offsets marking where each position's start
+    ledgers = [portfolio.positions[tick].lots for tick in tickers]
+    for table, dtypes in (('lots', LotLedger.lot_dtypes), ('sales', LotLedger.sale_dtypes)):
+        columns = [getattr(ledger, table) for ledger in ledgers]
+        arrays[f'{table}.offsets'] = np.concatenate([[0], np.cumsum([len(column) for column in columns])])
+        for name, dtype in dtypes.items():
+            arrays[f'{table}.{name}'] = (np.concatenate([column[name] for column in columns]) if columns else
+                                         np.empty(0, dtype=dtype))
+    for name in _LEDGER_TOTALS:
+        arrays[f'ledgers.{name}'] = np.array([getattr(ledger, name) for ledger in ledgers])
+
+    for name in ('balance_scores', 'overbalance_scores', 'correlation_scores', 'optimal_shares'):
+        values = getattr(portfolio, name)
+        arrays[f'portfolio.{name}'] = np.array([values.get(tick, np.nan) for tick in tickers], dtype=np.float64)
+    if portfolio._previous_solution is not None:
+        arrays['portfolio.previous_solution'] = portfolio._previous_solution
+    if portfolio.correlation is not None:
+        for name in _CORRELATION_ARRAYS:
+            arrays[f'correlation.{name}'] = getattr(portfolio.correlation, name)
+
+    header = {
+        'version': SNAPSHOT_VERSION,
+        'tickers': tickers,
+        'parameters': {name: getattr(portfolio, name) for name in _PORTFOLIO_PARAMETERS},
+        'derived_params': portfolio._derived_params,
+        'correlation': None if portfolio.correlation is None else {
+            'halflife': portfolio.correlation.halflife, 'n_updates': portfolio.correlation.n_updates},
+        'journal_sequence': store.journal.sequence if store.journal is not None else None,
+        'arrays': {},
+    }
+    offset = 0
+    for name, values in arrays.items():
+        values = np.ascontiguousarray(values)
+        arrays[name] = values
+        header['arrays'][name] = {'dtype': values.dtype.str, 'shape': list(values.shape), 'offset': offset}
+        offset += -(-values.nbytes // _ALIGNMENT) * _ALIGNMENT
+
+    header_bytes = json.dumps(header).encode()
+    preamble = SNAPSHOT_MAGIC + np.array([SNAPSHOT_VERSION, len(header_bytes)], dtype='<u4').tobytes() + header_bytes
+    data_start = -(-len(preamble) // _ALIGNMENT) * _ALIGNMENT
+
+    temporary_path = f'{path}.tmp'
+    with open(temporary_path, 'wb') as f:
+        f.write(preamble + b'\x00' * (data_start - len(preamble)))
+        for name, values in arrays.items():
+            f.seek(data_start + header['arrays'][name]['offset'])
+            f.write(values.tobytes())
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temporary_path, path)
+
+    if store.journal is not None:
+        store.journal.reset()
+    return path
+
+
+def _read_snapshot_header(path: str) -> tuple:
+    with open(path, 'rb') as f:
+        preamble = f.read(len(SNAPSHOT_MAGIC) + 8)
+        if preamble[:len(SNAPSHOT_MAGIC)] != SNAPSHOT_MAGIC:
+            raise ValueError(f'{path} is not a portfolio snapshot')
+        version, header_length = np.frombuffer(preamble, dtype='<u4', count=2, offset=len(SNAPSHOT_MAGIC))
+        if version > SNAPSHOT_VERSION:
+            raise ValueError(f'{path} is snapshot version {version}, only versions <= {SNAPSHOT_VERSION} can be read')
+        header = json.loads(f.read(int(header_length)))
+    data_start = -(-(len(preamble) + int(header_length)) // _ALIGNMENT) * _ALIGNMENT
+    return header, data_start
+
+
+def load_snapshot(path: str, journal_path: str = None, mmap_mode: str = 'c') -> Portfolio:
+    """
+    Restores a Portfolio from save_snapshot(). Columns are memory mapped rather than read, so restoring is near instant
+    and pages are loaded as they are used. If a journal path is given, its records made after the snapshot are replayed
+    and journaling continues to it, see PortfolioJournal for which changes are journaled.
+    :param path: the snapshot file path
+    :param journal_path: (optional) a PortfolioJournal file to replay and keep appending to
+    :param mmap_mode: default is 'c' (copy-on-write), so changes to the restored portfolio never modify the snapshot.
+    Use 'r' for a read only view.
+    :return: the restored Portfolio
+    """
+    header, data_start = _read_snapshot_header(path)
+
+    def load(name):
+        spec = header['arrays'][name]
+        shape = tuple(spec['shape'])
+        if 0 in shape:
+            return np.empty(shape, dtype=spec['dtype'])
+        # a plain ndarray view of the map slices much faster than np.memmap itself
+        return np.memmap(path, dtype=spec['dtype'], mode=mmap_mode, offset=data_start + spec['offset'],
+                         shape=shape).view(np.ndarray)
+
+    portfolio = Portfolio()
+    for name, value in header['parameters'].items():
+        setattr(portfolio, name, value)
+    if header['derived_params'] is not None:
+        weights, greed_exponent, valuation_mode = header['derived_params']
+        portfolio._derived_params = (tuple(weights), greed_exponent, valuation_mode)
+
+    tickers = header['tickers']
+    store = portfolio.store
+    if tickers:
+        # columns added after the snapshot was written keep their default values
+        defaults = PositionStore(len(tickers)).columns
+        store.columns = {name: load(f'store.{name}') if f'store.{name}' in header['arrays'] else defaults[name]
+                         for name in store.columns}
+        store.size = store.capacity = len(tickers)
+        store.tickers = list(tickers)
+        store.rows = {tick: row for row, tick in enumerate(tickers)}
+        store.resync_equity_sums()
+        store.equity_heap.invalidate()
+    store.dirty_rows = set(load('store.dirty_rows').tolist())
+    store.stale_valuation_rows = set(load('store.stale_valuation_rows').tolist())
+
+    tables = {}
+    for table, dtypes in (('lots', LotLedger.lot_dtypes), ('sales', LotLedger.sale_dtypes)):
+        tables[table] = (load(f'{table}.offsets'), {name: load(f'{table}.{name}') for name in dtypes})
+    totals = {name: load(f'ledgers.{name}') for name in _LEDGER_TOTALS}
+    lots_loader = _SnapshotLots(tables, totals)
+    for row, tick in enumerate(tickers):
+        portfolio.positions[tick] = Position._from_store_row(tick, store, row, lots_loader)
+        portfolio.tickers.append(tick)
+
+    for name in ('balance_scores', 'overbalance_scores', 'correlation_scores', 'optimal_shares'):
+        values = load(f'portfolio.{name}')
+        setattr(portfolio, name, {tickers[row]: float(values[row]) for row in np.flatnonzero(~np.isnan(values))})
+    if 'portfolio.previous_solution' in header['arrays']:
+        portfolio._previous_solution = np.array(load('portfolio.previous_solution'))
+    if header['correlation'] is not None:
+        portfolio.correlation = StreamingCorrelation(halflife=header['correlation']['halflife'])
+        portfolio.correlation.n_updates = header['correlation']['n_updates']
+        for name in _CORRELATION_ARRAYS:
+            if f'correlation.{name}' in header['arrays']:
+                setattr(portfolio.correlation, name, load(f'correlation.{name}'))
+        if 'correlation.counts' not in header['arrays']:
+            # older snapshots counted every bar for every ticker
+            n_tickers, n_updates = len(portfolio.correlation.mean), header['correlation']['n_updates']
+            portfolio.correlation.counts = np.full(n_tickers, n_updates, dtype=np.int64)
+            portfolio.correlation.pair_counts = np.full((n_tickers, n_tickers), n_updates, dtype=np.int64)
+
+    if journal_path is not None:
+        journal_sequence = header['journal_sequence'] or 0
+        if os.path.exists(journal_path):
+            replay_journal(portfolio, journal_path, from_sequence=journal_sequence)
+        attach_journal(portfolio, journal_path, start_sequence=journal_sequence)
+    return portfolio
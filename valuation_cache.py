@@ -0,0 +1,108 @@
+import shelve
+from collections import OrderedDict
+
+
+def get_valuation_key(eps: float, three_year_eps_growth: float, decay_rate: float, discount_rate: float,
+                      pe_scenarios: list, time_horizon: int = 10) -> tuple:
+    """
+    Normalizes DCF inputs into a hashable cache key. Floats are rounded so inputs that only differ by float noise
+    (i.e., 0.1 + 0.2 vs 0.3) share a key.
+    """
+    pe_scenarios = tuple(round(float(pe), 10) for pe in pe_scenarios)
+    return (round(float(eps), 10), round(float(three_year_eps_growth), 10), round(float(decay_rate), 10),
+            round(float(discount_rate), 10), pe_scenarios, int(time_horizon))
+
+
+class ValuationCache:
+    """
+    A bounded least recently used (LRU) cache of DCF valuations keyed on their normalized inputs, with an optional
+    persistent on disk tier so valuations survive process restarts.
+    The following user facing class functions are defined:
+    - ValuationCache.get(key) -> list or None: returns cached [low, middle, high] values, counting a hit or miss
+    - ValuationCache.put(key, values): stores values, evicting the least recently used entry when full
+    - ValuationCache.get_stats() -> dict: hit/miss counters and the current size
+    - ValuationCache.close(): closes the on disk tier
+    """
+
+    def __init__(self, max_size: int = 100000, path: str = None):
+        """
+        :param max_size: default is 100,000. The maximum number of valuations held in memory.
+        :param path: (optional) a file path for the persistent on disk tier (opened with shelve)
+        """
+        self.max_size = max_size
+        self._values = OrderedDict()
+        self._disk = shelve.open(path) if path else None
+
+        self.hits = 0
+        self.misses = 0
+        self.disk_hits = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._values)
+
+    def __contains__(self, key):
+        return key in self._values or (self._disk is not None and repr(key) in self._disk)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def get(self, key: tuple):
+        if key in self._values:
+            self._values.move_to_end(key)
+            self.hits += 1
+            return self._values[key]
+
+        if self._disk is not None:
+            values = self._disk.get(repr(key))
+            if values is not None:
+                self.hits += 1
+                self.disk_hits += 1
+                self._store_in_memory(key, values)
+                return values
+
+        self.misses += 1
+        return None
+
+    def put(self, key: tuple, values: list):
+        values = list(values)
+        self._store_in_memory(key, values)
+        if self._disk is not None:
+            self._disk[repr(key)] = values
+
+    def clear(self):
+        """
+        Clears the in memory tier and resets the counters, the on disk tier is kept
+        """
+        self._values.clear()
+        self.hits = 0
+        self.misses = 0
+        self.disk_hits = 0
+        self.evictions = 0
+
+    def get_stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'disk_hits': self.disk_hits,
+            'evictions': self.evictions,
+            'hit_rate': self.hits / lookups if lookups else 0,
+            'size': len(self._values),
+        }
+
+    def close(self):
+        if self._disk is not None:
+            self._disk.close()
+            self._disk = None
+
+    # #### INTERNAL METHODS #####
+    def _store_in_memory(self, key: tuple, values: list):
+        self._values[key] = values
+        self._values.move_to_end(key)
+        while len(self._values) > self.max_size:
+            self._values.popitem(last=False)
+            self.evictions += 1